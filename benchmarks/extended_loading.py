@@ -0,0 +1,74 @@
+"""Benchmark of node data bag loading: serial vs parallel
+
+Usage: python benchmarks/extended_loading.py [number of nodes] [workers]
+
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import simplejson as json
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from kitchen.backends import lchef as chef
+
+
+def build_data_bag(path, total):
+    """Writes a data bag item with ohai-like attributes for each node"""
+    nodes = []
+    for i in range(total):
+        name = "node{0}.example.com".format(i)
+        item = {
+            'name': name, 'fqdn': name, 'chef_environment': 'production',
+            'run_list': ['role[webserver]'], 'roles': ['webserver'],
+            'kernel': {'modules': dict(
+                ('module{0}'.format(j), {'size': str(j), 'refcount': '1'})
+                for j in range(150))},
+            'network': {'interfaces': dict(
+                ('eth{0}'.format(j), {'addresses': {
+                    '10.0.{0}.{1}'.format(j, i % 256): {'family': 'inet'}}})
+                for j in range(20))},
+        }
+        filename = name.replace(".", "_") + ".json"
+        with open(os.path.join(path, filename), 'w') as f:
+            f.write(json.dumps(item))
+        nodes.append({'name': name})
+    return nodes
+
+
+def measure(nodes, workers, processes, rounds=3):
+    """Returns the best loading time out of the given rounds"""
+    chef.LOAD_WORKERS = workers
+    chef.LOAD_WITH_PROCESSES = processes
+    best = None
+    for i in range(rounds):
+        start = time.time()
+        chef._load_extended_node_data(nodes)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    path = tempfile.mkdtemp()
+    try:
+        nodes = build_data_bag(path, total)
+        chef.DATA_BAG_PATH = path
+        serial = measure(nodes, 0, False)
+        print "{0} nodes, {1} workers".format(total, workers)
+        print "serial:    {0:.3f}s".format(serial)
+        for label, processes in [("threads:", False), ("processes:", True)]:
+            elapsed = measure(nodes, workers, processes)
+            print "{0:<10} {1:.3f}s ({2:.2f}x)".format(
+                label, elapsed, serial / elapsed)
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""Benchmark of node filtering: linear scan vs inverted index
+
+Usage: python benchmarks/filter_nodes.py [number of nodes]
+
+"""
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from kitchen.backends import lchef as chef
+from kitchen.backends.index import NodeIndex
+
+FILTERS = [
+    ('production', '', 'guest'),
+    ('production', 'webserver', 'guest'),
+    ('staging', 'dbserver,worker', ''),
+    ('', 'loadbalancer', 'host'),
+    ('', '', 'host,guest'),
+]
+
+
+def generate_nodes(total):
+    """Returns synthetic extended nodes"""
+    rand = random.Random(0)
+    roles = ['webserver', 'dbserver', 'dbserver_slave', 'worker',
+             'loadbalancer', 'env_production', 'env_staging']
+    nodes = []
+    for i in range(total):
+        nodes.append({
+            'name': 'node{0}'.format(i),
+            'chef_environment': rand.choice(
+                ['production', 'staging', 'testing']),
+            'roles': rand.sample(roles, rand.randint(1, 3)),
+            'virtualization': {'role': rand.choice(['host', 'guest'])},
+            'tags': rand.sample(['WIP', 'dummy', 'Node1'], 1),
+        })
+    return nodes
+
+
+def measure(func, rounds=20):
+    """Returns the average time of a call to func"""
+    start = time.time()
+    for i in range(rounds):
+        func()
+    return (time.time() - start) / rounds
+
+
+def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    nodes = generate_nodes(total)
+    start = time.time()
+    index = NodeIndex(nodes)
+    print "{0} nodes, index built in {1:.3f}s".format(
+        total, time.time() - start)
+    for env, roles, virt in FILTERS:
+        assert index.filter(env, roles, virt) == chef.filter_nodes(
+            nodes, env, roles, virt)
+        scan = measure(lambda: chef.filter_nodes(nodes, env, roles, virt))
+        indexed = measure(lambda: index.filter(env, roles, virt))
+        print "env={0!r} roles={1!r} virt={2!r}".format(env, roles, virt)
+        print "  scan: {0:.2f}ms  index: {1:.2f}ms ({2:.1f}x)".format(
+            scan * 1000, indexed * 1000, scan / indexed)
+
+
+if __name__ == "__main__":
+    main()
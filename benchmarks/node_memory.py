@@ -0,0 +1,92 @@
+"""Benchmark of the memory used by extended nodes: dicts vs NodeRecords
+
+Usage: python benchmarks/node_memory.py [number of nodes]
+
+Each variant is measured in a forked process, as the resident set size of
+the process after building all nodes minus its size before. Linux only.
+
+"""
+import os
+import sys
+import gc
+import random
+import simplejson as json
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from kitchen.backends.records import build_records
+
+
+def generate_sources(total):
+    """Returns JSON data bag items with ohai-like attributes"""
+    rand = random.Random(0)
+    sources = []
+    for i in range(total):
+        name = "node{0}.example.com".format(i)
+        node = {
+            'name': name, 'fqdn': name, 'hostname': name.split('.')[0],
+            'ipaddress': '10.0.{0}.{1}'.format(i / 256, i % 256),
+            'chef_environment': rand.choice(['production', 'staging']),
+            'run_list': ['role[webserver]', 'recipe[haproxy::app_lb]'],
+            'roles': ['webserver', 'base'], 'role': ['webserver'],
+            'recipes': ['apache2', 'haproxy::app_lb', 'ntp'],
+            'tags': ['WIP'], 'virtualization': {'role': 'guest'},
+            'memory': {'total': '4048000kB', 'free': '1024000kB',
+                       'swap': {'total': '0kB', 'free': '0kB'}},
+            'cpu': dict([('total', 4), ('real', 1)] + [
+                (str(j), {'model_name': 'Intel(R) Xeon(R)', 'mhz': '2400',
+                          'flags': ['fpu', 'vme', 'de', 'pse', 'tsc'] * 8})
+                for j in range(4)]),
+            'kernel': {'modules': dict(
+                ('module{0}'.format(j), {'size': str(j), 'refcount': '1'})
+                for j in range(100))},
+        }
+        sources.append(json.dumps(node))
+    return sources
+
+
+def rss():
+    """Returns the resident set size of the process in kB"""
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+
+
+def measure(sources, build):
+    """Returns the kB of memory taken by the nodes built in a child process
+    and the number of nodes built
+
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        gc.collect()
+        before = rss()
+        nodes = build(sources)
+        gc.collect()
+        # The nodes are still referenced here, so they are not freed yet
+        os.write(write_fd, "{0} {1}".format(rss() - before, len(nodes)))
+        os._exit(0)
+    os.waitpid(pid, 0)
+    size, count = os.read(read_fd, 64).split()
+    return int(size), int(count)
+
+
+def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+    sources = generate_sources(total)
+    dicts, count = measure(sources,
+                           lambda s: [json.loads(item) for item in s])
+    # Records keep their JSON source, so they are given their own copy of it
+    records, _ = measure(sources, lambda s: build_records(
+        (json.loads(item), (item + ' ')[:-1]) for item in s))
+    print "{0} nodes".format(count)
+    print "dicts:   {0} kB ({1:.1f} kB per node)".format(
+        dicts, float(dicts) / count)
+    print "records: {0} kB ({1:.1f} kB per node, {2:.1f}x smaller)".format(
+        records, float(records) / count, float(dicts) / records)
+
+
+if __name__ == "__main__":
+    main()
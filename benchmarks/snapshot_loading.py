@@ -0,0 +1,76 @@
+"""Benchmark of worker snapshot loading: repository files vs snapshot file
+
+Usage: python benchmarks/snapshot_loading.py [number of nodes]
+
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import simplejson as json
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from kitchen.backends import lchef as chef
+
+
+def build_kitchen(path, total):
+    """Creates a kitchen with a node file and a data bag item per node"""
+    for dirname in ['nodes', 'roles', 'cookbooks', 'data_bags/node']:
+        os.makedirs(os.path.join(path, dirname))
+    with open(os.path.join(path, 'roles', 'webserver.json'), 'w') as f:
+        f.write(json.dumps({'name': 'webserver', 'run_list': []}))
+    for i in range(total):
+        name = "node{0}.example.com".format(i)
+        node = {'chef_environment': 'production',
+                'run_list': ['role[webserver]']}
+        with open(os.path.join(path, 'nodes', name + '.json'), 'w') as f:
+            f.write(json.dumps(node))
+        node.update({
+            'name': name, 'fqdn': name, 'roles': ['webserver'],
+            'virtualization': {'role': 'guest'},
+            'kernel': {'modules': dict(
+                ('module{0}'.format(j), {'size': str(j), 'refcount': '1'})
+                for j in range(150))},
+        })
+        filename = name.replace(".", "_") + ".json"
+        with open(os.path.join(path, 'data_bags', 'node', filename), 'w') as f:
+            f.write(json.dumps(node))
+
+
+def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+    path = tempfile.mkdtemp()
+    try:
+        build_kitchen(path, total)
+        chef.KITCHEN_DIR = path
+        chef.DATA_BAG_PATH = os.path.join(path, 'data_bags', 'node')
+        chef.SNAPSHOT_DIR = os.path.join(path, 'snapshots')
+        generation = chef.get_generation()
+
+        start = time.time()
+        chef._build_snapshot(generation)
+        from_repo = time.time() - start
+
+        start = time.time()
+        chef.write_snapshot()
+        written = time.time() - start
+
+        start = time.time()
+        snapshot = chef._read_snapshot(generation)
+        from_file = time.time() - start
+        assert len(snapshot.nodes_extended) == total
+
+        size = os.path.getsize(chef._get_snapshot_path()) / 1024
+        print "{0} nodes".format(total)
+        print "load from repo files: {0:.3f}s".format(from_repo)
+        print "write snapshot file:  {0:.3f}s ({1} kB)".format(written, size)
+        print "load snapshot file:   {0:.3f}s ({1:.1f}x faster)".format(
+            from_file, from_repo / from_file)
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""Log of the nodes changed by each repo sync"""
+import os
+import time
+import tempfile
+import threading
+
+import simplejson as json
+from logbook import Logger
+
+from kitchen.settings import (SNAPSHOT_DIR, CHANGES_MAX_ENTRIES,
+                              CHANGES_MAX_SIZE)
+
+log = Logger(__name__)
+
+_cache = {'key': None, 'log': None}
+_cache_lock = threading.Lock()
+
+
+def _get_changes_path():
+    """Returns the path of the change log file"""
+    return os.path.join(SNAPSHOT_DIR, "changes.json")
+
+
+def _diff_paths(old, new, prefix=''):
+    """Returns the attribute paths, like 'memory/total', whose values differ
+    between two nodes
+
+    """
+    paths = []
+    for key in sorted(set(old) | set(new)):
+        path = prefix + key
+        if key not in old or key not in new:
+            paths.append(path)
+        elif isinstance(old[key], dict) and isinstance(new[key], dict):
+            paths.extend(_diff_paths(old[key], new[key], path + '/'))
+        elif old[key] != new[key]:
+            paths.append(path)
+    return paths
+
+
+def diff_snapshots(old, new):
+    """Returns the names of the nodes added and removed between two
+    snapshots, and the changed attribute paths of each modified node. Only
+    the nodes whose JSON source differs are decoded
+
+    """
+    old_nodes = dict((node['name'], node) for node in old.nodes_extended)
+    new_nodes = dict((node['name'], node) for node in new.nodes_extended)
+    modified = {}
+    for name in set(old_nodes) & set(new_nodes):
+        old_node, new_node = old_nodes[name], new_nodes[name]
+        if old_node._source != new_node._source:
+            paths = _diff_paths(old_node.to_dict(), new_node.to_dict())
+            if paths:
+                modified[name] = paths
+    return {'added': sorted(set(new_nodes) - set(old_nodes)),
+            'removed': sorted(set(old_nodes) - set(new_nodes)),
+            'modified': modified}
+
+
+def _read_log():
+    """Returns the change log saved by the repo sync, which is only read
+    again when the file changes
+
+    """
+    path = _get_changes_path()
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    key = (path, stat.st_ino, stat.st_size, stat.st_mtime)
+    with _cache_lock:
+        if _cache['key'] != key:
+            try:
+                with open(path, 'r') as f:
+                    _cache['log'] = json.load(f)
+            except (IOError, ValueError) as e:
+                log.error("Could not read change log '{0}': {1}".format(
+                          path, e))
+                return None
+            _cache['key'] = key
+        return _cache['log']
+
+
+def _write_log(change_log):
+    """Saves the change log without readers ever seeing half a file"""
+    if not os.path.exists(SNAPSHOT_DIR):
+        os.makedirs(SNAPSHOT_DIR, 0755)
+    fd, tmp_path = tempfile.mkstemp(dir=SNAPSHOT_DIR)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(change_log, f)
+        os.chmod(tmp_path, 0644)
+        os.rename(tmp_path, _get_changes_path())
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def record_changes(old, new):
+    """Adds the changes between the snapshots of two sync generations to the
+    change log, dropping the oldest entries when there are more than
+    CHANGES_MAX_ENTRIES or they take more than CHANGES_MAX_SIZE bytes. The
+    log is started over when there is no previous snapshot to compare with
+
+    """
+    change_log = _read_log()
+    if old is not None and change_log is not None and (
+            change_log['generation'] != old.generation):
+        # Changes of some syncs were not recorded
+        change_log = None
+    if old is None or change_log is None:
+        change_log = {'generation': new.generation, 'entries': []}
+        _write_log(change_log)
+        return None
+    if old.generation == new.generation:
+        return None
+    entry = diff_snapshots(old, new)
+    entry.update({'generation': new.generation,
+                  'previous': old.generation, 'date': time.time()})
+    entries = change_log['entries'] + [entry]
+    sizes = [len(json.dumps(item)) for item in entries]
+    while entries and (len(entries) > CHANGES_MAX_ENTRIES or
+                       sum(sizes) > CHANGES_MAX_SIZE):
+        entries.pop(0)
+        sizes.pop(0)
+    _write_log({'generation': new.generation, 'entries': entries})
+    return entry
+
+
+def get_changes(since):
+    """Returns the latest recorded generation and the changes of each sync
+    after the given generation, or None when the changes since then are not
+    in the log anymore
+
+    """
+    change_log = _read_log()
+    if change_log is None:
+        return None
+    if since == change_log['generation']:
+        return change_log['generation'], []
+    entries = change_log['entries']
+    for i, entry in enumerate(entries):
+        if entry['previous'] == since:
+            return change_log['generation'], entries[i:]
+    return None
@@ -0,0 +1,313 @@
+"""Inverted indexes over node attributes used to filter nodes"""
+
+# Node attributes nodes can be sorted by
+SORT_FIELDS = ('name', 'fqdn', 'hostname', 'ipaddress', 'chef_environment')
+
+# Node attributes searched by free text queries
+SEARCH_FIELDS = ('name', 'fqdn', 'hostname', 'ipaddress', 'chef_environment',
+                 'roles', 'tags')
+
+
+def _split(value):
+    """Returns a list out of a comma separated filter value"""
+    if not value:
+        return []
+    return value.split(',')
+
+
+def _get_sort_key(node, field):
+    """Returns the key to sort a node by the given field. IP addresses are
+    sorted by their numeric value. Nodes without the field go first
+
+    """
+    value = node.get(field)
+    if value is None:
+        return ()
+    if field == 'ipaddress':
+        try:
+            return tuple(int(part) for part in value.split('.'))
+        except (ValueError, AttributeError):
+            pass
+    return (value,)
+
+
+def _get_search_text(node):
+    """Returns the lowercase text a free text query is matched against"""
+    values = []
+    for field in SEARCH_FIELDS:
+        value = node.get(field)
+        if isinstance(value, list):
+            values.extend(value)
+        elif value:
+            values.append(value)
+    return u' '.join(unicode(value) for value in values).lower()
+
+
+class NodeIndex(object):
+    """Maps environments, role prefixes, roles, virtualization roles and tags
+    to the ids of the nodes having them, and names, fqdns and hostnames to
+    node ids. A node id is its position in the list of nodes the index was
+    built from
+
+    """
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.by_name = {}
+        self.by_fqdn = {}
+        self.by_hostname = {}
+        self.by_env = {}
+        self.by_role_prefix = {}
+        self.by_role = {}
+        self.by_virt = {}
+        self.by_tag = {}
+        self.search_text = []
+        for node_id, node in enumerate(nodes):
+            self.by_name[node.get('name')] = node_id
+            if node.get('fqdn'):
+                self.by_fqdn[node['fqdn']] = node_id
+            if node.get('hostname'):
+                self._add(self.by_hostname, node['hostname'], node_id)
+            self._add(self.by_env, node.get('chef_environment', 'none'),
+                      node_id)
+            for role in node.get('roles', []):
+                self._add(self.by_role, role, node_id)
+                self._add(self.by_role_prefix, role.split("_")[0], node_id)
+            self._add(self.by_virt,
+                      node.get('virtualization', {}).get('role'), node_id)
+            for tag in node.get('tags', []):
+                self._add(self.by_tag, tag, node_id)
+            self.search_text.append(_get_search_text(node))
+        # Node ids sorted by each sort field, and the position of each node
+        # in them
+        self.orders = {}
+        self.ranks = {}
+        for field in SORT_FIELDS:
+            order = sorted(range(len(nodes)),
+                           key=lambda node_id: _get_sort_key(
+                               nodes[node_id], field))
+            ranks = [0] * len(nodes)
+            for rank, node_id in enumerate(order):
+                ranks[node_id] = rank
+            self.orders[field] = order
+            self.ranks[field] = ranks
+
+    def _add(self, index, key, node_id):
+        index.setdefault(key, set()).add(node_id)
+
+    def _union(self, index, keys):
+        ids = set()
+        for key in keys:
+            ids.update(index.get(key, ()))
+        return ids
+
+    def find_id(self, name):
+        """Returns the id of the node with the given name, fqdn or hostname.
+        Returns None when no node matches or the hostname is not unique
+
+        """
+        node_id = self.by_name.get(name, self.by_fqdn.get(name))
+        if node_id is None:
+            ids = self.by_hostname.get(name, ())
+            if len(ids) == 1:
+                node_id = list(ids)[0]
+        return node_id
+
+    def find(self, name):
+        """Returns the node with the given name, fqdn or hostname, or None"""
+        node_id = self.find_id(name)
+        if node_id is None:
+            return None
+        return self.nodes[node_id]
+
+    def filter_ids(self, env='', roles='', virt_roles='', tags='', query=''):
+        """Returns the sorted ids of the nodes which fulfill env, roles and
+        virt_roles criteria, the same way lchef.filter_nodes() does, have
+        any of the given tags and contain every word of the query in their
+        name, addresses, environment, roles or tags
+
+        """
+        matches = []
+        if env:
+            matches.append(self.by_env.get(env, set()))
+        if roles:
+            matches.append(self._union(self.by_role_prefix, _split(roles)))
+        if virt_roles:
+            virt_roles = _split(virt_roles)
+            # A node without virtualization role counts as a 'guest'
+            matches.append(self._union(
+                self.by_virt, [virt_role for virt_role in self.by_virt
+                               if virt_role in virt_roles or
+                               ('guest' in virt_roles and not virt_role)]))
+        if tags:
+            matches.append(self._union(self.by_tag, _split(tags)))
+        if not matches:
+            ids = xrange(len(self.nodes))
+        else:
+            matches.sort(key=len)
+            ids = sorted(set.intersection(*matches))
+        if query:
+            words = query.lower().split()
+            ids = [node_id for node_id in ids
+                   if all(word in self.search_text[node_id]
+                          for word in words)]
+        return ids
+
+    def get_facets(self, ids):
+        """Returns how many of the given nodes there are per environment,
+        role group, virtualization role and tag
+
+        """
+        ids = set(ids)
+        facets = {}
+        for facet, index in [('environments', self.by_env),
+                             ('role_groups', self.by_role_prefix),
+                             ('tags', self.by_tag)]:
+            counts = facets[facet] = {}
+            for key, key_ids in index.iteritems():
+                count = len(ids.intersection(key_ids))
+                if count:
+                    counts[key] = count
+        # A node without virtualization role counts as a 'guest'
+        counts = facets['virt_roles'] = {}
+        for virt_role, key_ids in self.by_virt.iteritems():
+            count = len(ids.intersection(key_ids))
+            if count:
+                virt_role = virt_role or 'guest'
+                counts[virt_role] = counts.get(virt_role, 0) + count
+        return facets
+
+    def page_ids(self, ids, sort=None, offset=0, limit=None):
+        """Returns a page of the given node ids, sorted by a sort field, in
+        descending order if it starts with '-'. When ids are all the nodes,
+        only the ids in the page are gone through
+
+        """
+        field = sort.lstrip('-') if sort else None
+        if field and field not in SORT_FIELDS:
+            raise ValueError("Nodes can't be sorted by '{0}'".format(field))
+        descending = bool(sort) and sort.startswith('-')
+        total = len(ids)
+        end = total if limit is None else min(offset + limit, total)
+        if offset >= end:
+            return []
+        if total == len(self.nodes):
+            # All nodes, the page can be taken from a precomputed order
+            order = self.orders[field] if field else xrange(total)
+            if descending:
+                return [order[i] for i in xrange(
+                    total - 1 - offset, total - 1 - end, -1)]
+            return [order[i] for i in xrange(offset, end)]
+        if field:
+            ids = sorted(ids, key=self.ranks[field].__getitem__,
+                         reverse=descending)
+        elif descending:
+            ids = ids[::-1]
+        return ids[offset:end]
+
+    def filter(self, env='', roles='', virt_roles=''):
+        """Returns the nodes which fulfill env, roles and virt_roles criteria
+        """
+        return [self.nodes[node_id]
+                for node_id in self.filter_ids(env, roles, virt_roles)]
+
+
+class NodeList(list):
+    """List of the nodes an index was built from, in the same order. Nodes
+    are only built from their records, with the given build function, when
+    they are first read, and a node can be found by name, fqdn or hostname
+    without building the others. All nodes are built before the list is
+    modified, after which it behaves like any other list
+
+    """
+    # Nodes built at once while iterating
+    BATCH_SIZE = 100
+
+    def __init__(self, index, records, build):
+        super(NodeList, self).__init__()
+        self.index = index
+        self._records = records
+        self._build = build
+        self._nodes = {}
+        self._complete = False
+
+    def _get_nodes(self, ids):
+        """Returns the nodes with the given ids, building the missing ones
+        in a single call
+
+        """
+        missing = [node_id for node_id in ids if node_id not in self._nodes]
+        if missing:
+            nodes = self._build([self._records[node_id]
+                                 for node_id in missing])
+            self._nodes.update(zip(missing, nodes))
+        return [self._nodes[node_id] for node_id in ids]
+
+    def _complete_list(self):
+        """Builds all nodes and stores them in the list itself"""
+        if not self._complete:
+            list.extend(self, self._get_nodes(range(len(self._records))))
+            self._complete = True
+            self._nodes = None
+
+    def find(self, name):
+        """Returns the node with the given name, fqdn or hostname, or None"""
+        node_id = self.index.find_id(name)
+        if node_id is None:
+            return None
+        return self[node_id]
+
+    def __len__(self):
+        if self._complete:
+            return list.__len__(self)
+        return len(self._records)
+
+    def __getitem__(self, key):
+        if self._complete:
+            return list.__getitem__(self, key)
+        if isinstance(key, slice):
+            return self._get_nodes(range(*key.indices(len(self))))
+        node_id = key + len(self) if key < 0 else key
+        if not 0 <= node_id < len(self):
+            raise IndexError("list index out of range")
+        return self._get_nodes([node_id])[0]
+
+    def __getslice__(self, start, stop):
+        return self.__getitem__(slice(start, stop))
+
+    def __iter__(self):
+        if self._complete:
+            return list.__iter__(self)
+        return self._iter_nodes()
+
+    def _iter_nodes(self):
+        total = len(self._records)
+        for start in xrange(0, total, self.BATCH_SIZE):
+            ids = range(start, min(start + self.BATCH_SIZE, total))
+            for node in self._get_nodes(ids):
+                yield node
+
+    def __add__(self, other):
+        return list(self) + other
+
+    def __radd__(self, other):
+        return other + list(self)
+
+
+def _complete_first(name):
+    """Returns a list method which builds all nodes of a NodeList first"""
+    method = getattr(list, name)
+
+    def wrapper(self, *args):
+        self._complete_list()
+        return method(self, *args)
+    wrapper.__name__ = name
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+for _name in ('__contains__', '__reversed__', '__repr__', '__eq__', '__ne__',
+              '__lt__', '__le__', '__gt__', '__ge__', '__mul__', '__rmul__',
+              '__iadd__', '__imul__', '__setitem__', '__delitem__',
+              '__setslice__', '__delslice__', 'append', 'extend', 'insert',
+              'pop', 'remove', 'reverse', 'sort', 'index', 'count'):
+    setattr(NodeList, _name, _complete_first(_name))
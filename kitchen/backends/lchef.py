@@ -1,18 +1,50 @@
 """Functions to read and process data from a LittleChef repository"""
 import os
+import copy
+import stat
+import time
+import hashlib
+import tempfile
+import threading
+import cPickle as pickle
+from multiprocessing import Pool, TimeoutError
+from multiprocessing.pool import ThreadPool
 import simplejson as json
 
-from littlechef import runner, lib, chef
 from logbook import Logger
 
-from kitchen.settings import REPO, REPO_BASE_PATH
+from kitchen.settings import (REPO, REPO_BASE_PATH, SYNCDATE_FILE,
+                              SNAPSHOT_DIR, LOAD_WORKERS, LOAD_WITH_PROCESSES,
+                              PLUGIN_WORKERS, PLUGIN_TIMEOUT)
+from kitchen.backends.index import NodeIndex
+from kitchen.backends.records import build_records
 from kitchen.backends.plugins import plugins
+from kitchen.backends.plugins.cache import (cache as plugin_cache,
+                                            get_key as get_cache_key)
+from kitchen.backends.plugins.loader import get_inject_many, injects_data
+from kitchen.backends.plugins.stats import get_stats as get_plugin_stats
 
 log = Logger(__name__)
 
-KITCHEN_DIR = os.path.join(
-    REPO_BASE_PATH, REPO['NAME'], REPO['KITCHEN_SUBDIR'])
+REPO_DIR = os.path.join(REPO_BASE_PATH, REPO['NAME'])
+KITCHEN_DIR = os.path.join(REPO_DIR, REPO['KITCHEN_SUBDIR'])
 DATA_BAG_PATH = os.path.join(KITCHEN_DIR, "data_bags", "node")
+KITCHEN_APPLIANCES = ['nodes', 'roles', 'cookbooks', 'data_bags']
+
+_cwd_lock = threading.Lock()
+
+# Seconds after which a repo sync still marked as in progress is assumed to
+# have died
+SYNC_MAX_DURATION = 30 * 60
+
+# Needs to be increased whenever the pickled snapshot classes change
+SNAPSHOT_VERSION = 6
+SNAPSHOT_HEADER = "kitchen-snapshot {0}\n".format(SNAPSHOT_VERSION)
+
+_snapshot = None
+_snapshot_lock = threading.Lock()
+_plugin_pool = None
+_plugin_pool_lock = threading.Lock()
 
 
 class RepoError(Exception):
@@ -25,11 +57,9 @@ def _check_kitchen():
     if not os.path.exists(KITCHEN_DIR):
         raise RepoError("Repo dir doesn't exist at '{0}'".format(KITCHEN_DIR))
 
-    current_dir = os.getcwd()
-    os.chdir(KITCHEN_DIR)
-    in_a_kitchen, missing = runner._check_appliances()
-    os.chdir(current_dir)
-    if not in_a_kitchen:
+    missing = [dirname for dirname in KITCHEN_APPLIANCES
+               if not os.path.isdir(os.path.join(KITCHEN_DIR, dirname))]
+    if missing:
         missing_str = lambda m: ' and '.join(', '.join(m).rsplit(', ', 1))
         raise RepoError("Couldn't find {0}. ".format(missing_str(missing)))
     elif not os.path.exists(DATA_BAG_PATH):
@@ -38,20 +68,100 @@ def _check_kitchen():
         return True
 
 
-def build_node_data_bag():
-    """Tells LittleChef to build the node data bag"""
-    current_dir = os.getcwd()
-    os.chdir(KITCHEN_DIR)
-    try:
-        lib.get_recipes()  # This builds metadata.json for all recipes
-        chef._build_node_data_bag()
-    except SystemExit as e:
-        log.error(e)
-    finally:
-        os.chdir(current_dir)
+def _build_node_data_bag_item(name):
+    """Builds the data bag item of a single node the same way LittleChef's
+    _build_node_data_bag() does, but only loading the roles and cookbooks the
+    node uses. The item is removed when the node no longer exists. Needs to be
+    run inside the kitchen directory
+
+    """
+    from littlechef import lib, chef
+    filepath = os.path.join(
+        'data_bags', 'node', name.replace('.', '_') + '.json')
+    if not os.path.exists(os.path.join('nodes', name + '.json')):
+        if os.path.exists(filepath):
+            os.remove(filepath)
+        return
+    node = lib.get_node(name)
+    node['id'] = node['name'].replace('.', '_')
+
+    # Build extended role list
+    node['role'] = lib.get_roles_in_node(node)
+    node['roles'] = node['role'][:]
+    for role in node['role']:
+        node['roles'].extend(lib.get_roles_in_role(role))
+    node['roles'] = list(set(node['roles']))
+
+    # Build extended recipe list
+    node['recipes'] = lib.get_recipes_in_node(node)
+    for role in node['roles']:
+        node['recipes'].extend(lib.get_recipes_in_role(role))
+    node['recipes'] = list(set(node['recipes']))
+
+    recipes = []
+    for cookbook in set(recipe.split('::')[0] for recipe in node['recipes']):
+        recipes.extend(lib.get_recipes_in_cookbook(cookbook))
+    roles = [lib._get_role(role) for role in node['roles']]
+    chef._add_merged_attributes(node, recipes, roles)
+    chef._add_automatic_attributes(node)
+    with open(filepath, 'w') as f:
+        f.write(json.dumps(node))
+
+
+def build_node_data_bag(nodes=None):
+    """Tells LittleChef to build the node data bag. If a list of node names
+    is given, only the data bag items of those nodes are rebuilt
+
+    """
+    # LittleChef is slow to import and web workers don't need it
+    from littlechef import lib, chef
+    # LittleChef only works relative to the current directory. As it is
+    # process-wide state, make sure only one thread at a time changes it
+    with _cwd_lock:
+        current_dir = os.getcwd()
+        os.chdir(KITCHEN_DIR)
+        try:
+            if nodes is None:
+                lib.get_recipes()  # This builds metadata.json for all recipes
+                chef._build_node_data_bag()
+            else:
+                for name in nodes:
+                    _build_node_data_bag_item(name)
+        except SystemExit as e:
+            log.error(e)
+        finally:
+            os.chdir(current_dir)
     return True
 
 
+def get_changed_nodes(paths):
+    """Returns the names of the nodes whose data bag items are affected by
+    changes to the given files, which are relative to the repo dir. Returns
+    None when the whole node data bag needs to be rebuilt
+
+    """
+    from littlechef import cookbook_paths
+    subdir = REPO['KITCHEN_SUBDIR'].strip('/')
+    nodes = set()
+    for path in paths:
+        if subdir:
+            if not path.startswith(subdir + '/'):
+                continue
+            path = path[len(subdir) + 1:]
+        parts = path.split('/')
+        if parts[0] == 'nodes':
+            if len(parts) == 2 and parts[1].endswith('.json'):
+                nodes.add(parts[1][:-len('.json')])
+        elif parts[0] in ['roles', 'environments']:
+            return None
+        elif parts[0] in cookbook_paths and len(parts) > 2:
+            # Cookbook attributes and recipes are read from the metadata and
+            # the recipes dir. Other cookbook files don't affect the data bag
+            if parts[2] in ['metadata.rb', 'metadata.json', 'recipes']:
+                return None
+    return nodes
+
+
 def get_environments(nodes):
     """Returns an environments set out of chef_environment values found"""
     envs = set()
@@ -64,24 +174,65 @@ def get_environments(nodes):
     return [{'name': env, 'counts': counts[env]} for env in sorted(envs)]
 
 
+def _read_json_file(path, data_type):
+    """Reads and parses a JSON file from the kitchen"""
+    with open(path, 'r') as f:
+        try:
+            return json.loads(f.read())
+        except json.JSONDecodeError as e:
+            log.error('Error in "{0}": {1}'.format(path, e))
+            raise RepoError('Error while loading {0} files. Possibly a JSON '
+                            'syntax error'.format(data_type))
+
+
+def _read_node(name):
+    """Reads a node file, adding the node name as LittleChef does"""
+    path = os.path.join(KITCHEN_DIR, "nodes", name + ".json")
+    if not os.path.exists(path):
+        return None
+    node = _read_json_file(path, "node")
+    node['name'] = name
+    return node
+
+
+def _read_nodes():
+    """Reads all node files sorted by file name"""
+    nodes_dir = os.path.join(KITCHEN_DIR, "nodes")
+    if not os.path.exists(nodes_dir):
+        return []
+    filenames = sorted([f for f in os.listdir(nodes_dir)
+                        if f.endswith(".json") and not f.startswith('.')])
+    return [_read_node(f[:-len(".json")]) for f in filenames]
+
+
+def _read_roles():
+    """Reads all role files sorted by role name"""
+    roles_dir = os.path.join(KITCHEN_DIR, "roles")
+    roles = []
+    for root, subfolders, files in os.walk(roles_dir):
+        for filename in files:
+            if not filename.endswith(".json"):
+                continue
+            path = os.path.join(root, filename)
+            role = _read_json_file(path, "roles")
+            role['fullname'] = os.path.relpath(path, roles_dir)[:-len(".json")]
+            roles.append(role)
+    return sorted(roles, key=lambda x: x['fullname'])
+
+
+_readers = {'node': _read_node, 'nodes': _read_nodes, 'roles': _read_roles}
+
+
 def _data_loader(data_type, name=None):
-    """Loads data from LittleChef's kitchen"""
-    current_dir = os.getcwd()
-    os.chdir(KITCHEN_DIR)
-    try:
-        func = getattr(lib, "get_" + data_type)
-        if name:
-            data = func(name)
-        else:
-            data = func()
-    except SystemExit as e:
-        log.error(e)
-        raise RepoError('Error while loading {0} files. Possibly a JSON '
-                        'syntax error'.format(data_type))
+    """Loads data from LittleChef's kitchen. Files are read using absolute
+    paths, so that it is safe to load data from several threads at once
+
+    """
+    func = _readers[data_type]
+    if name:
+        return func(name)
     else:
-        return data
-    finally:
-        os.chdir(current_dir)
+        return func()
 
 
 def _load_data(data_type, name=None):
@@ -93,61 +244,405 @@ def _load_data(data_type, name=None):
     return _data_loader(data_type, name)
 
 
-def _load_extended_node_data(nodes):
-    """Loads JSON node files from node databag, which has merged attributes"""
+def _parallel_map(func, items, processes=False):
+    """Applies func to every item using a pool of LOAD_WORKERS threads, or
+    processes when specified. The order of the results is preserved
+
+    """
+    if not LOAD_WORKERS or len(items) < 2:
+        return map(func, items)
+    pool_class = Pool if processes else ThreadPool
+    pool = pool_class(min(LOAD_WORKERS, len(items)))
+    try:
+        return pool.map(func, items)
+    finally:
+        # Idle threads exit on their own, only wait for child processes
+        pool.close()
+        if processes:
+            pool.join()
+
+
+def _read_data_bag_item(name):
+    """Returns the path of a node's data bag item together with its contents,
+    which will be None when the item is missing
+
+    """
+    filename = name.replace(".", "_") + ".json"
+    filepath = os.path.join(DATA_BAG_PATH, filename)
+    if not os.path.exists(filepath):
+        return filepath, None
+    with open(filepath, 'r') as f:
+        return filepath, f.read()
+
+
+def _decode_data_bag_item(item):
+    """Decodes a data bag item read by _read_data_bag_item. Returns the node
+    data and an error message, one of which will be None
+
+    """
+    filepath, contents = item
+    if contents is None:
+        error = "'node' data bag was not generated correctly: item "
+        error += "'data_bag/node/{0}' is missing".format(
+            os.path.basename(filepath))
+        return None, error
+    try:
+        return json.loads(contents), None
+    except json.JSONDecodeError as e:
+        error = 'LittleChef found the following error in'
+        error += ' "{0}":\n {1}'.format(filepath, str(e))
+        return None, error
+
+
+def _load_node_data_bag(nodes):
+    """Loads the node data bag items of the given nodes. Returns a list of
+    (node data, JSON source) pairs
+
+    """
+    # Read corresponding data bag item for each node
+    items = _parallel_map(_read_data_bag_item,
+                          [node['name'] for node in nodes])
+    if LOAD_WITH_PROCESSES:
+        results = _parallel_map(_decode_data_bag_item, items, processes=True)
+    else:
+        results = map(_decode_data_bag_item, items)
     data = []
-    for node in nodes:
-        # Read corresponding data bag item for each node
-        filename = node['name'].replace(".", "_") + ".json"
-        filepath = os.path.join(DATA_BAG_PATH, filename)
-        if not os.path.exists(filepath):
-            error = "'node' data bag was not generated correctly: item "
-            error += "'data_bag/node/{0}' is missing".format(filename)
+    # Errors are raised following node order, as when loading serially
+    for (filepath, contents), (node_data, error) in zip(items, results):
+        if error is not None:
             raise RepoError(error)
-        with open(filepath, 'r') as f:
-            try:
-                data.append(json.loads(f.read()))
-            except json.JSONDecodeError as e:
-                error = 'LittleChef found the following error in'
-                error += ' "{0}":\n {1}'.format(filepath, str(e))
-                raise RepoError(error)
+        data.append((node_data, contents))
     return data
 
 
-def inject_plugin_data(nodes):
-    """Injects kitchen plugin data"""
-    for node in nodes:
-        for name, plugin in plugins.iteritems():
-            try:
-                plugin.inject(node)
-            except Exception as e:
-                log.error("Plugin '{0}' had an error: {1}".format(name, e))
-                continue
+def _load_extended_node_data(nodes):
+    """Loads JSON node files from node databag, which has merged attributes"""
+    return [node_data for node_data, contents in _load_node_data_bag(nodes)]
+
+
+def get_plugins(dynamic=None):
+    """Returns the enabled (name, plugin) pairs of the plugins injecting data
+    into nodes. Plugins setting DYNAMIC to True are run on every request, the
+    others only when a snapshot is built. Only dynamic or static ones are
+    returned when dynamic is True or False
+
+    """
+    return [(name, plugin) for name, plugin in plugins.iteritems()
+            if injects_data(plugin) and (
+                dynamic is None or
+                bool(getattr(plugin, 'DYNAMIC', False)) == dynamic)]
+
+
+def _get_plugin_pool():
+    """Returns the thread pool plugins are run in"""
+    global _plugin_pool
+    with _plugin_pool_lock:
+        if _plugin_pool is None:
+            _plugin_pool = ThreadPool(PLUGIN_WORKERS)
+        return _plugin_pool
+
+
+def _copy_for_plugin(node):
+    """Returns a copy of a node for a plugin to add its data to. The node's
+    and its guests' 'kitchen' attributes are empty, so that only the output
+    of the plugin is left in them
+
+    """
+    node = dict(node, kitchen={})
+    virtualization = node.get('virtualization')
+    if isinstance(virtualization, dict) and \
+            isinstance(virtualization.get('guests'), list):
+        node['virtualization'] = dict(virtualization, guests=[
+            dict(guest, kitchen={}) for guest in virtualization['guests']])
+    return node
+
+
+def _get_plugin_output(node):
+    """Returns the 'kitchen' attributes a plugin left in a node copy and in
+    those of its guests
+
+    """
+    guests = node.get('virtualization', {}).get('guests', [])
+    return node['kitchen'], [guest.get('kitchen', {}) for guest in guests]
+
+
+def _run_plugin(name, plugin, nodes):
+    """Runs a plugin over copies of the given nodes. Returns their plugin
+    output, how long the plugin took, whether it failed and the positions
+    of the nodes it failed for
+
+    """
+    copies = [_copy_for_plugin(node) for node in nodes]
+    start = time.time()
+    error = False
+    failed = []
+    try:
+        failed = get_inject_many(name, plugin)(copies)
+    except Exception as e:
+        log.error("Plugin '{0}' had an error: {1}".format(name, e))
+        error = True
+    duration = time.time() - start
+    return ([_get_plugin_output(node) for node in copies], duration, error,
+            failed)
+
+
+def _run_plugin_by_name(name, nodes):
+    """Runs an enabled plugin in a worker process"""
+    return _run_plugin(name, plugins[name], nodes)
+
+
+def _start_plugin(name, plugin, nodes):
+    """Starts running a plugin over the given nodes, in the thread pool or
+    in a process of its own. Returns the run to give to _get_plugin_result()
+
+    """
+    if getattr(plugin, 'PROCESSES', False):
+        pool = Pool(1)
+        result = pool.apply_async(_run_plugin_by_name, (name, nodes))
+    else:
+        pool = None
+        result = _get_plugin_pool().apply_async(
+            _run_plugin, (name, plugin, nodes))
+    start = time.time()
+    deadline = start + getattr(plugin, 'TIMEOUT', PLUGIN_TIMEOUT)
+    return name, plugin, pool, result, start, deadline
+
+
+def _get_plugin_result(run):
+    """Waits for a plugin run to finish and records it in the plugin's
+    stats. Returns the plugin output for each node, whether the plugin had
+    an error and the positions of the nodes it failed for, or None when it
+    timed out
+
+    """
+    name, plugin, pool, result, start, deadline = run
+    stats = get_plugin_stats(name, plugin)
+    try:
+        plugin_outputs, duration, error, failed = result.get(
+            max(deadline - time.time(), 0))
+    except TimeoutError:
+        log.error("Plugin '{0}' timed out".format(name))
+        stats.record(time.time() - start, error=True)
+        return None
+    except Exception as e:
+        log.error("Plugin '{0}' had an error: {1}".format(name, e))
+        stats.record(0, error=True)
+        return None
+    finally:
+        if pool is not None:
+            pool.terminate()
+    stats.record(duration, error, node_errors=len(failed))
+    return plugin_outputs, error, failed
+
+
+def _cache_plugin_output(name, nodes, plugin_outputs, failed, ttl):
+    """Stores the output of a plugin for the given nodes, except for those
+    at the failed positions
+
+    """
+    failed = set(failed)
+    for i, (node, output) in enumerate(zip(nodes, plugin_outputs)):
+        if i in failed:
+            continue
+        key = get_cache_key(name, node)
+        if key is not None:
+            plugin_cache.set(key, output, ttl)
+
+
+def _refresh_plugin_cache(name, plugin, nodes, ttl):
+    """Runs a plugin in the background over nodes whose cached output has
+    expired, unless they are already being refreshed
+
+    """
+    keys = plugin_cache.start_refresh(
+        [get_cache_key(name, node) for node in nodes])
+    if not keys:
+        return
+    nodes = [_copy_for_plugin(node) for node in nodes
+             if get_cache_key(name, node) in keys]
+
+    def refresh():
+        try:
+            result = _get_plugin_result(_start_plugin(name, plugin, nodes))
+            if result is not None:
+                plugin_outputs, error, failed = result
+                if not error:
+                    _cache_plugin_output(name, nodes, plugin_outputs,
+                                         failed, ttl)
+        finally:
+            plugin_cache.end_refresh(keys)
+    thread = threading.Thread(target=refresh)
+    thread.daemon = True
+    thread.start()
+
+
+def _get_cached_plugin_output(name, plugin, nodes, ttl):
+    """Returns the cached output of a plugin by node position, and the
+    positions of the nodes it has to be run for. Expired output is used
+    while it is refreshed in the background
+
+    """
+    cached = {}
+    missing = []
+    expired = []
+    for i, node in enumerate(nodes):
+        key = get_cache_key(name, node)
+        entry = None if key is None else plugin_cache.get(key)
+        if entry is None:
+            missing.append(i)
+            continue
+        cached[i], fresh = entry
+        if not fresh:
+            expired.append(node)
+    if expired:
+        _refresh_plugin_cache(name, plugin, expired, ttl)
+    return cached, missing
+
+
+def run_plugins(nodes, dynamic=None):
+    """Runs the enabled plugins concurrently over the given nodes, which are
+    not modified. Returns for each node the data plugins add to its
+    'kitchen' attribute and to those of its guests. Only dynamic or static
+    plugins are run when dynamic is True or False.
+
+    Plugins run in a thread pool, or in a process of their own when they
+    set PROCESSES to True. A plugin not done after PLUGIN_TIMEOUT seconds,
+    or its own TIMEOUT, adds no data. Its thread can't be stopped and keeps
+    a worker busy until the plugin returns, while its process is terminated.
+    The output of plugins setting a TTL is cached for that many seconds
+
+    """
+    outputs = [({}, []) for node in nodes]
+    running = []
+    for name, plugin in get_plugins(dynamic):
+        if not get_plugin_stats(name, plugin).is_enabled():
+            log.debug("Skipping disabled plugin '{0}'".format(name))
+            continue
+        ttl = getattr(plugin, 'TTL', None)
+        if ttl:
+            cached, missing = _get_cached_plugin_output(
+                name, plugin, nodes, ttl)
+        else:
+            cached, missing = {}, range(len(nodes))
+        run = None
+        if missing:
+            run = _start_plugin(name, plugin, [nodes[i] for i in missing])
+        running.append((name, ttl, cached, missing, run))
+    # Outputs are merged in plugin order, whichever plugin finishes first
+    for name, ttl, cached, missing, run in running:
+        plugin_outputs = cached
+        result = None if run is None else _get_plugin_result(run)
+        if result is not None:
+            computed, error, failed = result
+            plugin_outputs.update(zip(missing, computed))
+            if ttl and not error:
+                _cache_plugin_output(name, [nodes[i] for i in missing],
+                                     computed, failed, ttl)
+        for i, (data, guests) in plugin_outputs.iteritems():
+            outputs[i] = (_merge_data(outputs[i][0], data),
+                          _merge_guest_data(outputs[i][1], guests))
+    return outputs
+
+
+def inject_plugin_data(nodes, dynamic=None):
+    """Injects kitchen plugin data. Only dynamic or static plugins are run
+    when dynamic is True or False
+
+    """
+    for node, (data, guests) in zip(nodes, run_plugins(nodes, dynamic)):
+        if data:
+            node['kitchen'] = _merge_data(node.get('kitchen', {}), data)
+        for guest, guest_data in zip(
+                node.get('virtualization', {}).get('guests', []), guests):
+            if guest_data:
+                guest['kitchen'] = _merge_data(
+                    guest.get('kitchen', {}), guest_data)
+
+
+def _merge_data(data, extra):
+    """Returns a new dict with the items of extra added to those of data.
+    Dicts are merged and lists are concatenated. Neither argument is modified
+
+    """
+    merged = dict(data)
+    for key, value in extra.iteritems():
+        current = merged.get(key)
+        if isinstance(value, dict):
+            if not isinstance(current, dict):
+                current = {}
+            merged[key] = _merge_data(current, value)
+        elif isinstance(value, list) and isinstance(current, list):
+            merged[key] = current + value
+        elif isinstance(value, list):
+            merged[key] = list(value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def _merge_guest_data(data, extra):
+    """Merges two lists of guest plugin data, which may differ in length"""
+    if len(data) < len(extra):
+        data = data + [{}] * (len(extra) - len(data))
+    return [_merge_data(guest, extra[i]) if i < len(extra) else guest
+            for i, guest in enumerate(data)]
+
+
+def build_plugin_data(records):
+    """Runs the static plugins over the given node records and returns what
+    they add to the nodes' 'kitchen' attribute, for nodes by name and for
+    hosts (by name) and their guests (by fqdn) as grouped in the virt view
+
+    """
+    by_node = {}
+    by_host = {}
+    if not get_plugins(dynamic=False):
+        return by_node, by_host
+    nodes = [record.to_dict() for record in records]
+    for node, (data, guests) in zip(nodes, run_plugins(nodes, False)):
+        if data:
+            by_node[node['name']] = data
+    hosts = group_nodes_by_host(nodes)
+    for host, (data, guests) in zip(hosts, run_plugins(hosts, False)):
+        guests = dict((guest['fqdn'], guest_data) for guest, guest_data in
+                      zip(host['virtualization']['guests'], guests)
+                      if guest_data)
+        if data or guests:
+            by_host[host['name']] = (data, guests)
+    return by_node, by_host
 
 
 def group_nodes_by_host(nodes, roles=None):
-    """Returns a list of hosts with their virtual machines"""
-    hosts = filter_nodes(nodes, virt_roles='host')
-    guests = filter_nodes(nodes, virt_roles='guest')
+    """Returns a list of hosts with their virtual machines. Hosts and virtual
+    machines are new dicts, the given nodes are not modified
+
+    """
+    guests_by_fqdn = {}
+    for guest in filter_nodes(nodes, virt_roles='guest'):
+        guests_by_fqdn.setdefault(guest['fqdn'], []).append(guest)
+    if roles:
+        roles = set(roles.split(','))
     filtered_hosts = []
 
-    for host in hosts:
-        vms = host['virtualization'].get('guests', [])[:]  # Shallow copy
+    for host in filter_nodes(nodes, virt_roles='host'):
+        vms = []
         has_role = False
         for vm in host['virtualization'].get('guests', []):
-            guest_found = False
+            guests = guests_by_fqdn.get(vm['fqdn'])
+            if not guests:
+                continue  # Filter the vm (won't be shown)
+            vm = dict(vm)
             for guest in guests:
-                if guest['fqdn'] == vm['fqdn']:
-                    vm.update(guest)  # Set guest attributes in the vm
-                    guest_found = True
-                    if filter_nodes([guest], roles=roles):
-                        has_role = True
-            if not guest_found:
-                vms.remove(vm)  # Filter the vm (won't be shown)
-        host['virtualization']['guests'] = vms
+                vm.update(guest)  # Set guest attributes in the vm
+                if roles and roles.intersection(
+                        role.split("_")[0] for role in guest['roles']):
+                    has_role = True
+            vms.append(vm)
         if not roles or has_role:
             # Show all hosts if there is not a role given
             # Show only a host if it has 1 or more vms when a role is given
+            host = dict(host)
+            host['virtualization'] = dict(host['virtualization'], guests=vms)
             filtered_hosts.append(host)
     return filtered_hosts
 
@@ -182,31 +677,397 @@ def filter_nodes(nodes, env='', roles='', virt_roles=''):
     return retval
 
 
+class Snapshot(object):
+    """Repository data loaded for a given sync generation. Extended nodes are
+    kept as NodeRecords. Its contents are shared between requests and must
+    not be modified
+
+    """
+    def __init__(self, generation, nodes, nodes_extended, roles):
+        self.generation = generation
+        self.nodes = nodes
+        self.nodes_extended = nodes_extended
+        self.roles = roles
+        self.environments = get_environments(nodes_extended)
+        self.role_groups = get_role_groups(roles)
+        self.index = NodeIndex(nodes_extended)
+        self.run_plugins()
+
+    def run_plugins(self):
+        """Stores the output of the enabled static plugins and their stats,
+        as web workers don't run them when loading the snapshot saved by
+        the repo sync
+
+        """
+        static_plugins = get_plugins(False)
+        self.plugin_names = sorted(name for name, _ in static_plugins)
+        self._plugin_data, self._plugin_data_by_host = build_plugin_data(
+            self.nodes_extended)
+        self.plugin_stats = dict(
+            (name, get_plugin_stats(name, plugin).to_dict())
+            for name, plugin in static_plugins)
+
+    def inject_plugin_data(self, nodes):
+        """Adds the stored static plugin output to the given nodes"""
+        for node in nodes:
+            data = self._plugin_data.get(node.get('name'))
+            if data:
+                node['kitchen'] = _merge_data(node.get('kitchen', {}), data)
+
+    def inject_plugin_data_by_host(self, hosts):
+        """Adds the stored static plugin output to hosts grouped by
+        group_nodes_by_host() and to their guests
+
+        """
+        for host in hosts:
+            data, guests = self._plugin_data_by_host.get(
+                host.get('name'), ({}, {}))
+            if data:
+                host['kitchen'] = _merge_data(host.get('kitchen', {}), data)
+            for guest in host['virtualization'].get('guests', []):
+                if guest.get('fqdn') in guests:
+                    guest['kitchen'] = _merge_data(
+                        guest.get('kitchen', {}), guests[guest['fqdn']])
+
+    def get_node(self, name):
+        """Returns the node with the given name, fqdn or hostname, or None"""
+        node_id = self.index.find_id(name)
+        if node_id is None:
+            return None
+        return self.nodes[node_id]
+
+    def get_node_extended(self, name):
+        """Returns the record of the node with the given name, fqdn or
+        hostname, or None
+
+        """
+        return self.index.find(name)
+
+    def find_nodes(self, names, extended=True):
+        """Returns the nodes with the given names, fqdns or hostnames, either
+        their records or their node files, and the names no node was found
+        for. Each node is returned once
+
+        """
+        nodes = self.nodes_extended if extended else self.nodes
+        found = []
+        missing = []
+        seen = set()
+        for name in names:
+            node_id = self.index.find_id(name)
+            if node_id is None:
+                if name not in missing:
+                    missing.append(name)
+            elif node_id not in seen:
+                seen.add(node_id)
+                found.append(nodes[node_id])
+        return found, missing
+
+    def get_nodes_extended(self, nodes):
+        """Returns the node records of the given nodes"""
+        data = []
+        for node in nodes:
+            try:
+                data.append(
+                    self.nodes_extended[self.index.by_name[node['name']]])
+            except KeyError:
+                # Not part of the snapshot, let the loader find it or fail
+                data.extend(build_records(_load_node_data_bag([node])))
+        return data
+
+    def filter_nodes(self, env='', roles='', virt_roles='', extended=True):
+        """Returns the nodes which fulfill env, roles and virt_roles criteria,
+        either their records or their node files
+
+        """
+        nodes = self.nodes_extended if extended else self.nodes
+        return [nodes[node_id]
+                for node_id in self.index.filter_ids(env, roles, virt_roles)]
+
+    def page_nodes(self, env='', roles='', virt_roles='', tags='',
+                   query='', sort=None, offset=0, limit=None, extended=True):
+        """Returns a page of the nodes which fulfill env, roles, virt_roles,
+        tags and query criteria, sorted by sort, and the total count of
+        those nodes. Raises ValueError for an unknown sort field
+
+        """
+        nodes = self.nodes_extended if extended else self.nodes
+        ids = self.index.filter_ids(env, roles, virt_roles, tags, query)
+        page = self.index.page_ids(ids, sort, offset, limit)
+        return [nodes[node_id] for node_id in page], len(ids)
+
+    def get_facets(self, env='', roles='', virt_roles='', tags='',
+                   query=''):
+        """Returns the node counts per environment, role group,
+        virtualization role and tag of the nodes which fulfill the criteria
+
+        """
+        return self.index.get_facets(
+            self.index.filter_ids(env, roles, virt_roles, tags, query))
+
+
+def _get_repo_head():
+    """Returns the commit id the kitchen's git HEAD points to, if any"""
+    git_dir = os.path.join(REPO_DIR, '.git')
+    try:
+        with open(os.path.join(git_dir, 'HEAD'), 'r') as f:
+            head = f.read().strip()
+        if not head.startswith('ref: '):
+            return head  # Detached HEAD
+        ref = head[len('ref: '):]
+        ref_path = os.path.join(git_dir, ref)
+        if os.path.exists(ref_path):
+            with open(ref_path, 'r') as f:
+                return f.read().strip()
+        with open(os.path.join(git_dir, 'packed-refs'), 'r') as f:
+            for line in f:
+                if line.rstrip().endswith(' ' + ref):
+                    return line.split(' ')[0]
+    except IOError:
+        pass
+    return None
+
+
+def _get_repo_sync_date():
+    """Returns the timestamp of the last repo sync on disk, or None"""
+    try:
+        return os.stat(SYNCDATE_FILE).st_mtime
+    except OSError:
+        return None
+
+
+def _get_repo_generation():
+    """Returns a token identifying the data currently present on disk. It
+    changes whenever the repo sync date is bumped or the git HEAD moves
+
+    """
+    key = "{0}|{1!r}|{2}".format(KITCHEN_DIR, _get_repo_sync_date(),
+                                 _get_repo_head())
+    return hashlib.sha1(key).hexdigest()[:12]
+
+
+def _get_sync_marker_path():
+    """Returns the path of the file marking a repo sync in progress"""
+    return os.path.join(SNAPSHOT_DIR, "sync-in-progress")
+
+
+def _read_sync_marker():
+    """Returns the generation and sync date from before the repo sync in
+    progress, or None when there is no sync in progress
+
+    """
+    path = _get_sync_marker_path()
+    try:
+        if time.time() - os.stat(path).st_mtime >= SYNC_MAX_DURATION:
+            return None
+        with open(path, 'r') as f:
+            marker = json.load(f)
+        return marker['generation'], marker['sync_date']
+    except (OSError, IOError, ValueError, KeyError, TypeError):
+        return None
+
+
+def get_generation():
+    """Returns a token identifying the data web workers should show. While
+    a repo sync is in progress it is the generation from before the sync,
+    so that workers keep their snapshot until the new one is saved
+
+    """
+    marker = _read_sync_marker()
+    if marker is not None:
+        return marker[0]
+    return _get_repo_generation()
+
+
+def get_sync_date():
+    """Returns the timestamp of the repo sync of the generation returned by
+    get_generation(), or None when the repo was never synced
+
+    """
+    marker = _read_sync_marker()
+    if marker is not None:
+        return marker[1]
+    return _get_repo_sync_date()
+
+
+def start_sync():
+    """Marks a repo sync as started, keeping the current generation and its
+    sync date until finish_sync() is called
+
+    """
+    if not os.path.exists(SNAPSHOT_DIR):
+        os.makedirs(SNAPSHOT_DIR, 0755)
+    fd, tmp_path = tempfile.mkstemp(dir=SNAPSHOT_DIR)
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'generation': _get_repo_generation(),
+                   'sync_date': _get_repo_sync_date()}, f)
+    os.chmod(tmp_path, 0644)
+    os.rename(tmp_path, _get_sync_marker_path())
+
+
+def finish_sync():
+    """Marks the repo sync as finished, making its generation visible"""
+    try:
+        os.remove(_get_sync_marker_path())
+    except OSError:
+        pass
+
+
+def _build_snapshot(generation):
+    """Loads all repository data into a new snapshot"""
+    nodes = _load_data("nodes")
+    nodes_extended = build_records(_load_node_data_bag(nodes))
+    roles = _load_data("roles")
+    log.debug("Built snapshot for generation {0}".format(generation))
+    return Snapshot(generation, nodes, nodes_extended, roles)
+
+
+def _get_snapshot_path():
+    """Returns the path of the snapshot file for the current format"""
+    return os.path.join(SNAPSHOT_DIR,
+                        "snapshot-v{0}.pickle".format(SNAPSHOT_VERSION))
+
+
+def write_snapshot():
+    """Builds the snapshot of the current sync generation and saves it, so
+    that web workers can load it without parsing the repository files
+
+    """
+    snapshot = _build_snapshot(_get_repo_generation())
+    if not os.path.exists(SNAPSHOT_DIR):
+        os.makedirs(SNAPSHOT_DIR, 0755)
+    # Write to a temporary file first so that readers never see half a file
+    fd, tmp_path = tempfile.mkstemp(dir=SNAPSHOT_DIR)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(SNAPSHOT_HEADER)
+            pickle.dump(snapshot, f, pickle.HIGHEST_PROTOCOL)
+        os.chmod(tmp_path, 0644)
+        os.rename(tmp_path, _get_snapshot_path())
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    return snapshot
+
+
+def _is_writable_by_others(path):
+    """Returns whether users other than the owner can write to a path"""
+    return bool(os.stat(path).st_mode & (stat.S_IWGRP | stat.S_IWOTH))
+
+
+def read_saved_snapshot():
+    """Returns the snapshot saved by the last repo sync, whatever its
+    generation, or None when there is none, it was saved in an older format,
+    or it could have been replaced by another user
+
+    """
+    path = _get_snapshot_path()
+    try:
+        if (_is_writable_by_others(SNAPSHOT_DIR) or
+                _is_writable_by_others(path)):
+            # Unpickling a planted file would run arbitrary code
+            log.error("Ignoring snapshot '{0}' which is writable by other "
+                      "users".format(path))
+            return None
+        with open(path, 'rb') as f:
+            if f.readline() != SNAPSHOT_HEADER:
+                log.info("Ignoring snapshot '{0}' with an outdated "
+                         "format".format(path))
+                return None
+            snapshot = pickle.load(f)
+    except (OSError, IOError):
+        return None
+    except Exception as e:
+        log.error("Could not load snapshot '{0}': {1}".format(path, e))
+        return None
+    return snapshot
+
+
+def _read_snapshot(generation):
+    """Returns the snapshot saved by the repo sync, or None when there is
+    none for the given generation or it was saved in an older format
+
+    """
+    snapshot = read_saved_snapshot()
+    if snapshot is None or snapshot.generation != generation:
+        return None
+    if snapshot.plugin_names != sorted(name for name, _ in get_plugins(False)):
+        # The repo sync was run with other plugins enabled
+        snapshot.run_plugins()
+    return snapshot
+
+
+def get_snapshot():
+    """Returns the snapshot of the current sync generation. It is only
+    loaded again when a repo sync has taken place since it was last loaded,
+    from the file saved by the sync or, when missing, from the repository
+
+    """
+    global _snapshot
+    generation = get_generation()
+    snapshot = _snapshot
+    if snapshot is not None and snapshot.generation == generation:
+        return snapshot
+    with _snapshot_lock:
+        if _snapshot is None or _snapshot.generation != generation:
+            _snapshot = (_read_snapshot(generation) or
+                         _build_snapshot(generation))
+        return _snapshot
+
+
+def detach_node(node):
+    """Returns a copy of a snapshot node that views and plugins can modify.
+    Only the top level and the 'kitchen' and 'virtualization' attributes are
+    copied, the rest of the data is shared with the snapshot
+
+    """
+    node = dict(node)
+    for key in ('kitchen', 'virtualization'):
+        if key in node:
+            node[key] = copy.deepcopy(node[key])
+    return node
+
+
 def get_node(name):
-    """Returns the given node"""
-    node = _load_data("node", name)
-    if node == {'run_list': []}:
-        # Workaround LittleChef returning an empy node file when not found
+    """Returns the node with the given name, fqdn or hostname"""
+    node = get_snapshot().get_node(name)
+    if node is None:
         return None
-    else:
-        return node
+    return copy.deepcopy(node)
 
 
 def get_nodes():
     """Returns nodes present in the repository's 'nodes' directory"""
-    return _load_data("nodes")
+    return [detach_node(node) for node in get_snapshot().nodes]
+
+
+def get_node_extended(name):
+    """Returns the data from the automatic 'node' data bag of the node with
+    the given name, fqdn or hostname
+
+    """
+    node = get_snapshot().get_node_extended(name)
+    if node is None:
+        return None
+    return node.to_dict()
+
 
+def get_nodes_extended(nodes=None, fields=None):
+    """Returns node data from the automatic 'node' data_bag. If a list of
+    attribute paths like 'memory/total' is given as fields, nodes only
+    contain those attributes
 
-def get_nodes_extended(nodes=None):
-    """Returns node data from the automatic 'node' data_bag"""
+    """
+    snapshot = get_snapshot()
     if nodes is None:
-        nodes = _load_data("nodes")
-    return _load_extended_node_data(nodes)
+        nodes = snapshot.nodes
+    return [node.project(fields)
+            for node in snapshot.get_nodes_extended(nodes)]
 
 
 def get_roles():
     """Returns roles present in the repository's 'roles' directory"""
-    return _load_data("roles")
+    return copy.deepcopy(get_snapshot().roles)
 
 
 def get_role_groups(roles):
@@ -1,4 +1,6 @@
 """Plugins package"""
+import threading
+
 from kitchen.backends.plugins.loader import import_plugins
 
 
@@ -19,4 +21,67 @@ def is_view(plugin_type):
             return func
         return inner
 
-plugins = import_plugins()
+
+def find_node(nodes, fqdn):
+    """Returns the node with the given fqdn, or None. Node lists given to
+    plugin views can find it without going through all nodes
+
+    """
+    if hasattr(nodes, 'find'):
+        return nodes.find(fqdn)
+    for node in nodes:
+        if node.get('fqdn') == fqdn:
+            return node
+    return None
+
+
+class PluginRegistry(dict):
+    """Dict of the enabled plugins by name. Plugins are only imported when
+    it is first accessed, so that importing the backend stays cheap
+
+    """
+    def __init__(self):
+        super(PluginRegistry, self).__init__()
+        self._loaded = False
+        self._lock = threading.RLock()
+
+    def load(self):
+        """Imports the enabled plugins unless they have been already"""
+        if self._loaded:
+            return
+        with self._lock:
+            if not self._loaded:
+                dict.update(self, import_plugins())
+                self._loaded = True
+
+    def _loading(method):
+        def wrapper(self, *args, **kwargs):
+            self.load()
+            return method(self, *args, **kwargs)
+        wrapper.__name__ = method.__name__
+        return wrapper
+
+    __getitem__ = _loading(dict.__getitem__)
+    __contains__ = _loading(dict.__contains__)
+    __iter__ = _loading(dict.__iter__)
+    __len__ = _loading(dict.__len__)
+    __repr__ = _loading(dict.__repr__)
+    get = _loading(dict.get)
+    has_key = _loading(dict.has_key)
+    keys = _loading(dict.keys)
+    values = _loading(dict.values)
+    items = _loading(dict.items)
+    iterkeys = _loading(dict.iterkeys)
+    itervalues = _loading(dict.itervalues)
+    iteritems = _loading(dict.iteritems)
+    copy = _loading(dict.copy)
+    update = _loading(dict.update)
+    clear = _loading(dict.clear)
+    pop = _loading(dict.pop)
+    setdefault = _loading(dict.setdefault)
+    __setitem__ = _loading(dict.__setitem__)
+    __delitem__ = _loading(dict.__delitem__)
+    del _loading
+
+
+plugins = PluginRegistry()
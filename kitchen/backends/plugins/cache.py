@@ -0,0 +1,93 @@
+"""Cache of plugin output with stale-while-revalidate expiration"""
+import time
+import threading
+from collections import OrderedDict
+
+from kitchen.settings import PLUGIN_CACHE_SIZE
+
+
+def get_key(name, node):
+    """Returns the cache key of a plugin's output for a node, or None when
+    the node has no fqdn. Guests are part of the key, as plugins can add
+    data to them too
+
+    """
+    fqdn = node.get('fqdn')
+    if not fqdn:
+        return None
+    guests = node.get('virtualization', {}).get('guests', [])
+    return name, fqdn, tuple(guest.get('fqdn') for guest in guests)
+
+
+class PluginCache(object):
+    """LRU cache of plugin output. Entries are fresh for the TTL they were
+    stored with, and stale but still usable for that long again, to be
+    refreshed meanwhile. They are dropped after that
+
+    """
+    def __init__(self, max_size=None):
+        self.max_size = PLUGIN_CACHE_SIZE if max_size is None else max_size
+        self.entries = OrderedDict()
+        self.refreshing = set()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, now=None):
+        """Returns a (value, is_fresh) pair, or None when there is no
+        usable entry for key
+
+        """
+        now = now or time.time()
+        with self.lock:
+            try:
+                value, fresh_until, stale_until = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            if now >= stale_until:
+                self.misses += 1
+                return None
+            self.entries[key] = value, fresh_until, stale_until
+            if now < fresh_until:
+                self.hits += 1
+                return value, True
+            self.stale_hits += 1
+            return value, False
+
+    def set(self, key, value, ttl, now=None):
+        """Stores value for key for ttl seconds"""
+        now = now or time.time()
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value, now + ttl, now + 2 * ttl
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def start_refresh(self, keys):
+        """Marks the given keys as being refreshed. Returns those which were
+        not being refreshed already
+
+        """
+        with self.lock:
+            keys = [key for key in keys if key not in self.refreshing]
+            self.refreshing.update(keys)
+            return keys
+
+    def end_refresh(self, keys):
+        """Marks the given keys as not being refreshed any more"""
+        with self.lock:
+            self.refreshing.difference_update(keys)
+
+    def clear(self):
+        """Drops all entries and resets the counters"""
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.stale_hits = self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+
+cache = PluginCache()
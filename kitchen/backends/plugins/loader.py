@@ -23,9 +23,45 @@ def import_plugin(name):
                 raise ImportError(str(e))
     except IOError as e:
         raise ImportError(str(e))
+    if not injects_data(plugin):
+        log.debug("Plugin '{0}' only provides views".format(name))
     return plugin
 
 
+def injects_data(plugin):
+    """Returns whether a plugin defines inject() or inject_many(). Both are
+    optional, a plugin can also only provide views
+
+    """
+    return hasattr(plugin, 'inject') or hasattr(plugin, 'inject_many')
+
+
+def get_inject_many(name, plugin):
+    """Returns a function injecting plugin data into a list of nodes, which
+    returns the positions of the nodes it failed for. When the plugin has
+    inject_many() it fails as a whole by raising an error. Otherwise
+    inject() is called for each node, and a node raising an error doesn't
+    stop the others
+
+    """
+    if hasattr(plugin, 'inject_many'):
+        def inject_many(nodes):
+            plugin.inject_many(nodes)
+            return []
+        return inject_many
+
+    def inject_many(nodes):
+        failed = []
+        for i, node in enumerate(nodes):
+            try:
+                plugin.inject(node)
+            except Exception as e:
+                log.error("Plugin '{0}' had an error: {1}".format(name, e))
+                failed.append(i)
+        return failed
+    return inject_many
+
+
 def import_plugins():
     """Imports plugin python module"""
     plugins = {}
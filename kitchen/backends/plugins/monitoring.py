@@ -1,7 +1,7 @@
 """Plugin that adds monitoring links"""
 
 from django.shortcuts import redirect
-from kitchen.backends.plugins import is_view
+from kitchen.backends.plugins import is_view, find_node
 
 
 def inject(node):
@@ -22,14 +22,15 @@ def links(request, nodes):
         fqdn = request.GET['fqdn']
     except KeyError:
         return None
-    for node in nodes:
-        if fqdn == node['fqdn']:
-            try:
-                links = node['kitchen']['data']['links']
-            except KeyError:
-                return None
-            for link in links:
-                if link.get('title') == 'monitoring':
-                    return redirect(link['url'])
-            else:
-                return None
+    node = find_node(nodes, fqdn)
+    if node is None:
+        return None
+    try:
+        links = node['kitchen']['data']['links']
+    except KeyError:
+        return None
+    for link in links:
+        if link.get('title') == 'monitoring':
+            return redirect(link['url'])
+    else:
+        return None
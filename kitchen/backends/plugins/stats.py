@@ -0,0 +1,116 @@
+"""Plugin instrumentation and circuit breaking"""
+import time
+import threading
+from collections import deque
+
+from logbook import Logger
+
+from kitchen.settings import (PLUGIN_TIME_BUDGET, PLUGIN_MAX_FAILURES,
+                              PLUGIN_COOL_DOWN)
+
+log = Logger(__name__)
+
+# Number of recent durations percentiles are computed from
+SAMPLES = 1000
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+class PluginStats(object):
+    """Counts the runs of a plugin and disables it for a cool-down period
+    after it fails or goes over its time budget too many times in a row.
+    Nodes the plugin fails for in a run which otherwise succeeds are only
+    counted
+
+    """
+    def __init__(self, name, budget=None):
+        self.name = name
+        self.budget = PLUGIN_TIME_BUDGET if budget is None else budget
+        self.calls = 0
+        self.errors = 0
+        self.node_errors = 0
+        self.over_budget = 0
+        self.total_time = 0.0
+        self.durations = deque(maxlen=SAMPLES)
+        self.failures = 0
+        self.disabled_until = 0
+        self.lock = threading.Lock()
+
+    def is_enabled(self, now=None):
+        """Returns whether the plugin may be run. Once the cool-down is over
+        it is run again, and a single failure disables it again
+
+        """
+        return (now or time.time()) >= self.disabled_until
+
+    def record(self, duration, error=False, now=None, node_errors=0):
+        """Records a run of the plugin, and how many nodes it failed for"""
+        with self.lock:
+            self.calls += 1
+            self.total_time += duration
+            self.durations.append(duration)
+            self.node_errors += node_errors
+            if error:
+                self.errors += 1
+            if duration > self.budget:
+                self.over_budget += 1
+            if not error and duration <= self.budget:
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.failures >= PLUGIN_MAX_FAILURES:
+                self.disabled_until = (now or time.time()) + PLUGIN_COOL_DOWN
+                log.warning("Plugin '{0}' disabled for {1} seconds after {2} "
+                            "failed runs".format(self.name, PLUGIN_COOL_DOWN,
+                                                 self.failures))
+
+    def percentile(self, percent):
+        """Returns the given percentile of the recent run durations"""
+        durations = sorted(self.durations)
+        if not durations:
+            return None
+        rank = int(round(percent / 100.0 * len(durations))) - 1
+        return durations[max(rank, 0)]
+
+    def to_dict(self, now=None):
+        """Returns the stats as a dict which can be serialized to JSON"""
+        now = now or time.time()
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'node_errors': self.node_errors,
+            'over_budget': self.over_budget,
+            'total_time': self.total_time,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'budget': self.budget,
+            'enabled': self.is_enabled(now),
+            'disabled_for': max(self.disabled_until - now, 0),
+        }
+
+
+def get_stats(name, plugin=None):
+    """Returns the stats of the given plugin, which are created on first use
+    with the plugin's TIME_BUDGET if it has one
+
+    """
+    with _stats_lock:
+        if name not in _stats:
+            _stats[name] = PluginStats(
+                name, getattr(plugin, 'TIME_BUDGET', None))
+        return _stats[name]
+
+
+def get_all_stats():
+    """Returns the stats of all plugins run so far as dicts, by name"""
+    with _stats_lock:
+        stats = _stats.items()
+    return dict((name, plugin_stats.to_dict()) for name, plugin_stats in stats)
+
+
+def reset_stats():
+    """Forgets the stats of all plugins"""
+    with _stats_lock:
+        _stats.clear()
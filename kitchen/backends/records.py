@@ -0,0 +1,175 @@
+"""Compact representation of extended nodes"""
+import copy
+
+import simplejson as json
+
+# Node attributes shown in node lists, which are kept decoded in a record
+FIELDS = ('name', 'fqdn', 'hostname', 'ipaddress', 'chef_environment',
+          'run_list', 'role', 'roles', 'recipes', 'tags', 'virtualization',
+          'kitchen')
+# Attributes whose strings are repeated across many nodes
+INTERNED_FIELDS = ('chef_environment', 'run_list', 'role', 'roles',
+                   'recipes', 'tags')
+# Hardware attributes of which only the totals are kept
+HARDWARE_FIELDS = ('memory', 'cpu')
+# Attributes which views and plugins add data to
+MODIFIABLE_FIELDS = ('kitchen', 'virtualization')
+
+_FIELD_SET = frozenset(FIELDS)
+_MISSING = object()
+
+
+class StringPool(object):
+    """Makes equal strings share a single object. Unlike intern(), it also
+    works with unicode strings, and its strings are freed with the pool
+
+    """
+    def __init__(self):
+        self.strings = {}
+
+    def get(self, value):
+        if isinstance(value, basestring):
+            return self.strings.setdefault(value, value)
+        elif isinstance(value, list):
+            return [self.get(item) for item in value]
+        return value
+
+
+class NodeRecord(object):
+    """Read-only mapping holding an extended node. Only the attributes in
+    FIELDS are kept as Python objects. Any other attribute is decoded from the
+    node's JSON source each time it is accessed
+
+    """
+    __slots__ = FIELDS + ('_totals', '_source')
+
+    def __init__(self, data, source, pool=None):
+        pool = pool or StringPool()
+        for field in FIELDS:
+            value = data.get(field, _MISSING)
+            if field in INTERNED_FIELDS:
+                value = pool.get(value)
+            setattr(self, field, value)
+        virtualization = data.get('virtualization')
+        if isinstance(virtualization, dict) and 'role' in virtualization:
+            virtualization['role'] = pool.get(virtualization['role'])
+        self._totals = {}
+        for field in HARDWARE_FIELDS:
+            try:
+                self._totals[field] = {'total': data[field]['total']}
+            except (KeyError, TypeError):
+                pass
+        self._source = source
+
+    @property
+    def attributes(self):
+        """All node attributes, decoded from the node's JSON source"""
+        return json.loads(self._source)
+
+    def to_dict(self):
+        """Returns a new dict with all node attributes"""
+        return self.attributes
+
+    def project(self, fields=None):
+        """Returns a new dict with only the given attribute paths, like
+        'name' or 'memory/total', or with all attributes when fields is None.
+        The node's JSON source is only decoded when a path is neither one of
+        FIELDS nor a hardware total
+
+        """
+        if fields is None:
+            return self.to_dict()
+        data = {}
+        attributes = None
+        for field in fields:
+            path = field.split('/')
+            if path[0] in _FIELD_SET:
+                # Values kept by the record are shared, copy the modifiable
+                # ones so that the record is not changed through the dict
+                source = {path[0]: getattr(self, path[0])}
+                _copy_path(source, path, data, path[0] in MODIFIABLE_FIELDS)
+            elif path[0] in self._totals and path[1:] == ['total']:
+                _copy_path(self._totals, path, data)
+            else:
+                if attributes is None:
+                    attributes = self.attributes
+                _copy_path(attributes, path, data)
+        return data
+
+    def __getitem__(self, key):
+        if key in _FIELD_SET:
+            value = getattr(self, key)
+            if value is _MISSING:
+                raise KeyError(key)
+            return value
+        return self.attributes[key]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        if key in _FIELD_SET:
+            return getattr(self, key) is not _MISSING
+        return key in self.attributes
+
+    def keys(self):
+        return self.attributes.keys()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.attributes)
+
+    def __getstate__(self):
+        state = dict((field, getattr(self, field)) for field in FIELDS
+                     if getattr(self, field) is not _MISSING)
+        state['_totals'] = self._totals
+        state['_source'] = self._source
+        return state
+
+    def __setstate__(self, state):
+        for field in self.__slots__:
+            setattr(self, field, state.get(field, _MISSING))
+
+    def __repr__(self):
+        return "<NodeRecord {0}>".format(self.get('name'))
+
+
+def _copy_path(source, path, target, deep=False):
+    """Copies the value found following path in source to the same path in
+    target, making a deep copy of it if specified. Nothing is copied when the
+    path doesn't exist
+
+    """
+    value = source
+    for key in path:
+        if not isinstance(value, dict) or key not in value:
+            return
+        value = value[key]
+    if value is _MISSING:
+        return
+    for key in path[:-1]:
+        target = target.setdefault(key, {})
+    target[path[-1]] = copy.deepcopy(value) if deep else value
+
+
+def project(data, fields):
+    """Returns a new dict with only the given attribute paths of a node dict
+    """
+    projected = {}
+    for field in fields:
+        _copy_path(data, field.split('/'), projected)
+    return projected
+
+
+def build_records(items):
+    """Returns NodeRecords for the given (data, source) pairs, sharing equal
+    strings between all of them
+
+    """
+    pool = StringPool()
+    return [NodeRecord(data, source, pool) for data, source in items]
@@ -12,6 +12,7 @@ os.environ['DJANGO_SETTINGS_MODULE'] = 'kitchen.settings'
 from kitchen.settings import (REPO, REPO_BASE_PATH, SYNCDATE_FILE, LOG_FILE,
                               DEBUG)
 from kitchen.backends import lchef as chef
+from kitchen.backends import changes
 
 file_log_handler = MonitoringFileHandler(LOG_FILE, bubble=DEBUG)
 file_log_handler.push_application()
@@ -23,16 +24,25 @@ class SyncRepo():
     REPO_ROOT = os.path.join(REPO_BASE_PATH, REPO['NAME'])
 
     def run(self):
-        """Syncs the git repository"""
+        """Syncs the git repository. Web workers keep showing the previous
+        sync until the snapshot of this one is saved
+
+        """
         log.debug("Synching repo")
-        if os.path.exists(self.REPO_ROOT):
-            self._update()
-        else:
-            self._clone()
-        self._set_repo_sync_date()
+        chef.start_sync()
+        try:
+            if os.path.exists(self.REPO_ROOT):
+                self._update()
+            else:
+                self._clone()
+            self._set_repo_sync_date()
+            self._write_snapshot()
+        finally:
+            chef.finish_sync()
 
     def _update(self):
         """Do a 'git pull'"""
+        old_head = self._get_head()
         cmd = ['git', 'pull']
         p = Popen(cmd, stdout=PIPE, stderr=PIPE, cwd=self.REPO_ROOT)
         log.info("Updating repo")
@@ -41,7 +51,56 @@ class SyncRepo():
             log.error("git pull returned {0}: {1}".format(
                       p.returncode, stderr))
         else:
+            self._update_node_data_bag(old_head)
+
+    def _get_head(self):
+        """Returns the commit id of the repo's HEAD, or None on errors"""
+        cmd = ['git', 'rev-parse', 'HEAD']
+        p = Popen(cmd, stdout=PIPE, stderr=PIPE, cwd=self.REPO_ROOT)
+        stdout, stderr = p.communicate()
+        if p.returncode != 0:
+            log.error("git rev-parse returned {0}: {1}".format(
+                      p.returncode, stderr))
+            return None
+        return stdout.strip()
+
+    def _get_changed_files(self, old_head, new_head):
+        """Returns the files changed between two commits, or None on errors"""
+        cmd = ['git', 'diff', '--name-only', old_head, new_head]
+        p = Popen(cmd, stdout=PIPE, stderr=PIPE, cwd=self.REPO_ROOT)
+        stdout, stderr = p.communicate()
+        if p.returncode != 0:
+            log.error("git diff returned {0}: {1}".format(
+                      p.returncode, stderr))
+            return None
+        return stdout.splitlines()
+
+    def _update_node_data_bag(self, old_head):
+        """Rebuilds the node data bag items affected by the pulled changes.
+        Everything is rebuilt when the changes can't be determined or they
+        affect roles or cookbook metadata
+
+        """
+        new_head = self._get_head()
+        if old_head is None or new_head is None:
+            nodes = None
+        elif old_head == new_head:
+            nodes = set()
+        else:
+            changed_files = self._get_changed_files(old_head, new_head)
+            if changed_files is None:
+                nodes = None
+            else:
+                nodes = chef.get_changed_nodes(changed_files)
+        if not os.path.exists(chef.DATA_BAG_PATH):
+            nodes = None
+        if nodes is None:
+            log.info("Building the node data bag")
             chef.build_node_data_bag()
+        elif nodes:
+            log.info("Rebuilding the node data bag for {0} nodes".format(
+                     len(nodes)))
+            chef.build_node_data_bag(sorted(nodes))
 
     def _clone(self):
         """Clone a git repository"""
@@ -57,6 +116,24 @@ class SyncRepo():
         else:
             chef.build_node_data_bag()
 
+    def _write_snapshot(self):
+        """Saves the synced data for the web workers to load, and records
+        the nodes changed since the previous sync
+
+        """
+        previous = chef.read_saved_snapshot()
+        try:
+            snapshot = chef.write_snapshot()
+        except chef.RepoError as e:
+            log.error("Could not write snapshot: {0}".format(e))
+            return
+        entry = changes.record_changes(previous, snapshot)
+        if entry:
+            log.info("Sync changed {0} nodes, added {1} and removed "
+                     "{2}".format(len(entry['modified']),
+                                  len(entry['added']),
+                                  len(entry['removed'])))
+
     def _set_repo_sync_date(self):
         """Sets the modified date of a file, which will be the sync date"""
         with file(SYNCDATE_FILE, 'a'):
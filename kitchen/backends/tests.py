@@ -1,11 +1,23 @@
 """Tests for the kitchen.backends app"""
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+
 import simplejson as json
 from django.test import TestCase
 from mock import patch
 
 from kitchen.backends import lchef as chef
-from kitchen.backends import plugins
-from kitchen.backends.plugins import loader
+from kitchen.backends import changes, plugins
+from kitchen.backends.index import NodeIndex, NodeList
+from kitchen.backends.plugins import loader, stats as plugin_stats
+from kitchen.backends.plugins.cache import PluginCache
+from kitchen.backends.records import NodeRecord, build_records
+from kitchen.backends.repo_sync import SyncRepo
+from kitchen.settings import REPO
 
 chef.build_node_data_bag()
 TOTAL_NODES = 9
@@ -49,6 +61,38 @@ class TestRepo(TestCase):
         nodes.append({'name': 'extra_node'})
         self.assertRaises(chef.RepoError, chef._load_extended_node_data, nodes)
 
+    def test_node_data_bag_errors_in_node_order(self):
+        """Should raise the error of the first failing node in node order"""
+        nodes = chef._load_data("nodes")
+        with patch.object(json, 'loads') as mock_method:
+            mock_method.side_effect = json.decoder.JSONDecodeError(
+                "JSON syntax error", "", 10)
+            try:
+                chef._load_extended_node_data([{'name': 'extra_node'}] + nodes)
+            except chef.RepoError as e:
+                self.assertTrue("'data_bag/node/extra_node.json' is missing"
+                                in str(e))
+            else:
+                self.fail("RepoError not raised")
+            try:
+                chef._load_extended_node_data(nodes + [{'name': 'extra_node'}])
+            except chef.RepoError as e:
+                self.assertTrue("testnode1.json" in str(e), str(e))
+            else:
+                self.fail("RepoError not raised")
+
+    def test_load_node_data_bag_in_parallel(self):
+        """Should load the same node data in the same order in parallel"""
+        nodes = chef._load_data("nodes")
+        with patch('kitchen.backends.lchef.LOAD_WORKERS', 0):
+            expected = chef._load_extended_node_data(nodes)
+        self.assertEqual(len(expected), TOTAL_NODES)
+        with patch('kitchen.backends.lchef.LOAD_WORKERS', 4):
+            self.assertEqual(chef._load_extended_node_data(nodes), expected)
+            with patch('kitchen.backends.lchef.LOAD_WITH_PROCESSES', True):
+                self.assertEqual(chef._load_extended_node_data(nodes),
+                                 expected)
+
 
 class TestData(TestCase):
 
@@ -59,11 +103,23 @@ class TestData(TestCase):
         self.assertEqual(data[1]['name'], "testnode2")
 
     def test_data_loader_json_error(self):
-        """Should raise RepoError when LittleChef raises SystemExit"""
-        with patch('kitchen.backends.lchef.lib.get_nodes') as mock_method:
-            mock_method.side_effect = SystemExit()
+        """Should raise RepoError when a file has a JSON syntax error"""
+        with patch.object(json, 'loads') as mock_method:
+            mock_method.side_effect = json.decoder.JSONDecodeError(
+                "JSON syntax error", "", 10)
             self.assertRaises(chef.RepoError, chef._data_loader, 'nodes')
 
+    def test_data_loader_roles(self):
+        """Should return roles with their full name when loading roles"""
+        data = chef._data_loader('roles')
+        self.assertEqual([role['fullname'] for role in data],
+                         ['dbserver', 'loadbalancer', 'webserver', 'worker'])
+
+    def test_data_loader_node_not_found(self):
+        """Should return None when the node file does not exist"""
+        self.assertEqual(chef._data_loader('node', 'node_does_not_exist'),
+                         None)
+
     def test_load_data_nodes(self):
         """Should return nodes when the given argument is 'nodes'"""
         data = chef._load_data('nodes')
@@ -191,6 +247,1027 @@ class TestData(TestCase):
             expected_vms.remove(fqdn)
 
 
+class TestNodeDataBag(TestCase):
+
+    def _read_item(self, name):
+        filename = name.replace('.', '_') + '.json'
+        with open(os.path.join(chef.DATA_BAG_PATH, filename), 'r') as f:
+            item = json.loads(f.read())
+        for key in ['role', 'roles', 'recipes']:
+            item[key] = sorted(item[key])
+        return item
+
+    def test_build_node_data_bag_items(self):
+        """Should build the same data bag items as a full build"""
+        names = ['testnode2', 'testnode3.mydomain.com', 'testnode8']
+        expected = [self._read_item(name) for name in names]
+        for name in names:
+            os.remove(os.path.join(chef.DATA_BAG_PATH,
+                                   name.replace('.', '_') + '.json'))
+        chef.build_node_data_bag(names)
+        self.assertEqual([self._read_item(name) for name in names], expected)
+
+    def test_build_node_data_bag_removed_node(self):
+        """Should remove the data bag item of a node that no longer exists"""
+        filepath = os.path.join(chef.DATA_BAG_PATH, 'removed_node.json')
+        with open(filepath, 'w') as f:
+            f.write('{"name": "removed_node"}')
+        chef.build_node_data_bag(['removed_node'])
+        self.assertFalse(os.path.exists(filepath))
+
+    def test_get_changed_nodes(self):
+        """Should return the nodes affected by the changed files"""
+        paths = ['nodes/testnode1.json', 'nodes/testnode3.mydomain.com.json',
+                 'cookbooks/apache2/templates/default/site.erb', 'README.md']
+        self.assertEqual(chef.get_changed_nodes(paths),
+                         set(['testnode1', 'testnode3.mydomain.com']))
+
+    def test_get_changed_nodes_full_rebuild(self):
+        """Should return None when roles or cookbook metadata changed"""
+        changes = [['roles/webserver.json'],
+                   ['environments/production.json'],
+                   ['cookbooks/mysql/metadata.rb'],
+                   ['site-cookbooks/mysql/recipes/server.rb']]
+        for paths in changes:
+            self.assertEqual(
+                chef.get_changed_nodes(['nodes/testnode1.json'] + paths), None)
+
+    @patch('kitchen.backends.lchef.REPO', dict(REPO, KITCHEN_SUBDIR='kitchen'))
+    def test_get_changed_nodes_kitchen_subdir(self):
+        """Should only consider files inside the kitchen subdir"""
+        paths = ['kitchen/nodes/testnode1.json', 'roles/webserver.json']
+        self.assertEqual(chef.get_changed_nodes(paths), set(['testnode1']))
+
+    @patch('kitchen.backends.repo_sync.chef.build_node_data_bag')
+    def test_sync_rebuilds_changed_nodes(self, build):
+        """Should only rebuild the data bag items of changed nodes"""
+        sync = SyncRepo()
+        with patch.object(sync, '_get_head', return_value='new'):
+            with patch.object(sync, '_get_changed_files',
+                              return_value=['nodes/testnode2.json']):
+                sync._update_node_data_bag('old')
+                build.assert_called_once_with(['testnode2'])
+                build.reset_mock()
+                sync._update_node_data_bag('new')
+                self.assertFalse(build.called)
+            with patch.object(sync, '_get_changed_files',
+                              return_value=['roles/webserver.json']):
+                sync._update_node_data_bag('old')
+                build.assert_called_once_with()
+
+
+class TestConcurrentLoading(TestCase):
+
+    def test_loaders_from_many_threads(self):
+        """Should load the same data from concurrent threads, even when the
+        current working directory changes meanwhile
+
+        """
+        expected_nodes = chef._load_data('nodes')
+        expected_roles = chef._load_data('roles')
+        expected_extended = chef._load_extended_node_data(expected_nodes)
+        errors = []
+        stop = threading.Event()
+
+        def load():
+            try:
+                for i in range(20):
+                    nodes = chef._load_data('nodes')
+                    self.assertEqual(nodes, expected_nodes)
+                    self.assertEqual(chef._load_data('roles'), expected_roles)
+                    self.assertEqual(chef._load_extended_node_data(nodes),
+                                     expected_extended)
+            except Exception as e:
+                errors.append(e)
+
+        def change_dir():
+            current_dir = os.getcwd()
+            try:
+                while not stop.is_set():
+                    os.chdir(tempfile.gettempdir())
+                    os.chdir(current_dir)
+            finally:
+                os.chdir(current_dir)
+
+        chdir_thread = threading.Thread(target=change_dir)
+        chdir_thread.start()
+        threads = [threading.Thread(target=load) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stop.set()
+        chdir_thread.join()
+        self.assertEqual(errors, [])
+
+
+class TestSnapshot(TestCase):
+
+    def setUp(self):
+        fd, self.syncdate_file = tempfile.mkstemp()
+        os.close(fd)
+        self.patcher = patch('kitchen.backends.lchef.SYNCDATE_FILE',
+                             self.syncdate_file)
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+        os.remove(self.syncdate_file)
+
+    def test_snapshot_is_reused(self):
+        """Should reuse the snapshot while the sync generation is the same"""
+        snapshot = chef.get_snapshot()
+        self.assertTrue(chef.get_snapshot() is snapshot)
+        self.assertEqual(len(snapshot.nodes), TOTAL_NODES)
+        self.assertEqual(len(snapshot.nodes_extended), TOTAL_NODES)
+        self.assertEqual(len(snapshot.roles), 4)
+        self.assertEqual(snapshot.role_groups,
+                         ['dbserver', 'loadbalancer', 'webserver', 'worker'])
+        self.assertEqual(len(snapshot.environments), 3)
+
+    def test_snapshot_rebuilt_after_sync(self):
+        """Should rebuild the snapshot when the repo sync date changes"""
+        snapshot = chef.get_snapshot()
+        sync_date = os.stat(self.syncdate_file).st_mtime
+        os.utime(self.syncdate_file, (sync_date + 60, sync_date + 60))
+        new_snapshot = chef.get_snapshot()
+        self.assertFalse(new_snapshot is snapshot)
+        self.assertNotEqual(new_snapshot.generation, snapshot.generation)
+
+    def test_snapshot_rebuilt_after_head_change(self):
+        """Should rebuild the snapshot when the git HEAD changes"""
+        with patch('kitchen.backends.lchef._get_repo_head',
+                   return_value='a' * 40):
+            snapshot = chef.get_snapshot()
+        with patch('kitchen.backends.lchef._get_repo_head',
+                   return_value='b' * 40):
+            self.assertFalse(chef.get_snapshot() is snapshot)
+
+    def test_snapshot_not_modified_by_callers(self):
+        """Should not change snapshot data when returned data is modified"""
+        nodes = chef.get_nodes_extended()
+        nodes[0]['name'] = 'modified'
+        nodes[0].setdefault('kitchen', {}).setdefault('data', {})
+        nodes[0]['kitchen']['data'].setdefault('links', []).append({})
+        nodes.append({'name': 'extra_node'})
+        snapshot = chef.get_snapshot()
+        self.assertEqual(len(snapshot.nodes_extended), TOTAL_NODES)
+        self.assertEqual(snapshot.nodes_extended[0]['name'], 'testnode1')
+        self.assertEqual(chef.get_nodes_extended()[0]['kitchen']['data'],
+                         snapshot.nodes_extended[0]['kitchen']['data'])
+
+    def test_get_node_not_found(self):
+        """Should return None when the node does not exist"""
+        self.assertEqual(chef.get_node('node_does_not_exist'), None)
+        self.assertEqual(chef.get_node_extended('node_does_not_exist'), None)
+
+    def test_get_nodes_extended_fields(self):
+        """Should only return the given attributes when fields are given"""
+        data = chef.get_nodes_extended(fields=['name', 'virtualization/role'])
+        self.assertEqual(len(data), TOTAL_NODES)
+        self.assertEqual(data[4], {'name': 'testnode5',
+                                   'virtualization': {'role': 'host'}})
+        self.assertEqual(data[0], {'name': 'testnode1'})
+
+
+class TestSnapshotFile(TestCase):
+
+    def setUp(self):
+        self.snapshot_dir = tempfile.mkdtemp()
+        self.patcher = patch('kitchen.backends.lchef.SNAPSHOT_DIR',
+                             self.snapshot_dir)
+        self.patcher.start()
+        chef._snapshot = None
+
+    def tearDown(self):
+        self.patcher.stop()
+        shutil.rmtree(self.snapshot_dir)
+        chef._snapshot = None
+
+    def test_load_written_snapshot(self):
+        """Should load the snapshot written by the sync instead of the repo"""
+        written = chef.write_snapshot()
+        self.assertEqual(
+            os.listdir(self.snapshot_dir),
+            ['snapshot-v{0}.pickle'.format(chef.SNAPSHOT_VERSION)])
+        with patch('kitchen.backends.lchef._build_snapshot') as build:
+            snapshot = chef.get_snapshot()
+            self.assertFalse(build.called)
+        self.assertEqual(snapshot.generation, written.generation)
+        self.assertEqual(snapshot.nodes, written.nodes)
+        self.assertEqual(snapshot.roles, written.roles)
+        self.assertEqual(
+            [node.to_dict() for node in snapshot.nodes_extended],
+            [node.to_dict() for node in written.nodes_extended])
+        self.assertEqual(snapshot.nodes_extended[3].get('tags', []), [])
+        self.assertEqual(snapshot.filter_nodes('staging')[0]['name'],
+                         'testnode4')
+
+    def test_rerun_plugins_of_saved_snapshot(self):
+        """Should rerun static plugins when others were enabled by the sync"""
+        with patch.dict(chef.plugins, {}, clear=True):
+            chef.write_snapshot()
+        with patch.dict(chef.plugins, {'counter': CountingPlugin()},
+                        clear=True):
+            snapshot = chef.get_snapshot()
+        self.assertEqual(snapshot.plugin_names, ['counter'])
+        nodes = [{'name': 'testnode2'}]
+        snapshot.inject_plugin_data(nodes)
+        self.assertEqual(nodes[0]['kitchen']['data']['links'][0]['title'],
+                         'counter')
+
+    def test_static_plugin_stats_saved(self):
+        """Should keep the stats of the static plugins run by the sync"""
+        plugin_stats.reset_stats()
+        with patch.dict(chef.plugins, {'counter': CountingPlugin()},
+                        clear=True):
+            chef.write_snapshot()
+            plugin_stats.reset_stats()
+            snapshot = chef.get_snapshot()
+        self.assertEqual(plugin_stats.get_all_stats(), {})
+        self.assertEqual(snapshot.plugin_stats.keys(), ['counter'])
+        self.assertEqual(snapshot.plugin_stats['counter']['calls'], 2)
+        self.assertTrue(snapshot.plugin_stats['counter']['enabled'])
+
+    def test_keep_generation_during_sync(self):
+        """Should keep the previous generation until the sync has saved the
+        snapshot of the new one
+
+        """
+        before = chef.get_generation()
+        chef.start_sync()
+        with patch('kitchen.backends.lchef._get_repo_head',
+                   return_value='a' * 40):
+            self.assertEqual(chef.get_generation(), before)
+            written = chef.write_snapshot()
+            self.assertNotEqual(written.generation, before)
+            chef.finish_sync()
+            self.assertEqual(chef.get_generation(), written.generation)
+            self.assertEqual(chef.get_sync_date(),
+                             chef._get_repo_sync_date())
+            with patch('kitchen.backends.lchef._build_snapshot') as build:
+                self.assertEqual(chef.get_snapshot().generation,
+                                 written.generation)
+                self.assertFalse(build.called)
+
+    def test_ignore_stale_sync_marker(self):
+        """Should ignore the mark of a sync which died"""
+        chef.start_sync()
+        with patch('kitchen.backends.lchef.SYNC_MAX_DURATION', -1):
+            with patch('kitchen.backends.lchef._get_repo_head',
+                       return_value='a' * 40):
+                self.assertEqual(chef.get_generation(),
+                                 chef._get_repo_generation())
+        chef.finish_sync()
+
+    def test_ignore_other_generation(self):
+        """Should build the snapshot when the saved one is outdated"""
+        chef.write_snapshot()
+        with patch('kitchen.backends.lchef._get_repo_head',
+                   return_value='a' * 40):
+            snapshot = chef.get_snapshot()
+        self.assertEqual(len(snapshot.nodes), TOTAL_NODES)
+        self.assertEqual(chef._read_snapshot(snapshot.generation), None)
+
+    def test_ignore_snapshot_writable_by_others(self):
+        """Should not unpickle a snapshot other users could have replaced"""
+        chef.write_snapshot()
+        generation = chef.get_generation()
+        self.assertNotEqual(chef._read_snapshot(generation), None)
+        os.chmod(chef._get_snapshot_path(), 0666)
+        self.assertEqual(chef._read_snapshot(generation), None)
+        os.chmod(chef._get_snapshot_path(), 0644)
+        os.chmod(self.snapshot_dir, 0777)
+        self.assertEqual(chef._read_snapshot(generation), None)
+
+    def test_ignore_other_format(self):
+        """Should ignore a saved snapshot with another format version"""
+        chef.write_snapshot()
+        path = chef._get_snapshot_path()
+        with open(path, 'rb') as f:
+            data = f.read()
+        with open(path, 'wb') as f:
+            f.write(data.replace(chef.SNAPSHOT_HEADER, "kitchen-snapshot 0\n"))
+        self.assertEqual(chef._read_snapshot(chef.get_generation()), None)
+        self.assertEqual(len(chef.get_snapshot().nodes), TOTAL_NODES)
+
+
+class FakeSnapshot(object):
+    """Snapshot holding only the records of the given nodes"""
+    def __init__(self, generation, nodes):
+        self.generation = generation
+        self.nodes_extended = build_records(
+            [(node, json.dumps(node)) for node in nodes])
+
+
+class TestChanges(TestCase):
+
+    def setUp(self):
+        self.snapshot_dir = tempfile.mkdtemp()
+        self.patchers = [
+            patch('kitchen.backends.lchef.SNAPSHOT_DIR', self.snapshot_dir),
+            patch('kitchen.backends.changes.SNAPSHOT_DIR', self.snapshot_dir)]
+        for patcher in self.patchers:
+            patcher.start()
+        self.nodes = [
+            {'name': 'node1', 'memory': {'total': '1024kB', 'free': '1kB'}},
+            {'name': 'node2', 'roles': ['webserver']},
+        ]
+        changes.record_changes(None, FakeSnapshot('gen1', self.nodes))
+
+    def tearDown(self):
+        for patcher in self.patchers:
+            patcher.stop()
+        shutil.rmtree(self.snapshot_dir)
+        chef._snapshot = None
+
+    def test_diff_snapshots(self):
+        """Should return added, removed and modified nodes with the changed
+        attribute paths
+
+        """
+        new_nodes = [
+            {'name': 'node1', 'memory': {'total': '2048kB', 'free': '1kB'},
+             'tags': ['WIP']},
+            {'name': 'node3'},
+        ]
+        diff = changes.diff_snapshots(FakeSnapshot('gen1', self.nodes),
+                                      FakeSnapshot('gen2', new_nodes))
+        self.assertEqual(diff, {'added': ['node3'], 'removed': ['node2'],
+                                'modified': {'node1': ['memory/total',
+                                                       'tags']}})
+
+    def test_get_changes(self):
+        """Should return the changes of each sync after a generation"""
+        self.assertEqual(changes.get_changes('gen1'), ('gen1', []))
+        nodes = self.nodes + [{'name': 'node3'}]
+        changes.record_changes(FakeSnapshot('gen1', self.nodes),
+                               FakeSnapshot('gen2', nodes))
+        changes.record_changes(FakeSnapshot('gen2', nodes),
+                               FakeSnapshot('gen3', nodes[1:]))
+        generation, entries = changes.get_changes('gen1')
+        self.assertEqual(generation, 'gen3')
+        self.assertEqual([(entry['added'], entry['removed'])
+                          for entry in entries],
+                         [(['node3'], []), ([], ['node1'])])
+        self.assertEqual(len(changes.get_changes('gen2')[1]), 1)
+        self.assertEqual(changes.get_changes('gen3'), ('gen3', []))
+        self.assertEqual(changes.get_changes('unknown'), None)
+
+    def test_retention(self):
+        """Should drop the oldest changes when there are too many"""
+        with patch('kitchen.backends.changes.CHANGES_MAX_ENTRIES', 2):
+            for i in range(1, 4):
+                changes.record_changes(
+                    FakeSnapshot('gen{0}'.format(i), self.nodes),
+                    FakeSnapshot('gen{0}'.format(i + 1), self.nodes))
+        self.assertEqual(changes.get_changes('gen1'), None)
+        self.assertEqual(len(changes.get_changes('gen2')[1]), 2)
+        with patch('kitchen.backends.changes.CHANGES_MAX_SIZE', 10):
+            changes.record_changes(FakeSnapshot('gen4', self.nodes),
+                                   FakeSnapshot('gen5', self.nodes))
+        self.assertEqual(changes.get_changes('gen4'), None)
+        self.assertEqual(changes.get_changes('gen5'), ('gen5', []))
+
+    def test_start_over_on_missing_sync(self):
+        """Should start the log over when a sync was not recorded"""
+        changes.record_changes(FakeSnapshot('other', self.nodes),
+                               FakeSnapshot('gen2', self.nodes))
+        self.assertEqual(changes.get_changes('gen1'), None)
+        self.assertEqual(changes.get_changes('gen2'), ('gen2', []))
+
+    def test_sync_records_changes(self):
+        """Should record the changes when the repo sync writes a snapshot"""
+        sync = SyncRepo()
+        sync._write_snapshot()
+        first = chef.read_saved_snapshot().generation
+        self.assertEqual(changes.get_changes(first), (first, []))
+        with patch('kitchen.backends.lchef._get_repo_head',
+                   return_value='a' * 40):
+            sync._write_snapshot()
+        generation, entries = changes.get_changes(first)
+        self.assertNotEqual(generation, first)
+        self.assertEqual(entries[0]['previous'], first)
+        self.assertEqual(entries[0]['modified'], {})
+
+
+class TestNodeIndex(TestCase):
+
+    def _generate_nodes(self, total):
+        rand = random.Random(42)
+        nodes = []
+        for i in range(total):
+            node = {'name': 'node{0}'.format(i),
+                    'roles': rand.sample(
+                        ['webserver', 'dbserver', 'dbserver_slave', 'worker',
+                         'env_production', 'loadbalancer'],
+                        rand.randint(0, 3))}
+            env = rand.choice(['production', 'staging', None])
+            if env:
+                node['chef_environment'] = env
+            virt_role = rand.choice(['host', 'guest', '', None, 'missing'])
+            if virt_role != 'missing':
+                node['virtualization'] = {'role': virt_role}
+            nodes.append(node)
+        return nodes
+
+    def test_filter_same_as_filter_nodes(self):
+        """Should return the same nodes as filter_nodes() for all filters"""
+        nodes = self._generate_nodes(300)
+        index = NodeIndex(nodes)
+        for env in ['', 'production', 'staging', 'none', 'testing']:
+            for roles in ['', 'webserver', 'dbserver,worker', 'env', 'bad']:
+                for virt in ['', 'host', 'guest', 'host,guest', 'bad']:
+                    self.assertEqual(
+                        index.filter(env, roles, virt),
+                        chef.filter_nodes(nodes, env, roles, virt),
+                        "Filters: {0}, {1}, {2}".format(env, roles, virt))
+
+    def test_snapshot_filter_nodes(self):
+        """Should filter the snapshot nodes using its index"""
+        snapshot = chef.get_snapshot()
+        data = snapshot.filter_nodes('production', 'loadbalancer,webserver',
+                                     'guest')
+        self.assertEqual([node['name'] for node in data],
+                         ['testnode1', 'testnode2', 'testnode7'])
+        data = snapshot.filter_nodes('staging', extended=False)
+        self.assertEqual(data, [snapshot.nodes[3]])
+        self.assertTrue('role' not in data[0])
+
+    def test_index_keys(self):
+        """Should index nodes by role, tag and virtualization role"""
+        index = chef.get_snapshot().index
+        self.assertEqual(index.by_role['dbserver'], set([2, 4]))
+        self.assertEqual(index.by_tag['WIP'], set([6]))
+        self.assertEqual(index.by_virt['host'], set([4, 8]))
+
+    def test_find(self):
+        """Should find nodes by name, fqdn or unique hostname"""
+        index = chef.get_snapshot().index
+        self.assertEqual(index.find_id('testnode1'), 0)
+        self.assertEqual(index.find('testnode3.mydomain.com')['name'],
+                         'testnode3.mydomain.com')
+        self.assertEqual(index.find('testnode3')['name'],
+                         'testnode3.mydomain.com')
+        self.assertEqual(index.find('node_does_not_exist'), None)
+
+    def test_find_ambiguous_hostname(self):
+        """Should not find a node by a hostname shared by several nodes"""
+        index = NodeIndex([
+            {'name': 'web1.a.com', 'fqdn': 'web1.a.com', 'hostname': 'web1'},
+            {'name': 'web1.b.com', 'fqdn': 'web1.b.com', 'hostname': 'web1'},
+        ])
+        self.assertEqual(index.find_id('web1'), None)
+        self.assertEqual(index.find_id('web1.b.com'), 1)
+
+    def test_filter_tags_and_query(self):
+        """Should filter nodes by any of the tags and all query words"""
+        index = NodeIndex([
+            {'name': 'web1', 'ipaddress': '10.0.0.1', 'tags': ['WIP'],
+             'roles': ['webserver']},
+            {'name': 'web2', 'ipaddress': '10.0.1.1', 'tags': ['new'],
+             'roles': ['webserver']},
+            {'name': 'db1', 'ipaddress': '10.0.0.2', 'roles': ['dbserver'],
+             'chef_environment': 'production'},
+        ])
+        self.assertEqual(index.filter_ids(tags='WIP,new'), [0, 1])
+        self.assertEqual(index.filter_ids(tags='bad'), [])
+        self.assertEqual(index.filter_ids(query='10.0.0'), [0, 2])
+        self.assertEqual(index.filter_ids(query='WEB 10.0.1'), [1])
+        self.assertEqual(index.filter_ids(query='prod'), [2])
+        self.assertEqual(index.filter_ids(roles='webserver', query='wip'),
+                         [0])
+
+    def test_get_facets(self):
+        """Should count the given nodes per facet"""
+        index = chef.get_snapshot().index
+        facets = index.get_facets(index.filter_ids(env='production'))
+        self.assertEqual(facets['environments'], {'production': 7})
+        self.assertEqual(facets['virt_roles'], {'host': 2, 'guest': 5})
+        self.assertEqual(facets['tags']['WIP'], 1)
+        self.assertEqual(facets['role_groups']['dbserver'], 2)
+        facets = index.get_facets([])
+        self.assertEqual(facets['environments'], {})
+
+    def test_page_ids(self):
+        """Should return the same pages as sorting and slicing all ids"""
+        nodes = self._generate_nodes(100)
+        for i, node in enumerate(nodes):
+            if i % 7:
+                node['ipaddress'] = '10.0.{0}.{1}'.format(i % 3, 100 - i)
+        index = NodeIndex(nodes)
+        for env in ['', 'production']:
+            ids = index.filter_ids(env)
+            for sort in [None, 'name', '-name', 'ipaddress', '-ipaddress',
+                         'chef_environment']:
+                field = sort.lstrip('-') if sort else None
+                expected = sorted(
+                    ids, reverse=bool(sort) and sort.startswith('-'),
+                    key=lambda i: index.ranks[field][i] if field else i)
+                for offset, limit in [(0, None), (0, 10), (95, 10),
+                                      (30, 0), (200, 10)]:
+                    end = None if limit is None else offset + limit
+                    self.assertEqual(
+                        index.page_ids(ids, sort, offset, limit),
+                        expected[offset:end],
+                        "{0} {1} {2} {3}".format(env, sort, offset, limit))
+
+    def test_page_ids_sort_order(self):
+        """Should sort IP addresses numerically and missing values first"""
+        index = NodeIndex([{'name': 'a', 'ipaddress': '10.0.0.10'},
+                           {'name': 'b', 'ipaddress': '10.0.0.9'},
+                           {'name': 'c'}])
+        self.assertEqual(index.page_ids(xrange(3), 'ipaddress'), [2, 1, 0])
+        self.assertEqual(index.page_ids(xrange(3), '-name', 0, 2), [2, 1])
+        self.assertRaises(ValueError, index.page_ids, xrange(3), 'memory')
+
+    def test_snapshot_page_nodes(self):
+        """Should return a page of the filtered nodes and their count"""
+        snapshot = chef.get_snapshot()
+        data, total = snapshot.page_nodes('production', sort='-name',
+                                          offset=1, limit=2)
+        self.assertEqual(total, 7)
+        self.assertEqual([node['name'] for node in data],
+                         ['testnode8', 'testnode7'])
+
+    def _get_node_list(self, built):
+        """Returns a NodeList of the snapshot nodes which adds the names of
+        the nodes it builds to built
+
+        """
+        def build(records):
+            built.extend(record['name'] for record in records)
+            return [record.to_dict() for record in records]
+        snapshot = chef.get_snapshot()
+        return NodeList(snapshot.index, snapshot.nodes_extended, build)
+
+    def test_node_list(self):
+        """Should be a list of the nodes which finds them through the index
+        """
+        built = []
+        nodes = self._get_node_list(built)
+        self.assertEqual(len(nodes), 9)
+        self.assertEqual(nodes.find('testnode2')['fqdn'], 'testnode2')
+        self.assertTrue(nodes.find('testnode2') is nodes[1])
+        self.assertEqual(nodes.find('node_does_not_exist'), None)
+        self.assertEqual([node['name'] for node in nodes[0:2]],
+                         ['testnode1', 'testnode2'])
+        self.assertEqual(nodes[-1]['name'], 'testnode9')
+        self.assertRaises(IndexError, lambda: nodes[9])
+        self.assertEqual(built, ['testnode2', 'testnode1', 'testnode9'])
+        self.assertEqual(len(nodes + []), 9)
+        self.assertEqual(len([] + nodes), 9)
+        self.assertEqual(json.loads(json.dumps(nodes))[1]['name'],
+                         'testnode2')
+        self.assertEqual(sorted(built), sorted(set(built)))
+        self.assertEqual(plugins.find_node(nodes, 'testnode5')['name'],
+                         'testnode5')
+        self.assertEqual(
+            plugins.find_node([{'fqdn': 'testnode5'}], 'testnode5'),
+            {'fqdn': 'testnode5'})
+
+    def test_node_list_modified(self):
+        """Should build all nodes before the list is modified"""
+        built = []
+        nodes = self._get_node_list(built)
+        first = nodes[0]
+        nodes.append({'name': 'extra'})
+        self.assertEqual(len(built), 9)
+        self.assertEqual(len(nodes), 10)
+        self.assertTrue(nodes[0] is first)
+        self.assertEqual(nodes.find('testnode9')['name'], 'testnode9')
+        self.assertEqual(nodes.pop()['name'], 'extra')
+        self.assertEqual([node['name'] for node in nodes], built)
+
+
+class TestNodeRecord(TestCase):
+
+    def setUp(self):
+        self.node = {
+            'name': 'testnode', 'fqdn': 'testnode', 'roles': [u'webserver'],
+            'chef_environment': u'production', 'ipaddress': '1.1.1.1',
+            'memory': {'total': '2048000kB', 'free': '1024000kB'},
+            'cpu': {'total': 2, '0': {'flags': ['fpu']}},
+            'kitchen': {'data': {'links': []}},
+            'apache2': {'client_roles': ['loadbalancer']},
+        }
+        self.record = NodeRecord(self.node, json.dumps(self.node))
+
+    def test_mapping(self):
+        """Should give access to all node attributes"""
+        self.assertEqual(self.record['name'], 'testnode')
+        self.assertEqual(self.record['apache2'],
+                         {'client_roles': ['loadbalancer']})
+        self.assertEqual(self.record.get('tags', []), [])
+        self.assertRaises(KeyError, lambda: self.record['tags'])
+        self.assertTrue('apache2' in self.record)
+        self.assertFalse('tags' in self.record)
+        self.assertEqual(sorted(self.record.keys()), sorted(self.node.keys()))
+        self.assertEqual(self.record.to_dict(), self.node)
+
+    def test_project(self):
+        """Should return only the given attribute paths"""
+        fields = ['name', 'kitchen', 'memory/total', 'cpu/total', 'tags']
+        with patch.object(json, 'loads') as mock_method:
+            data = self.record.project(fields)
+            self.assertFalse(mock_method.called)
+        self.assertEqual(data, {'name': 'testnode', 'memory': {
+            'total': '2048000kB'}, 'cpu': {'total': 2},
+            'kitchen': {'data': {'links': []}}})
+        data['kitchen']['data']['links'].append({})
+        self.assertEqual(self.record['kitchen']['data']['links'], [])
+
+    def test_project_decoded_paths(self):
+        """Should return attribute paths not kept by the record"""
+        data = self.record.project(['name', 'memory/free', 'cpu/0/flags',
+                                    'apache2/client_roles', 'apache2/bad',
+                                    'cpu/total/bad'])
+        self.assertEqual(data, {'name': 'testnode',
+                                'memory': {'free': '1024000kB'},
+                                'cpu': {'0': {'flags': ['fpu']}},
+                                'apache2': {'client_roles': ['loadbalancer']}})
+        self.assertEqual(self.record.project(), self.node)
+
+    def test_shared_strings(self):
+        """Should share equal strings between records"""
+        other = dict(self.node, name='othernode',
+                     chef_environment=u''.join([u'produc', u'tion']))
+        records = build_records([(self.node, json.dumps(self.node)),
+                                 (other, json.dumps(other))])
+        self.assertTrue(records[0]['chef_environment'] is
+                        records[1]['chef_environment'])
+        self.assertTrue(records[0]['roles'][0] is records[1]['roles'][0])
+
+    def test_snapshot_records(self):
+        """Should keep records with the same data as the node data bag"""
+        nodes = chef._load_data("nodes")
+        snapshot = chef.get_snapshot()
+        self.assertEqual([node.to_dict() for node in snapshot.nodes_extended],
+                         chef._load_extended_node_data(nodes))
+        self.assertEqual(chef.filter_nodes(snapshot.nodes_extended, 'staging',
+                                           'webserver', 'guest')[0]['name'],
+                         'testnode4')
+
+
+class TestGroupNodesByHost(TestCase):
+
+    def test_group_by_hosts_does_not_modify_nodes(self):
+        """Should not modify the given nodes when grouping them by host"""
+        nodes = chef.get_nodes_extended()
+        expected = json.dumps(nodes)
+        data = chef.group_nodes_by_host(nodes, roles='webserver')
+        self.assertEqual(json.dumps(nodes), expected)
+        host = [node for node in nodes if node['name'] == 'testnode5'][0]
+        self.assertFalse(data[0] is host)
+        self.assertTrue('run_list' not in host['virtualization']['guests'][0])
+
+    def test_group_by_hosts_merges_guest_data(self):
+        """Should set guest attributes in the host's virtual machines"""
+        nodes = [
+            {'name': 'host1', 'fqdn': 'host1', 'roles': [],
+             'virtualization': {'role': 'host', 'guests': [
+                 {'fqdn': 'guest1', 'state': 'running'},
+                 {'fqdn': 'unknown'}]}},
+            {'name': 'guest1', 'fqdn': 'guest1', 'roles': ['worker_big'],
+             'virtualization': {'role': 'guest'}},
+        ]
+        data = chef.group_nodes_by_host(nodes, roles='worker')
+        self.assertEqual(len(data), 1)
+        vms = data[0]['virtualization']['guests']
+        self.assertEqual(len(vms), 1)
+        self.assertEqual(vms[0]['name'], 'guest1')
+        self.assertEqual(vms[0]['state'], 'running')
+        self.assertEqual(chef.group_nodes_by_host(nodes, roles='webserver'),
+                         [])
+
+
+class CountingPlugin(object):
+    """Fake plugin adding a link to nodes which counts its calls"""
+
+    def __init__(self, dynamic=False):
+        self.DYNAMIC = dynamic
+        self.calls = 0
+
+    def inject(self, node):
+        self.calls += 1
+        node.setdefault('kitchen', {})
+        node['kitchen'].setdefault('data', {})
+        node['kitchen']['data'].setdefault('links', [])
+        node['kitchen']['data']['links'].append(
+            {'url': "http://counter/{0}".format(node['fqdn']),
+             'title': 'counter'})
+        for guest in node.get('virtualization', {}).get('guests', []):
+            guest['kitchen'] = {'data': {'links': [
+                {'url': "http://counter/{0}/{1}".format(
+                    node['fqdn'], guest['fqdn']), 'title': 'counter'}]}}
+
+
+class BatchPlugin(object):
+    """Fake plugin with a batch hook which records its calls"""
+
+    def __init__(self):
+        self.batches = []
+
+    def inject(self, node):
+        raise AssertionError("inject() should not be called")
+
+    def inject_many(self, nodes):
+        self.batches.append([node['fqdn'] for node in nodes])
+        for node in nodes:
+            node['kitchen'] = {'data': {'links': [{'title': 'batch'}]}}
+
+
+class FailingPlugin(object):
+    """Fake plugin which always fails"""
+
+    def __init__(self):
+        self.calls = 0
+
+    def inject_many(self, nodes):
+        self.calls += 1
+        raise ValueError("Unreachable inventory")
+
+
+class SlowPlugin(object):
+    """Fake plugin adding a link after waiting for a given time"""
+
+    def __init__(self, title, delay):
+        self.title = title
+        self.delay = delay
+
+    def inject_many(self, nodes):
+        time.sleep(self.delay)
+        for node in nodes:
+            node['kitchen'] = {'data': {'links': [{'title': self.title}]}}
+
+
+class TestRunPlugins(TestCase):
+
+    def setUp(self):
+        plugin_stats.reset_stats()
+
+    def tearDown(self):
+        plugin_stats.reset_stats()
+
+    def _get_titles(self, node):
+        return [link['title'] for link in node['kitchen']['data']['links']]
+
+    def test_plugins_run_concurrently(self):
+        """Should take as long as the slowest plugin, not all of them"""
+        plugins_by_name = dict(
+            ('slow{0}'.format(i), SlowPlugin('slow{0}'.format(i), 0.2))
+            for i in range(3))
+        nodes = [{'fqdn': 'testnode1'}]
+        with patch.dict(chef.plugins, plugins_by_name, clear=True):
+            start = time.time()
+            chef.inject_plugin_data(nodes)
+            self.assertTrue(time.time() - start < 0.5)
+        self.assertEqual(sorted(self._get_titles(nodes[0])),
+                         ['slow0', 'slow1', 'slow2'])
+
+    def test_plugin_timeout(self):
+        """Should leave out the data of a plugin which times out"""
+        slow = SlowPlugin('slow', 0.5)
+        slow.TIMEOUT = 0.1
+        nodes = [{'fqdn': 'testnode1'}]
+        with patch.dict(chef.plugins, {'slow': slow,
+                                       'fast': SlowPlugin('fast', 0)},
+                        clear=True):
+            start = time.time()
+            chef.inject_plugin_data(nodes)
+            self.assertTrue(time.time() - start < 0.4)
+        self.assertEqual(self._get_titles(nodes[0]), ['fast'])
+        self.assertEqual(plugin_stats.get_all_stats()['slow']['errors'], 1)
+        # The timed out plugin doesn't change the node once it is done
+        time.sleep(0.5)
+        self.assertEqual(self._get_titles(nodes[0]), ['fast'])
+
+    def test_plugin_process(self):
+        """Should run plugins setting PROCESSES in a process"""
+        plugin = CountingPlugin()
+        plugin.PROCESSES = True
+        nodes = [{'fqdn': 'testnode5',
+                  'virtualization': {'guests': [{'fqdn': 'testnode7'}]}}]
+        with patch.dict(chef.plugins, {'counter': plugin}, clear=True):
+            chef.inject_plugin_data(nodes)
+        # The plugin was called in another process
+        self.assertEqual(plugin.calls, 0)
+        self.assertEqual(self._get_titles(nodes[0]), ['counter'])
+        guest = nodes[0]['virtualization']['guests'][0]
+        self.assertEqual(guest['kitchen']['data']['links'][0]['url'],
+                         'http://counter/testnode5/testnode7')
+
+    def test_plugin_process_timeout(self):
+        """Should terminate the process of a plugin which times out"""
+        slow = SlowPlugin('slow', 5)
+        slow.PROCESSES = True
+        slow.TIMEOUT = 0.2
+        nodes = [{'fqdn': 'testnode1'}]
+        with patch.dict(chef.plugins, {'slow': slow}, clear=True):
+            start = time.time()
+            chef.inject_plugin_data(nodes)
+            self.assertTrue(time.time() - start < 2)
+        self.assertFalse('kitchen' in nodes[0])
+
+
+class VersionPlugin(object):
+    """Fake cached plugin adding a link with the number of its calls"""
+    DYNAMIC = True
+
+    def __init__(self, ttl):
+        self.TTL = ttl
+        self.calls = 0
+        self.called = threading.Event()
+
+    def inject(self, node):
+        self.calls += 1
+        node['kitchen'] = {'data': {'links': [
+            {'title': 'version', 'url': str(self.calls)}]}}
+        self.called.set()
+
+
+class TestPluginCache(TestCase):
+
+    def setUp(self):
+        chef.plugin_cache.clear()
+
+    def tearDown(self):
+        chef.plugin_cache.clear()
+
+    def _get_versions(self, nodes):
+        return [node['kitchen']['data']['links'][0]['url'] for node in nodes]
+
+    def test_expiration(self):
+        """Should return entries as fresh, then stale, then not at all"""
+        cache = PluginCache()
+        cache.set('key', 'value', 10, now=1000)
+        self.assertEqual(cache.get('key', now=1009), ('value', True))
+        self.assertEqual(cache.get('key', now=1010), ('value', False))
+        self.assertEqual(cache.get('key', now=1020), None)
+        self.assertEqual((cache.hits, cache.stale_hits, cache.misses),
+                         (1, 1, 1))
+
+    def test_lru_eviction(self):
+        """Should drop the least recently used entries when full"""
+        cache = PluginCache(max_size=2)
+        cache.set('a', 1, 10)
+        cache.set('b', 2, 10)
+        cache.get('a')
+        cache.set('c', 3, 10)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), (1, True))
+
+    def test_refresh_once(self):
+        """Should not refresh keys which are being refreshed"""
+        cache = PluginCache()
+        self.assertEqual(cache.start_refresh(['a', 'b']), ['a', 'b'])
+        self.assertEqual(cache.start_refresh(['b', 'c']), ['c'])
+        cache.end_refresh(['b'])
+        self.assertEqual(cache.start_refresh(['b']), ['b'])
+
+    def test_cached_plugin(self):
+        """Should only run a plugin with a TTL for nodes not in the cache"""
+        plugin = VersionPlugin(ttl=60)
+        with patch.dict(chef.plugins, {'version': plugin}, clear=True):
+            nodes = [{'fqdn': 'testnode1'}, {'fqdn': 'testnode2'}]
+            chef.inject_plugin_data(nodes)
+            self.assertEqual(plugin.calls, 2)
+            nodes = [{'fqdn': 'testnode1'}, {'fqdn': 'testnode3'}]
+            chef.inject_plugin_data(nodes)
+        self.assertEqual(plugin.calls, 3)
+        self.assertEqual(self._get_versions(nodes), ['1', '3'])
+
+    def test_cache_nodes_not_failed(self):
+        """Should cache the output of the nodes inject() didn't fail for"""
+        plugin = VersionPlugin(ttl=60)
+        inject = plugin.inject
+
+        def failing_inject(node):
+            inject(node)
+            if node['fqdn'] == 'testnode9':
+                raise ValueError("No data for testnode9")
+        plugin.inject = failing_inject
+        with patch.dict(chef.plugins, {'version': plugin}, clear=True):
+            for i in range(3):
+                chef.inject_plugin_data(
+                    [{'fqdn': 'testnode1'}, {'fqdn': 'testnode9'}])
+        # Only the failed node is run again
+        self.assertEqual(plugin.calls, 4)
+        self.assertEqual(len(chef.plugin_cache), 1)
+
+    def test_uncached_plugin(self):
+        """Should run a plugin without a TTL every time"""
+        plugin = VersionPlugin(ttl=None)
+        with patch.dict(chef.plugins, {'version': plugin}, clear=True):
+            for i in range(2):
+                chef.inject_plugin_data([{'fqdn': 'testnode1'}])
+        self.assertEqual(plugin.calls, 2)
+        self.assertEqual(len(chef.plugin_cache), 0)
+
+    def test_stale_while_revalidate(self):
+        """Should use expired output while refreshing it in the background"""
+        plugin = VersionPlugin(ttl=0.1)
+        with patch.dict(chef.plugins, {'version': plugin}, clear=True):
+            chef.inject_plugin_data([{'fqdn': 'testnode1'}])
+            time.sleep(0.15)
+            plugin.called.clear()
+            nodes = [{'fqdn': 'testnode1'}]
+            chef.inject_plugin_data(nodes)
+            self.assertEqual(self._get_versions(nodes), ['1'])
+            self.assertTrue(plugin.called.wait(2))
+            for i in range(20):
+                nodes = [{'fqdn': 'testnode1'}]
+                chef.inject_plugin_data(nodes)
+                if self._get_versions(nodes) == ['2']:
+                    break
+                time.sleep(0.01)
+        self.assertEqual(self._get_versions(nodes), ['2'])
+        self.assertEqual(plugin.calls, 2)
+
+
+class TestPluginStats(TestCase):
+
+    def setUp(self):
+        plugin_stats.reset_stats()
+
+    def tearDown(self):
+        plugin_stats.reset_stats()
+
+    def test_record(self):
+        """Should count calls, errors and runs over budget"""
+        stats = plugin_stats.PluginStats('test', budget=0.5)
+        for duration in [0.1, 0.2, 0.3, 0.4, 0.6]:
+            stats.record(duration)
+        stats.record(0.1, error=True)
+        data = stats.to_dict()
+        self.assertEqual(data['calls'], 6)
+        self.assertEqual(data['errors'], 1)
+        self.assertEqual(data['over_budget'], 1)
+        self.assertAlmostEqual(data['total_time'], 1.7)
+        self.assertEqual(data['p50'], 0.2)
+        self.assertEqual(data['p99'], 0.6)
+        self.assertTrue(data['enabled'])
+
+    @patch('kitchen.backends.plugins.stats.PLUGIN_MAX_FAILURES', 2)
+    @patch('kitchen.backends.plugins.stats.PLUGIN_COOL_DOWN', 60)
+    def test_circuit_breaker(self):
+        """Should disable a plugin failing repeatedly for the cool-down"""
+        stats = plugin_stats.PluginStats('test', budget=0.5)
+        stats.record(0.6, now=1000)
+        stats.record(0.1, now=1000)
+        stats.record(0.1, error=True, now=1000)
+        self.assertTrue(stats.is_enabled(now=1000))
+        stats.record(0.7, now=1000)
+        self.assertFalse(stats.is_enabled(now=1059))
+        self.assertTrue(stats.is_enabled(now=1060))
+        # A failure right after the cool-down disables it again
+        stats.record(0.1, error=True, now=1060)
+        self.assertFalse(stats.is_enabled(now=1061))
+
+    def test_plugin_budget(self):
+        """Should use the plugin's own time budget when it has one"""
+        plugin = CountingPlugin()
+        plugin.TIME_BUDGET = 5
+        self.assertEqual(plugin_stats.get_stats('slow', plugin).budget, 5)
+        self.assertEqual(plugin_stats.get_stats('other').budget,
+                         plugin_stats.PLUGIN_TIME_BUDGET)
+
+    @patch('kitchen.backends.plugins.stats.PLUGIN_MAX_FAILURES', 2)
+    def test_inject_skips_disabled_plugins(self):
+        """Should stop running a plugin once it has been disabled"""
+        plugin = FailingPlugin()
+        counter = CountingPlugin()
+        with patch.dict(chef.plugins, {'failing': plugin, 'counter': counter},
+                        clear=True):
+            for i in range(4):
+                chef.inject_plugin_data([{'fqdn': 'testnode1'}])
+        self.assertEqual(plugin.calls, 2)
+        self.assertEqual(counter.calls, 4)
+        data = plugin_stats.get_all_stats()
+        self.assertEqual(data['failing']['errors'], 2)
+        self.assertFalse(data['failing']['enabled'])
+        self.assertEqual(data['counter']['calls'], 4)
+
+    @patch('kitchen.backends.plugins.stats.PLUGIN_MAX_FAILURES', 2)
+    def test_inject_node_errors_counted(self):
+        """Should count the nodes inject() fails on without disabling the
+        plugin for the others
+
+        """
+        with patch.dict(chef.plugins, {'counter': CountingPlugin()},
+                        clear=True):
+            for i in range(3):
+                nodes = [{'fqdn': 'testnode1'}, {}]
+                chef.inject_plugin_data(nodes)
+                self.assertEqual(
+                    len(nodes[0]['kitchen']['data']['links']), 1)
+        data = plugin_stats.get_all_stats()['counter']
+        self.assertEqual(data['errors'], 0)
+        self.assertEqual(data['node_errors'], 3)
+        self.assertTrue(data['enabled'])
+
+
 class TestPlugins(TestCase):
 
     @patch('kitchen.backends.plugins.loader.ENABLE_PLUGINS', ['bad_name'])
@@ -203,6 +1280,35 @@ class TestPlugins(TestCase):
         """Should load plugin when module exists"""
         self.assertEqual(len(loader.import_plugins()), 1)
 
+    @patch('kitchen.backends.plugins.loader.ENABLE_PLUGINS', ['views'])
+    def test_import_plugin_with_views_only(self):
+        """Should load a plugin defining neither inject() nor inject_many(),
+        but not run it
+
+        """
+        base_path = tempfile.mkdtemp()
+        try:
+            plugin_dir = os.path.join(base_path, "backends", "plugins")
+            os.makedirs(plugin_dir)
+            with open(os.path.join(plugin_dir, "views.py"), 'w') as f:
+                f.write("from kitchen.backends.plugins import is_view\n\n"
+                        "@is_view('list')\n"
+                        "def links(request, nodes):\n"
+                        "    return None\n")
+            with patch('kitchen.backends.plugins.loader.BASE_PATH',
+                       base_path):
+                imported = loader.import_plugins()
+        finally:
+            shutil.rmtree(base_path)
+        self.assertEqual(imported.keys(), ['views'])
+        self.assertTrue(imported['views'].links.__is_view__)
+        with patch.dict(chef.plugins, imported, clear=True):
+            self.assertEqual(chef.get_plugins(), [])
+            nodes = [{'fqdn': 'testnode1'}]
+            chef.inject_plugin_data(nodes)
+        self.assertEqual(nodes, [{'fqdn': 'testnode1'}])
+        self.assertFalse('views' in plugin_stats.get_all_stats())
+
     @patch('kitchen.backends.plugins.loader.ENABLE_PLUGINS', ['monitoring'])
     def test_inject_plugin_data(self):
         """Should add link data when plugin is applied"""
@@ -216,6 +1322,102 @@ class TestPlugins(TestCase):
         self.assertTrue('other' in node['kitchen']['data'])
         self.assertEqual(len(node['kitchen']['data']['links']), 2)
 
+    def test_static_plugins_run_once(self):
+        """Should run static plugins when the snapshot is built only"""
+        plugin = CountingPlugin()
+        with patch.dict(chef.plugins, {'counter': plugin}, clear=True):
+            snapshot = chef._build_snapshot('test')
+            calls = plugin.calls
+            self.assertTrue(calls > 0)
+            for i in range(2):
+                nodes = [record.project(['name', 'fqdn', 'kitchen'])
+                         for record in snapshot.filter_nodes()]
+                snapshot.inject_plugin_data(nodes)
+                chef.inject_plugin_data(nodes, dynamic=True)
+        self.assertEqual(plugin.calls, calls)
+        self.assertEqual(snapshot.plugin_names, ['counter'])
+        # Plugin links are added after the node's own ones
+        self.assertEqual(
+            [link['title'] for link in nodes[0]['kitchen']['data']['links']],
+            ['haproxy', 'api', 'counter'])
+        self.assertEqual(nodes[1]['kitchen']['data']['links'],
+                         [{'url': 'http://counter/testnode2',
+                           'title': 'counter'}])
+        # The snapshot records are left untouched
+        self.assertEqual(len(snapshot.nodes_extended[0]['kitchen']['data'][
+            'links']), 2)
+        self.assertFalse('kitchen' in snapshot.nodes_extended[1])
+
+    def test_static_plugins_by_host(self):
+        """Should add the plugin output of hosts and their guests"""
+        with patch.dict(chef.plugins, {'counter': CountingPlugin()},
+                        clear=True):
+            snapshot = chef._build_snapshot('test')
+        nodes = [record.project(['name', 'fqdn', 'roles', 'virtualization'])
+                 for record in snapshot.filter_nodes()]
+        hosts = chef.group_nodes_by_host(nodes)
+        snapshot.inject_plugin_data_by_host(hosts)
+        self.assertEqual(hosts[0]['name'], 'testnode5')
+        self.assertEqual(hosts[0]['kitchen']['data']['links'][0]['url'],
+                         'http://counter/testnode5')
+        guest = hosts[0]['virtualization']['guests'][0]
+        self.assertEqual(guest['kitchen']['data']['links'][0]['url'],
+                         'http://counter/testnode5/testnode7')
+
+    def test_dynamic_plugins_run_per_request(self):
+        """Should run dynamic plugins only when asked to"""
+        plugin = CountingPlugin(dynamic=True)
+        with patch.dict(chef.plugins, {'counter': plugin}, clear=True):
+            snapshot = chef._build_snapshot('test')
+            self.assertEqual(plugin.calls, 0)
+            self.assertEqual(snapshot.plugin_names, [])
+            nodes = [{'fqdn': 'testnode1'}]
+            chef.inject_plugin_data(nodes, dynamic=False)
+            self.assertEqual(plugin.calls, 0)
+            chef.inject_plugin_data(nodes, dynamic=True)
+        self.assertEqual(plugin.calls, 1)
+        self.assertEqual(len(nodes[0]['kitchen']['data']['links']), 1)
+
+    def test_inject_many(self):
+        """Should call inject_many() once with all nodes when defined"""
+        plugin = BatchPlugin()
+        nodes = [{'fqdn': 'testnode1'}, {'fqdn': 'testnode2'}]
+        with patch.dict(chef.plugins, {'batch': plugin}, clear=True):
+            chef.inject_plugin_data(nodes)
+        self.assertEqual(plugin.batches, [['testnode1', 'testnode2']])
+        self.assertEqual(nodes[1]['kitchen']['data']['links'],
+                         [{'title': 'batch'}])
+
+    def test_inject_many_from_inject(self):
+        """Should inject each node when the plugin has only inject()"""
+        plugin = CountingPlugin()
+        nodes = [{'fqdn': 'testnode1'}, {}, {'fqdn': 'testnode2'}]
+        self.assertEqual(loader.get_inject_many('counter', plugin)(nodes),
+                         [1])
+        self.assertEqual(plugin.calls, 3)
+        self.assertEqual(len(nodes[2]['kitchen']['data']['links']), 1)
+
+    def test_inject_many_error(self):
+        """Should go on with the other plugins when inject_many() fails"""
+        plugin = BatchPlugin()
+        plugin.inject_many = lambda nodes: {}['missing']
+        counter = CountingPlugin()
+        nodes = [{'fqdn': 'testnode1'}]
+        with patch.dict(chef.plugins, {'batch': plugin, 'counter': counter},
+                        clear=True):
+            chef.inject_plugin_data(nodes)
+        self.assertEqual(counter.calls, 1)
+
+    def test_plugins_loaded_on_first_use(self):
+        """Should only import the enabled plugins when first accessed"""
+        registry = plugins.PluginRegistry()
+        with patch('kitchen.backends.plugins.import_plugins',
+                   return_value={'monitoring': CountingPlugin()}) as imports:
+            self.assertFalse(imports.called)
+            self.assertTrue('monitoring' in registry)
+            self.assertEqual(registry.keys(), ['monitoring'])
+            self.assertEqual(imports.call_count, 1)
+
     @patch('kitchen.backends.plugins.loader.ENABLE_PLUGINS', ['monitoring'])
     def test_plugin_view(self):
         """Should load plugin when module exists"""
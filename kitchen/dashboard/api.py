@@ -1,14 +1,72 @@
 """Data API"""
 # -*- coding: utf-8 -*-
 import json
+import time
 
-from django.http import HttpResponse, Http404
+from django.http import (HttpResponse, HttpResponseBadRequest,
+                         HttpResponseGone, Http404)
+from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 
 from kitchen.backends import lchef as chef
+from kitchen.backends import changes
+from kitchen.backends.plugins import stats as plugin_stats
+from kitchen.backends.records import project
+from kitchen.dashboard.caching import (api_condition, cache_payload,
+                                       payload_cache)
+from kitchen.settings import SYNC_WAIT_TIMEOUT, SYNC_WAIT_INTERVAL
+
+
+# Bytes of JSON sent to the client at once by streamed responses
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def _stream_json_list(items):
+    """Yields the JSON array of the given items in chunks, serializing one
+    item at a time. The output is the same as json.dumps(list(items))
+
+    """
+    chunk = ['[']
+    size = 1
+    for i, item in enumerate(items):
+        data = json.dumps(item)
+        if i:
+            data = ', ' + data
+        chunk.append(data)
+        size += len(data)
+        if size >= STREAM_CHUNK_SIZE:
+            yield ''.join(chunk)
+            chunk = []
+            size = 0
+    chunk.append(']')
+    yield ''.join(chunk)
+
+
+def _get_int(request, name, default):
+    """Returns the non-negative integer value of a query parameter. Raises
+    ValueError for any other value
+
+    """
+    value = request.GET.get(name)
+    if value is None:
+        return default
+    if not value.isdigit():
+        raise ValueError("'{0}' must be a non-negative integer".format(name))
+    return int(value)
+
+
+def _get_filters(request):
+    """Returns the node filters given in the query string"""
+    return {'env': request.GET.get('env'),
+            'roles': request.GET.get('roles'),
+            'virt_roles': request.GET.get('virt'),
+            'tags': request.GET.get('tags'),
+            'query': request.GET.get('q')}
 
 
 @require_http_methods(["GET"])
+@api_condition
+@cache_payload
 def get_roles(request):
     """Returns all nodes in the repo"""
     data = chef.get_roles()
@@ -16,23 +74,182 @@ def get_roles(request):
 
 
 @require_http_methods(["GET"])
+@api_condition
+@cache_payload
 def get_nodes(request):
     """Returns node files. If 'extended' is given, the extended version is
-    returned
+    returned. Nodes can be filtered with 'env', 'roles', 'virt', 'tags' and
+    a free text query 'q'. They can be sorted with 'sort', paged with
+    'offset' and 'limit', and reduced to some attributes with 'fields'. The
+    number of nodes before paging is returned in the X-Total-Count header
 
     """
-    if request.GET.get('extended'):
-        data = chef.get_nodes_extended()
+    extended = bool(request.GET.get('extended'))
+    fields = request.GET.get('fields')
+    fields = fields.split(',') if fields else None
+    try:
+        offset = _get_int(request, 'offset', 0)
+        limit = _get_int(request, 'limit', None)
+        data, total = chef.get_snapshot().page_nodes(
+            sort=request.GET.get('sort'), offset=offset, limit=limit,
+            extended=extended, **_get_filters(request))
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    if extended:
+        data = (node.project(fields) for node in data)
+    elif fields:
+        data = (project(node, fields) for node in data)
+    response = HttpResponse(_stream_json_list(data),
+                            content_type="application/json")
+    response['X-Total-Count'] = str(total)
+    return response
+
+
+def _get_names(request):
+    """Returns the node names given in the 'names' query parameter, or in
+    the body of a POST request, either as a JSON list or a 'names' form
+    field. Raises ValueError when the body is not valid
+
+    """
+    if request.method == 'GET':
+        names = request.GET.get('names', '')
+    elif request.META.get('CONTENT_TYPE', '').startswith('application/json'):
+        names = json.loads(request.body)
+        if not isinstance(names, list) or not all(
+                isinstance(name, basestring) for name in names):
+            raise ValueError("The body must be a JSON list of node names")
+        return names
     else:
-        data = chef.get_nodes()
-    data = chef.filter_nodes(data, request.GET.get('env'))
+        names = request.POST.get('names', '')
+    return [name for name in names.split(',') if name]
+
+
+@csrf_exempt
+@require_http_methods(["GET", "POST"])
+def get_nodes_bulk(request):
+    """Returns the nodes with the given names in a single response, and the
+    names which were not found. If 'extended' is given, the extended
+    versions are returned
+
+    """
+    try:
+        names = _get_names(request)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    extended = bool(request.GET.get('extended'))
+    nodes, missing = chef.get_snapshot().find_nodes(names, extended)
+    if extended:
+        nodes = [node.to_dict() for node in nodes]
+    data = {'nodes': nodes, 'missing': missing}
     return HttpResponse(json.dumps(data), content_type="application/json")
 
 
 @require_http_methods(["GET"])
+@api_condition
+@cache_payload
 def get_node(request, name):
-    """Returns a node"""
-    data = chef.get_node(name)
+    """Returns a node. If 'extended' is given, the extended version is
+    returned
+
+    """
+    if request.GET.get('extended'):
+        data = chef.get_node_extended(name)
+    else:
+        data = chef.get_node(name)
     if not data:
         raise Http404()
     return HttpResponse(json.dumps(data), content_type="application/json")
+
+
+@require_http_methods(["GET"])
+@api_condition
+@cache_payload
+def get_facets(request):
+    """Returns the node counts per environment, role group, virtualization
+    role and tag of the nodes matching the filters of get_nodes
+
+    """
+    data = chef.get_snapshot().get_facets(**_get_filters(request))
+    return HttpResponse(json.dumps(data), content_type="application/json")
+
+
+@require_http_methods(["GET"])
+def get_changes(request):
+    """Returns the nodes added, removed and modified by each repo sync after
+    the generation given as 'since', and the latest generation. Responds
+    with GONE when those changes are no longer kept, in which case all
+    nodes need to be fetched again
+
+    """
+    since = request.GET.get('since')
+    if not since:
+        return HttpResponseBadRequest("'since' must be given")
+    result = changes.get_changes(since)
+    if result is None:
+        return HttpResponseGone(
+            "Changes since generation '{0}' are not available".format(since))
+    generation, entries = result
+    data = {'generation': generation, 'changes': entries}
+    return HttpResponse(json.dumps(data), content_type="application/json")
+
+
+def _count_changes(since, generation):
+    """Returns how many nodes the syncs after since added, removed and
+    modified, or None when the changes up to generation are not recorded
+
+    """
+    result = changes.get_changes(since)
+    if result is None or result[0] != generation:
+        return None
+    counts = {'added': 0, 'removed': 0, 'modified': 0}
+    for entry in result[1]:
+        for key in counts:
+            counts[key] += len(entry[key])
+    return counts
+
+
+@require_http_methods(["GET"])
+def wait_for_sync(request):
+    """Waits until the sync generation differs from 'generation', for up to
+    'timeout' seconds, and returns the current generation with the counts
+    of nodes changed since then when they are known. Returns at once when
+    no generation is given
+
+    """
+    since = request.GET.get('generation')
+    try:
+        timeout = min(_get_int(request, 'timeout', SYNC_WAIT_TIMEOUT),
+                      SYNC_WAIT_TIMEOUT)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    deadline = time.time() + timeout
+    generation = chef.get_generation()
+    while since and generation == since and time.time() < deadline:
+        time.sleep(min(SYNC_WAIT_INTERVAL, max(deadline - time.time(), 0)))
+        generation = chef.get_generation()
+    data = {'generation': generation,
+            'changed': bool(since) and generation != since}
+    if data['changed']:
+        data['changes'] = _count_changes(since, generation)
+    response = HttpResponse(json.dumps(data), content_type="application/json")
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+
+@require_http_methods(["GET"])
+def get_plugin_stats(request):
+    """Returns the run statistics of each plugin. Static plugins are run
+    when the snapshot is built, usually by the repo sync, so their
+    statistics are the ones saved with the snapshot
+
+    """
+    data = plugin_stats.get_all_stats()
+    data.update(chef.get_snapshot().plugin_stats)
+    return HttpResponse(json.dumps(data), content_type="application/json")
+
+
+@require_http_methods(["GET"])
+def get_cache_stats(request):
+    """Returns the hit and miss counts and the size of the API cache"""
+    data = payload_cache.get_stats()
+    return HttpResponse(json.dumps(data), content_type="application/json")
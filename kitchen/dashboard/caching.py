@@ -0,0 +1,354 @@
+"""HTTP caching of API and dashboard responses, which only change when the
+repo is synced
+
+"""
+import os
+import re
+import zlib
+import time
+import hashlib
+import tempfile
+import threading
+from collections import namedtuple, OrderedDict
+from datetime import datetime
+from functools import wraps
+from itertools import chain
+from urllib import urlencode
+
+from django.contrib.messages import get_messages, ERROR
+from django.http import HttpResponse
+from django.views.decorators.http import condition
+
+from kitchen.backends import lchef as chef
+from kitchen.settings import (SYNCDATE_FILE, REPO, API_CACHE_SIZE,
+                              API_CACHE_ENTRY_SIZE, PAGE_CACHE_SIZE)
+
+
+def get_sync_date():
+    """Returns the UTC date of the repo sync whose data is served, or None.
+    While a sync is in progress it is the date of the previous one
+
+    """
+    sync_date = chef.get_sync_date()
+    if sync_date is None:
+        return None
+    return datetime.utcfromtimestamp(sync_date)
+
+
+def normalize_query(request):
+    """Returns the query string of a request with its parameters sorted"""
+    return urlencode(sorted(
+        (key.encode('utf-8'), value.encode('utf-8'))
+        for key, values in request.GET.lists() for value in values))
+
+
+def _get_api_etag(request, *args, **kwargs):
+    """Returns the ETag of an API response. Responses only depend on the
+    sync generation, the requested path and its parameters. Gzip-compressed
+    responses get another ETag than plain ones
+
+    """
+    key = "{0}|{1}?{2}".format(chef.get_generation(),
+                               request.path.encode('utf-8'),
+                               normalize_query(request))
+    etag = hashlib.sha1(key).hexdigest()
+    if accepts_gzip(request):
+        etag += '-gz'
+    return etag
+
+
+def _get_api_last_modified(request, *args, **kwargs):
+    return get_sync_date()
+
+
+def _is_dashboard_cacheable(request):
+    """Dashboard pages can't be cached when they show messages from a
+    previous request or data of plugins run on every request
+
+    """
+    return not len(get_messages(request)) and not chef.get_plugins(True)
+
+
+def _get_sync_state():
+    """Returns whether the last repo sync is 'ok', 'late' or in 'error', as
+    dashboard pages warn about it
+
+    """
+    try:
+        sync_age = (time.time() - os.stat(SYNCDATE_FILE).st_mtime) / 60
+    except OSError:
+        return 'error'
+    return 'late' if sync_age > REPO['SYNC_PERIOD'] * 2.5 else 'ok'
+
+
+def _get_dashboard_etag(request, *args, **kwargs):
+    """Returns the ETag of a dashboard page. Pages warning about a late or
+    failed sync show its age, which changes over time, and have none
+
+    """
+    if not _is_dashboard_cacheable(request) or _get_sync_state() != 'ok':
+        return None
+    return _get_api_etag(request)
+
+
+def _get_dashboard_last_modified(request, *args, **kwargs):
+    if not _is_dashboard_cacheable(request) or _get_sync_state() != 'ok':
+        return None
+    return get_sync_date()
+
+
+# Decorators answering conditional requests with 304 Not Modified before
+# the view loads any data, and adding ETag and Last-Modified headers
+api_condition = condition(etag_func=_get_api_etag,
+                          last_modified_func=_get_api_last_modified)
+dashboard_condition = condition(
+    etag_func=_get_dashboard_etag,
+    last_modified_func=_get_dashboard_last_modified)
+
+
+class Payload(namedtuple('Payload', ['content_type', 'body', 'gzip_body',
+                                     'headers', 'files'])):
+    """Response body, plain and gzip-compressed, with the headers set by the
+    view and the (path, content) pairs of the files it wrote
+
+    """
+    __slots__ = ()
+
+    def __new__(cls, content_type, body, gzip_body, headers=(), files=()):
+        return super(Payload, cls).__new__(cls, content_type, body,
+                                           gzip_body, headers, files)
+
+    @property
+    def size(self):
+        return (len(self.body) + len(self.gzip_body) +
+                sum(len(content) for _, content in self.files))
+
+
+class PayloadCache(object):
+    """LRU cache of response bodies, plain and gzip-compressed, for a single
+    sync generation. Entries are dropped when another generation is stored,
+    and the least recently used ones when the bodies take more than
+    max_size bytes. Payloads larger than max_entry_size are not stored
+
+    """
+    def __init__(self, max_size, max_entry_size=None):
+        self.max_size = max_size
+        self.max_entry_size = (max_size if max_entry_size is None
+                               else max_entry_size)
+        self.entries = OrderedDict()
+        self.size = 0
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, generation, key):
+        """Returns the payload stored for key, or None"""
+        with self.lock:
+            if generation == self.generation and key in self.entries:
+                self.hits += 1
+                payload = self.entries.pop(key)
+                self.entries[key] = payload
+                return payload
+            self.misses += 1
+            return None
+
+    def set(self, generation, key, payload):
+        """Stores a payload for key, unless it is too large to be cached"""
+        size = payload.size
+        if size > min(self.max_size, self.max_entry_size):
+            return
+        with self.lock:
+            if generation != self.generation:
+                self.entries.clear()
+                self.size = 0
+                self.generation = generation
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = payload
+            self.size += size
+            while self.size > self.max_size:
+                self._remove(next(iter(self.entries)))
+
+    def _remove(self, key):
+        payload = self.entries.pop(key)
+        self.size -= payload.size
+
+    def clear(self):
+        """Drops all entries and resets the counters"""
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+            self.hits = self.misses = 0
+
+    def get_stats(self):
+        """Returns the counters of the cache as a dict"""
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': len(self.entries), 'size': self.size,
+                'max_size': self.max_size,
+                'max_entry_size': self.max_entry_size}
+
+
+payload_cache = PayloadCache(API_CACHE_SIZE, API_CACHE_ENTRY_SIZE)
+page_cache = PayloadCache(PAGE_CACHE_SIZE)
+
+
+def _gzip(data):
+    """Returns data compressed in gzip format"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def accepts_gzip(request):
+    """Returns whether the client accepts gzip-compressed responses"""
+    for coding in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        parts = coding.strip().split(';')
+        if parts[0].strip().lower() not in ('gzip', '*'):
+            continue
+        quality = re.match(r'\s*q\s*=\s*([\d.]+)', ';'.join(parts[1:]))
+        try:
+            if quality and float(quality.group(1)) == 0:
+                continue
+        except ValueError:
+            continue
+        return True
+    return False
+
+
+def payload_response(request, payload):
+    """Returns a response with the payload body, compressed when the client
+    accepts it
+
+    """
+    if accepts_gzip(request):
+        response = HttpResponse(payload.gzip_body,
+                                content_type=payload.content_type)
+        response['Content-Encoding'] = 'gzip'
+    else:
+        response = HttpResponse(payload.body,
+                                content_type=payload.content_type)
+    for header, value in payload.headers:
+        response[header] = value
+    response['Content-Length'] = len(response.content)
+    response['Vary'] = 'Accept-Encoding'
+    return response
+
+
+def cache_payload(view):
+    """Decorator serving API responses from the payload cache. Responses
+    larger than a cache entry are streamed as the view produces them, once
+    their first max_entry_size bytes have been buffered
+
+    """
+    @wraps(view)
+    def inner(request, *args, **kwargs):
+        generation = chef.get_generation()
+        key = (request.path, normalize_query(request))
+        payload = payload_cache.get(generation, key)
+        if payload is None:
+            response = view(request, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+            # Headers set by the view, like X-Total-Count, are kept
+            headers = tuple((header, value) for header, value
+                            in response.items() if header != 'Content-Type')
+            chunks = []
+            size = 0
+            body = iter(response)
+            for chunk in body:
+                chunks.append(chunk)
+                size += len(chunk)
+                if size > payload_cache.max_entry_size:
+                    streamed = HttpResponse(
+                        chain(chunks, body),
+                        content_type=response['Content-Type'])
+                    for header, value in headers:
+                        streamed[header] = value
+                    return streamed
+            body = ''.join(chunks)
+            payload = Payload(response['Content-Type'], body, _gzip(body),
+                              headers)
+            payload_cache.set(generation, key, payload)
+        return payload_response(request, payload)
+    return inner
+
+
+def _has_errors(request):
+    """Returns whether error messages were added while handling the request.
+    Rendered messages are moved from the queued to the loaded ones
+
+    """
+    storage = getattr(request, '_messages', None)
+    if storage is None:
+        return False
+    return any(message.level >= ERROR for message in
+               list(storage._loaded_messages) + storage._queued_messages)
+
+
+def _get_mtime(path):
+    """Returns the modified date of a file, or None when it doesn't exist"""
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def _read_file(path):
+    """Returns the content of a file, or None when it can't be read"""
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except IOError:
+        return None
+
+
+def _restore_file(path, content):
+    """Writes a file back unless it already has the given content"""
+    if _read_file(path) == content:
+        return
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as f:
+        f.write(content)
+    os.chmod(tmp_path, 0644)
+    os.rename(tmp_path, path)
+
+
+def cache_render(files=()):
+    """Decorator serving rendered dashboard pages from the page cache. Pages
+    are not cached when there are messages to show from a previous request,
+    dynamic plugins are enabled, the sync is late or failed, as pages then
+    show its age, or rendering them failed. The given files,
+    which the view writes and the page links to, are cached with the page
+    when it writes them, and written back when it is served
+
+    """
+    def decorator(view):
+        @wraps(view)
+        def inner(request, *args, **kwargs):
+            if (not _is_dashboard_cacheable(request) or
+                    _get_sync_state() != 'ok'):
+                return view(request, *args, **kwargs)
+            generation = chef.get_generation()
+            key = (view.__name__, normalize_query(request))
+            payload = page_cache.get(generation, key)
+            if payload is None:
+                mtimes = [_get_mtime(path) for path in files]
+                response = view(request, *args, **kwargs)
+                if response.status_code != 200 or _has_errors(request):
+                    return response
+                # Only the files written for this page are kept
+                contents = [(path, _read_file(path))
+                            for path, mtime in zip(files, mtimes)
+                            if _get_mtime(path) != mtime]
+                body = response.content
+                payload = Payload(
+                    response['Content-Type'], body, _gzip(body),
+                    files=tuple((path, content) for path, content in contents
+                                if content is not None))
+                page_cache.set(generation, key, payload)
+            else:
+                for path, content in payload.files:
+                    _restore_file(path, content)
+            return payload_response(request, payload)
+        return inner
+    return decorator
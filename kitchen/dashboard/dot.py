@@ -0,0 +1,110 @@
+"""pydot Dot class for the graphs module, which is imported on first use"""
+import os
+import subprocess
+import tempfile
+
+import pydot
+
+
+class KitchenDot(pydot.Dot):
+    """Inherits from the pydot library Dot class, and makes the subprocess as
+    an attribute for being killed from outside
+
+    """
+    def __init__(self, *argsl, **argsd):
+        super(KitchenDot, self).__init__(*argsl, **argsd)
+        self.p = None
+
+    def create(self, prog=None, format='ps'):
+        """Creates and returns a Postscript representation of the graph."""
+        if prog is None:
+            prog = self.prog
+
+        if isinstance(prog, (list, tuple)):
+            prog, args = prog[0], prog[1:]
+        else:
+            args = []
+
+        if self.progs is None:
+            self.progs = pydot.find_graphviz()
+            if self.progs is None:
+                raise pydot.InvocationException(
+                    'GraphViz\'s executables not found')
+
+        if not prog in self.progs:
+            raise pydot.InvocationException(
+                'GraphViz\'s executable "{0}" not found'.format(prog))
+
+        if (not os.path.exists(self.progs[prog])
+                or not os.path.isfile(self.progs[prog])):
+            raise pydot.InvocationException(
+                'GraphViz\'s executable "{0}" is not a file '
+                'or doesn\'t exist'.format(self.progs[prog]))
+
+        tmp_fd, tmp_name = tempfile.mkstemp()
+        os.close(tmp_fd)
+        self.write(tmp_name)
+        tmp_dir = os.path.dirname(tmp_name)
+
+        # For each of the image files...
+        for img in self.shape_files:
+            # Get its data
+            f = file(img, 'rb')
+            f_data = f.read()
+            f.close()
+
+            # Copy it under a file with the same name in the temp dir
+            f = file(os.path.join(tmp_dir, os.path.basename(img)), 'wb')
+            f.write(f_data)
+            f.close()
+
+        cmdline = [self.progs[prog], '-T' + format, tmp_name] + args
+
+        self.p = subprocess.Popen(
+            cmdline,
+            cwd=tmp_dir,
+            stderr=subprocess.PIPE, stdout=subprocess.PIPE
+        )
+
+        stderr = self.p.stderr
+        stdout = self.p.stdout
+
+        stdout_output = list()
+        while True:
+            data = stdout.read()
+            if not data:
+                break
+            stdout_output.append(data)
+        stdout.close()
+
+        stdout_output = ''.join(stdout_output)
+
+        if not stderr.closed:
+            stderr_output = list()
+            while True:
+                data = stderr.read()
+                if not data:
+                    break
+                stderr_output.append(data)
+            stderr.close()
+
+            if stderr_output:
+                stderr_output = ''.join(stderr_output)
+
+        status = self.p.wait()
+
+        if status != 0:
+            raise pydot.InvocationException(
+                'Program terminated with status: {0}. '
+                'stderr follows: {1}'.format(status, stderr_output))
+        elif stderr_output:
+            print stderr_output
+
+        #  For each of the image files...
+        for img in self.shape_files:
+            #  Remove it
+            os.unlink(os.path.join(tmp_dir, os.path.basename(img)))
+
+        os.unlink(tmp_name)
+
+        return stdout_output
@@ -1,10 +1,7 @@
 """Facility to render node graphs using pydot"""
 import os
-import subprocess
-import tempfile
 import threading
 
-import pydot
 from logbook import Logger
 
 from kitchen.settings import STATIC_ROOT, REPO, COLORS
@@ -12,6 +9,9 @@ from kitchen.backends.lchef import get_role_groups
 
 log = Logger(__name__)
 
+# Where the graph of the current node selection is drawn
+GRAPH_FILE = os.path.join(STATIC_ROOT, 'img', 'node_map.svg')
+
 
 def _build_links(nodes):
     """Returns a dictionary of nodes that have links to other nodes
@@ -51,6 +51,9 @@ def _build_links(nodes):
 
 def generate_node_map(nodes, roles, show_hostnames=True):
     """Generates a graphviz node map"""
+    # pydot is slow to import and only needed here
+    import pydot
+    from kitchen.dashboard.dot import KitchenDot
     graph = KitchenDot(graph_type='digraph')
     clusters = {}
     graph_nodes = {}
@@ -127,9 +130,8 @@ def generate_node_map(nodes, roles, show_hostnames=True):
             graph.add_edge(edge)
 
     # Generate graph
-    filename = os.path.join(STATIC_ROOT, 'img', 'node_map.svg')
     timeout = 10.0  # Seconds
-    graph_thread = GraphThread(filename, graph)
+    graph_thread = GraphThread(GRAPH_FILE, graph)
     graph_thread.start()
     result = graph_thread.join(timeout)
     if graph_thread.isAlive():
@@ -153,6 +155,7 @@ class GraphThread(threading.Thread):
         threading.Thread.__init__(self)
 
     def run(self):
+        import pydot
         try:
             self.graph.write_svg(self.filename)
         except pydot.InvocationException as e:
@@ -168,107 +171,3 @@ class GraphThread(threading.Thread):
     def kill(self):
         if self.graph.p:
             self.graph.p.kill()
-
-
-class KitchenDot(pydot.Dot):
-    """Inherits from the pydot library Dot class, and makes the subprocess as
-    an attribute for being killed from outside
-
-    """
-    def __init__(self, *argsl, **argsd):
-        super(KitchenDot, self).__init__(*argsl, **argsd)
-        self.p = None
-
-    def create(self, prog=None, format='ps'):
-        """Creates and returns a Postscript representation of the graph."""
-        if prog is None:
-            prog = self.prog
-
-        if isinstance(prog, (list, tuple)):
-            prog, args = prog[0], prog[1:]
-        else:
-            args = []
-
-        if self.progs is None:
-            self.progs = pydot.find_graphviz()
-            if self.progs is None:
-                raise pydot.InvocationException(
-                    'GraphViz\'s executables not found')
-
-        if not prog in self.progs:
-            raise pydot.InvocationException(
-                'GraphViz\'s executable "{0}" not found'.format(prog))
-
-        if (not os.path.exists(self.progs[prog])
-                or not os.path.isfile(self.progs[prog])):
-            raise pydot.InvocationException(
-                'GraphViz\'s executable "{0}" is not a file '
-                'or doesn\'t exist'.format(self.progs[prog]))
-
-        tmp_fd, tmp_name = tempfile.mkstemp()
-        os.close(tmp_fd)
-        self.write(tmp_name)
-        tmp_dir = os.path.dirname(tmp_name)
-
-        # For each of the image files...
-        for img in self.shape_files:
-            # Get its data
-            f = file(img, 'rb')
-            f_data = f.read()
-            f.close()
-
-            # Copy it under a file with the same name in the temp dir
-            f = file(os.path.join(tmp_dir, os.path.basename(img)), 'wb')
-            f.write(f_data)
-            f.close()
-
-        cmdline = [self.progs[prog], '-T' + format, tmp_name] + args
-
-        self.p = subprocess.Popen(
-            cmdline,
-            cwd=tmp_dir,
-            stderr=subprocess.PIPE, stdout=subprocess.PIPE
-        )
-
-        stderr = self.p.stderr
-        stdout = self.p.stdout
-
-        stdout_output = list()
-        while True:
-            data = stdout.read()
-            if not data:
-                break
-            stdout_output.append(data)
-        stdout.close()
-
-        stdout_output = ''.join(stdout_output)
-
-        if not stderr.closed:
-            stderr_output = list()
-            while True:
-                data = stderr.read()
-                if not data:
-                    break
-                stderr_output.append(data)
-            stderr.close()
-
-            if stderr_output:
-                stderr_output = ''.join(stderr_output)
-
-        status = self.p.wait()
-
-        if status != 0:
-            raise pydot.InvocationException(
-                'Program terminated with status: {0}. '
-                'stderr follows: {1}'.format(status, stderr_output))
-        elif stderr_output:
-            print stderr_output
-
-        #  For each of the image files...
-        for img in self.shape_files:
-            #  Remove it
-            os.unlink(os.path.join(tmp_dir, os.path.basename(img)))
-
-        os.unlink(tmp_name)
-
-        return stdout_output
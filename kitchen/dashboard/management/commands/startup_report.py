@@ -0,0 +1,88 @@
+"""Reports where the boot time of a web worker goes"""
+import sys
+import time
+import __builtin__
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+
+class ImportTimer(object):
+    """Times the modules imported while it is active. Each module gets the
+    time its import took and the time spent in the module itself, without
+    the modules it imported
+
+    """
+    def __init__(self):
+        self.timings = {}
+        self._stack = []
+        self._import = None
+
+    def __enter__(self):
+        self._import = __builtin__.__import__
+        __builtin__.__import__ = self._timed_import
+        return self
+
+    def __exit__(self, *exc_info):
+        __builtin__.__import__ = self._import
+
+    def _timed_import(self, name, globals=None, locals=None, fromlist=None,
+                      level=-1):
+        before = set(sys.modules)
+        # Time and modules taken by the imports nested in this one
+        self._stack.append([0.0, set()])
+        start = time.time()
+        try:
+            return self._import(name, globals, locals, fromlist, level)
+        finally:
+            total = time.time() - start
+            nested_time, nested_modules = self._stack.pop()
+            # Python 2 records failed relative imports as None
+            loaded = set(module for module in set(sys.modules) - before
+                         if sys.modules[module] is not None)
+            if self._stack:
+                self._stack[-1][0] += total
+                self._stack[-1][1].update(loaded)
+            own = loaded - nested_modules
+            if own:
+                # Importing a submodule may load its packages too
+                module = max(own, key=len)
+                self.timings[module] = (total, total - nested_time)
+
+
+class Command(NoArgsCommand):
+    help = ("Imports the kitchen modules and loads its data as a web worker "
+            "does, reporting how long each step and module import takes")
+    option_list = NoArgsCommand.option_list + (
+        make_option('--limit', type='int', default=20,
+                    help="Number of module imports to show"),
+    )
+
+    def handle_noargs(self, **options):
+        timer = ImportTimer()
+        steps = []
+        with timer:
+            start = time.time()
+            import kitchen.urls
+            steps.append(("import kitchen.urls", time.time() - start))
+            start = time.time()
+            import kitchen.dashboard.views
+            steps.append(("import kitchen.dashboard.views",
+                          time.time() - start))
+            from kitchen.backends import lchef
+            from kitchen.backends.plugins import plugins
+            start = time.time()
+            plugins.load()
+            steps.append(("import plugins", time.time() - start))
+            start = time.time()
+            lchef.get_snapshot()
+            steps.append(("load snapshot", time.time() - start))
+        self.stdout.write("Startup steps (ms):\n")
+        for step, duration in steps:
+            self.stdout.write("{0:9.1f}  {1}\n".format(duration * 1000, step))
+        self.stdout.write("Slowest module imports (ms, total / own):\n")
+        timings = sorted(timer.timings.items(), key=lambda item: item[1],
+                         reverse=True)
+        for name, (total, own) in timings[:options['limit']]:
+            self.stdout.write("{0:9.1f} {1:9.1f}  {2}\n".format(
+                total * 1000, own * 1000, name))
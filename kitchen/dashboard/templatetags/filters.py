@@ -1,6 +1,5 @@
 """Dashboard template filters"""
 from django import template
-import littlechef
 
 from kitchen.settings import REPO, TAG_CLASSES
 
@@ -10,8 +9,9 @@ register = template.Library()
 @register.filter(name='get_role_list')
 def get_role_list(run_list):
     """Returns the role sublist from the given run_list"""
+    from littlechef import lib
     role_list = []
-    for role in littlechef.lib.get_roles_in_node({'run_list': run_list or []}):
+    for role in lib.get_roles_in_node({'run_list': run_list or []}):
         if not role.startswith(REPO['EXCLUDE_ROLE_PREFIX']):
             # Only add if it doesn't start with excluded role prefixes
             role_list.append(role)
@@ -21,7 +21,8 @@ def get_role_list(run_list):
 @register.filter(name='get_recipe_list')
 def get_recipe_list(run_list):
     """Returns the recipe sublist from the given run_list"""
-    return littlechef.lib.get_recipes_in_node({'run_list': run_list or []})
+    from littlechef import lib
+    return lib.get_recipes_in_node({'run_list': run_list or []})
 
 
 @register.filter(name='get_memory_in_GB')
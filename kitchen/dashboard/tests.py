@@ -1,12 +1,23 @@
 """Tests for the kitchen.dashboard app"""
 import os
+import shutil
+import sys
+import tempfile
+import zlib
+from StringIO import StringIO
 
 import simplejson as json
+from django.http import HttpResponse
+from django.shortcuts import redirect
 from django.test import TestCase
+from django.test.client import RequestFactory
 from mock import patch
 
-from kitchen.backends import lchef as chef, plugins
-from kitchen.dashboard import graphs
+from kitchen.backends import lchef as chef, changes, plugins
+from kitchen.backends.plugins import stats as plugin_stats
+from kitchen.dashboard import api, caching, graphs
+from kitchen.dashboard.management.commands.startup_report import (
+    Command, ImportTimer)
 from kitchen.dashboard.templatetags import filters
 from kitchen.settings import STATIC_ROOT, REPO
 
@@ -21,6 +32,8 @@ class TestViews(TestCase):
     def setUp(self):
         if os.path.exists(self.filepath):
             os.remove(self.filepath)
+        # Tests change settings pages depend on
+        caching.page_cache.clear()
 
     @patch('kitchen.backends.lchef.KITCHEN_DIR', '/badrepopath/')
     def test_list_no_repo(self):
@@ -215,6 +228,35 @@ class TestViews(TestCase):
         self.assertEqual(
             resp['location'], 'http://monitoring.mydomain.com/testnode1')
 
+    def test_plugin_interface_node_list(self):
+        """Should give plugin views a list of all nodes, only running dynamic
+        plugins for the nodes the view reads, once per batch of nodes
+
+        """
+        calls = []
+
+        def inject_many(nodes):
+            calls.append(len(nodes))
+            for node in nodes:
+                node.setdefault('kitchen', {})['batch'] = True
+
+        @plugins.is_view('list')
+        def view(request, nodes):
+            first = json.loads(json.dumps(nodes[0:2] + []))
+            node = nodes.find('testnode2')
+            return redirect("/{0}/{1}/{2}".format(
+                len(nodes), first[1]['name'], node['kitchen']['batch']))
+        plugin = type('Plugin', (object,), {
+            'DYNAMIC': True, 'inject_many': staticmethod(inject_many),
+            'view': staticmethod(view)})
+        with patch.dict('kitchen.dashboard.views.PLUGINS', {'batch': plugin},
+                        clear=True):
+            with patch.dict(chef.plugins, {'batch': plugin}, clear=True):
+                resp = self.client.get("/plugins/batch/view")
+        self.assertEqual(resp.status_code, 302)
+        self.assertTrue(resp['location'].endswith('/9/testnode2/True'))
+        self.assertEqual(calls, [2])
+
 
 class TestGraph(TestCase):
     nodes = chef.get_nodes_extended()
@@ -411,6 +453,193 @@ class TestAPI(TestCase):
         self.assertEqual(data[0]['chef_environment'], 'staging')
         self.assertEqual(data[0]['role'], ['webserver'])
 
+    def test_get_nodes_streamed(self):
+        """Should stream the same JSON as serializing all nodes at once"""
+        snapshot = chef.get_snapshot()
+        for query, expected in [
+                ("", snapshot.nodes),
+                ("?extended=1", [node.to_dict()
+                                 for node in snapshot.nodes_extended]),
+                ("?env=staging&extended=1",
+                 [snapshot.nodes_extended[3].to_dict()]),
+                ("?env=bad", [])]:
+            # Payloads too large for the cache are streamed
+            with patch.object(caching.payload_cache, 'max_entry_size', 0):
+                resp = self.client.get("/api/nodes/" + query)
+            self.assertEqual(resp.status_code, 200)
+            self.assertTrue(resp._base_content_is_iter)
+            # The API serializes with the standard json module
+            self.assertEqual(resp.content, api.json.dumps(expected), query)
+
+    def test_get_nodes_paged(self):
+        """Should return a sorted page of nodes and the total count"""
+        resp = self.client.get("/api/nodes/?sort=-name&offset=2&limit=3")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp['X-Total-Count'], str(TOTAL_NODES))
+        data = json.loads(resp.content)
+        self.assertEqual([node['name'] for node in data],
+                         ['testnode7', 'testnode6', 'testnode5'])
+        resp = self.client.get("/api/nodes/?env=production&offset=100")
+        self.assertEqual(resp['X-Total-Count'], '7')
+        self.assertEqual(json.loads(resp.content), [])
+
+    def test_get_nodes_paged_not_cached(self):
+        """Should keep the total count when the response is streamed"""
+        with patch.object(caching.payload_cache, 'max_entry_size', 0):
+            resp = self.client.get("/api/nodes/?limit=1")
+        self.assertEqual(resp['X-Total-Count'], str(TOTAL_NODES))
+        self.assertEqual(len(json.loads(resp.content)), 1)
+
+    def test_get_nodes_bad_parameters(self):
+        """Should return BAD REQUEST for invalid paging or sorting"""
+        for query in ["limit=-1", "offset=a", "sort=memory"]:
+            resp = self.client.get("/api/nodes/?" + query)
+            self.assertEqual(resp.status_code, 400, query)
+
+    def test_get_nodes_fields(self):
+        """Should only return the requested attributes"""
+        resp = self.client.get(
+            "/api/nodes/?env=staging&fields=name,ipaddress,run_list")
+        self.assertEqual(json.loads(resp.content), [{
+            'name': 'testnode4', 'ipaddress': '4.4.4.4',
+            'run_list': ['role[webserver]']}])
+        resp = self.client.get(
+            "/api/nodes/?env=staging&extended=1&fields=name,role,memory/total")
+        self.assertEqual(json.loads(resp.content), [{
+            'name': 'testnode4', 'role': ['webserver']}])
+
+    def test_get_nodes_filters(self):
+        """Should filter nodes by roles, virt, tags and free text"""
+        for query, expected in [
+                ("roles=dbserver", ['testnode3.mydomain.com', 'testnode5']),
+                ("virt=host", ['testnode5', 'testnode9']),
+                ("tags=WIP", ['testnode7']),
+                ("q=testnode3", ['testnode3.mydomain.com']),
+                ("env=production&roles=webserver&q=node2", ['testnode2'])]:
+            resp = self.client.get("/api/nodes/?" + query)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(
+                [node['name'] for node in json.loads(resp.content)],
+                expected, query)
+
+    def test_get_facets(self):
+        """Should return node counts per facet for the given filters"""
+        resp = self.client.get("/api/facets?virt=host")
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.content)
+        self.assertEqual(data['virt_roles'], {'host': 2})
+        self.assertEqual(sum(data['environments'].values()), 2)
+        resp = self.client.get("/api/facets")
+        data = json.loads(resp.content)
+        self.assertEqual(sum(data['environments'].values()), TOTAL_NODES)
+
+    def test_get_nodes_bulk(self):
+        """Should return the requested nodes and the names not found"""
+        resp = self.client.get(
+            "/api/bulk?names=testnode6,testnode3,node_does_not_exist")
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.content)
+        self.assertEqual([node['name'] for node in data['nodes']],
+                         ['testnode6', 'testnode3.mydomain.com'])
+        self.assertTrue('role' not in data['nodes'][0])
+        self.assertEqual(data['missing'], ['node_does_not_exist'])
+
+    def test_get_nodes_bulk_post(self):
+        """Should read node names from a JSON or form POST body"""
+        resp = self.client.post("/api/bulk?extended=1",
+                                json.dumps(['testnode1', 'testnode1', 'x']),
+                                content_type="application/json")
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.content)
+        self.assertEqual(len(data['nodes']), 1)
+        self.assertEqual(data['nodes'][0]['role'], ['loadbalancer'])
+        self.assertEqual(data['missing'], ['x'])
+        resp = self.client.post("/api/bulk", {'names': 'testnode2,testnode4'})
+        data = json.loads(resp.content)
+        self.assertEqual([node['name'] for node in data['nodes']],
+                         ['testnode2', 'testnode4'])
+        self.assertEqual(data['missing'], [])
+
+    def test_get_nodes_bulk_bad_body(self):
+        """Should return BAD REQUEST when the JSON body is not a list"""
+        for body in ['{"names": []}', '[1, 2]', 'not json']:
+            resp = self.client.post("/api/bulk", body,
+                                    content_type="application/json")
+            self.assertEqual(resp.status_code, 400, body)
+
+    def test_get_changes(self):
+        """Should return the changes since a generation, or GONE when they
+        are not kept
+
+        """
+        snapshot_dir = tempfile.mkdtemp()
+        snapshot = chef.get_snapshot()
+        try:
+            with patch.object(changes, 'SNAPSHOT_DIR', snapshot_dir):
+                resp = self.client.get("/api/changes?since=gen1")
+                self.assertEqual(resp.status_code, 410)
+                changes.record_changes(None, snapshot)
+                resp = self.client.get(
+                    "/api/changes?since=" + snapshot.generation)
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(json.loads(resp.content), {
+                    'generation': snapshot.generation, 'changes': []})
+                resp = self.client.get("/api/changes")
+                self.assertEqual(resp.status_code, 400)
+        finally:
+            shutil.rmtree(snapshot_dir)
+
+    def test_wait_for_sync(self):
+        """Should return as soon as a new sync generation is available"""
+        generations = ['gen1', 'gen1', 'gen2']
+        with patch.object(chef, 'get_generation',
+                          side_effect=lambda: generations.pop(0)):
+            with patch.object(api, 'SYNC_WAIT_INTERVAL', 0.01):
+                with patch.object(api, '_count_changes',
+                                  return_value={'added': 1, 'removed': 0,
+                                                'modified': 2}):
+                    resp = self.client.get("/api/sync?generation=gen1")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.content), {
+            'generation': 'gen2', 'changed': True,
+            'changes': {'added': 1, 'removed': 0, 'modified': 2}})
+        self.assertEqual(generations, [])
+
+    def test_wait_for_sync_timeout(self):
+        """Should return the same generation when no sync happens in time"""
+        generation = chef.get_generation()
+        with patch.object(api, 'SYNC_WAIT_INTERVAL', 0.01):
+            resp = self.client.get(
+                "/api/sync?timeout=0&generation=" + generation)
+        self.assertEqual(json.loads(resp.content),
+                         {'generation': generation, 'changed': False})
+        resp = self.client.get("/api/sync")
+        self.assertEqual(json.loads(resp.content),
+                         {'generation': generation, 'changed': False})
+        resp = self.client.get("/api/sync?timeout=soon")
+        self.assertEqual(resp.status_code, 400)
+
+    def test_count_changes(self):
+        """Should count the nodes changed since a generation"""
+        entries = [{'added': ['a'], 'removed': [], 'modified': {'b': []}},
+                   {'added': ['c'], 'removed': ['a'], 'modified': {}}]
+        with patch.object(changes, 'get_changes',
+                          return_value=('gen3', entries)):
+            self.assertEqual(api._count_changes('gen1', 'gen3'),
+                             {'added': 2, 'removed': 1, 'modified': 1})
+            # The change log is not written yet
+            self.assertEqual(api._count_changes('gen1', 'gen4'), None)
+
+    def test_stream_json_list_chunks(self):
+        """Should split the streamed JSON in chunks"""
+        items = [{'name': "node{0}".format(i), 'data': 'x' * 100}
+                 for i in range(100)]
+        with patch('kitchen.dashboard.api.STREAM_CHUNK_SIZE', 1000):
+            chunks = list(api._stream_json_list(iter(items)))
+        self.assertTrue(len(chunks) > 10)
+        self.assertEqual(''.join(chunks), api.json.dumps(items))
+        self.assertEqual(list(api._stream_json_list([])), ['[]'])
+
     def test_get_node(self):
         """Should return a node hash when node name is found"""
         resp = self.client.get("/api/nodes/testnode6")
@@ -420,11 +649,428 @@ class TestAPI(TestCase):
         }
         self.assertEqual(json.loads(resp.content), expected_response)
 
+    def test_get_node_extended(self):
+        """Should return the extended node when extended is given"""
+        resp = self.client.get("/api/nodes/testnode6?extended=1")
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.content)
+        self.assertEqual(data['name'], 'testnode6')
+        self.assertEqual(data['role'], ['webserver'])
+        resp = self.client.get("/api/nodes/node_does_not_exist?extended=1")
+        self.assertEqual(resp.status_code, 404)
+
     def test_get_node_not_found(self):
         """Should return NOT FOUND when node name does not exist"""
         resp = self.client.get("/api/nodes/node_does_not_exist")
         self.assertEqual(resp.status_code, 404)
 
+    def test_get_node_by_fqdn_or_hostname(self):
+        """Should find a node by its fqdn or hostname"""
+        resp = self.client.get("/api/nodes/testnode3.mydomain.com")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.content)['name'],
+                         'testnode3.mydomain.com')
+        resp = self.client.get("/api/nodes/testnode3?extended=1")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.content)['fqdn'],
+                         'testnode3.mydomain.com')
+
+    def test_get_node_not_found_no_disk_access(self):
+        """Should return NOT FOUND without loading any node file"""
+        chef.get_snapshot()
+        with patch.object(chef, '_data_loader') as data_loader:
+            with patch.object(chef, '_load_node_data_bag') as load_data_bag:
+                resp = self.client.get(
+                    "/api/nodes/node_does_not_exist?extended=1")
+        self.assertEqual(resp.status_code, 404)
+        self.assertFalse(data_loader.called)
+        self.assertFalse(load_data_bag.called)
+
+    def test_get_plugin_stats(self):
+        """Should return the run statistics of plugins"""
+        plugin_stats.reset_stats()
+        plugin_stats.get_stats('monitoring').record(0.2)
+        with patch.object(chef.get_snapshot(), 'plugin_stats', {}):
+            resp = self.client.get("/api/plugins")
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.content)
+        self.assertEqual(data.keys(), ['monitoring'])
+        self.assertEqual(data['monitoring']['calls'], 1)
+        self.assertTrue(data['monitoring']['enabled'])
+        plugin_stats.reset_stats()
+
+    def test_get_static_plugin_stats(self):
+        """Should return the stats of static plugins saved with the snapshot
+        along with those of the plugins run by the web worker
+
+        """
+        plugin_stats.reset_stats()
+        plugin_stats.get_stats('dynamic').record(0.2)
+        snapshot = chef.get_snapshot()
+        with patch.object(snapshot, 'plugin_stats',
+                          {'static': {'calls': 2}}):
+            resp = self.client.get("/api/plugins")
+        data = json.loads(resp.content)
+        self.assertEqual(sorted(data.keys()), ['dynamic', 'static'])
+        self.assertEqual(data['static'], {'calls': 2})
+        self.assertEqual(data['dynamic']['calls'], 1)
+        plugin_stats.reset_stats()
+
+
+class TestConditionalGet(TestCase):
+
+    def setUp(self):
+        fd, self.syncdate_file = tempfile.mkstemp()
+        os.close(fd)
+        self.patchers = [
+            patch('kitchen.backends.lchef.SYNCDATE_FILE', self.syncdate_file),
+            patch('kitchen.dashboard.caching.SYNCDATE_FILE',
+                  self.syncdate_file),
+            patch('kitchen.dashboard.views.SYNCDATE_FILE',
+                  self.syncdate_file),
+        ]
+        for patcher in self.patchers:
+            patcher.start()
+
+    def tearDown(self):
+        for patcher in self.patchers:
+            patcher.stop()
+        os.remove(self.syncdate_file)
+
+    def _bump_sync_date(self):
+        """Simulates a repo sync"""
+        mtime = os.stat(self.syncdate_file).st_mtime + 1
+        os.utime(self.syncdate_file, (mtime, mtime))
+
+    def test_api_headers(self):
+        """Should set ETag and Last-Modified on API responses"""
+        resp = self.client.get("/api/nodes/?env=production")
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp['ETag'].startswith('"'))
+        self.assertTrue(resp.has_header('Last-Modified'))
+        other = self.client.get("/api/nodes/?extended=1&env=production")
+        self.assertNotEqual(other['ETag'], resp['ETag'])
+        same = self.client.get("/api/nodes/?env=production&")
+        self.assertEqual(same['ETag'], resp['ETag'])
+
+    def test_non_ascii_query(self):
+        """Should handle non-ASCII parameter names and values"""
+        for url in ["/api/roles?%C3%A9=1", "/api/roles?a=%C3%A9",
+                    "/api/roles/%C3%A9", "/?%C3%A9=1"]:
+            resp = self.client.get(url)
+            self.assertTrue(resp.status_code in (200, 404), url)
+            if resp.status_code == 200:
+                self.assertTrue(resp.has_header('ETag'), url)
+                resp = self.client.get(url, HTTP_IF_NONE_MATCH=resp['ETag'])
+                self.assertEqual(resp.status_code, 304, url)
+
+    def test_api_etag_per_encoding(self):
+        """Should not send the same ETag for plain and gzip bodies"""
+        plain = self.client.get("/api/roles")
+        compressed = self.client.get("/api/roles",
+                                     HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(compressed['Content-Encoding'], 'gzip')
+        self.assertNotEqual(plain['ETag'], compressed['ETag'])
+        resp = self.client.get("/api/roles", HTTP_ACCEPT_ENCODING='gzip',
+                               HTTP_IF_NONE_MATCH=plain['ETag'])
+        self.assertEqual(resp.status_code, 200)
+        resp = self.client.get("/api/roles", HTTP_ACCEPT_ENCODING='gzip',
+                               HTTP_IF_NONE_MATCH=compressed['ETag'])
+        self.assertEqual(resp.status_code, 304)
+
+    def test_api_not_modified(self):
+        """Should answer 304 without loading data while the sync is the same
+        """
+        for url in ["/api/nodes/?extended=1", "/api/roles",
+                    "/api/nodes/testnode2"]:
+            resp = self.client.get(url)
+            with patch.object(chef, 'get_snapshot') as get_snapshot:
+                cached = self.client.get(
+                    url, HTTP_IF_NONE_MATCH=resp['ETag'])
+                self.assertEqual(cached.status_code, 304, url)
+                self.assertEqual(cached.content, '')
+                cached = self.client.get(
+                    url, HTTP_IF_MODIFIED_SINCE=resp['Last-Modified'])
+                self.assertEqual(cached.status_code, 304, url)
+                self.assertFalse(get_snapshot.called)
+
+    def test_api_modified_after_sync(self):
+        """Should send the response again after a sync"""
+        resp = self.client.get("/api/nodes/")
+        self._bump_sync_date()
+        resp = self.client.get("/api/nodes/", HTTP_IF_NONE_MATCH=resp['ETag'])
+        self.assertEqual(resp.status_code, 200)
+
+    def test_api_last_modified_during_sync(self):
+        """Should keep the date of the previous sync until the new one is
+        served, and then send the response again
+
+        """
+        before = self.client.get("/api/roles")
+        chef.start_sync()
+        try:
+            mtime = os.stat(self.syncdate_file).st_mtime + 10
+            os.utime(self.syncdate_file, (mtime, mtime))
+            during = self.client.get("/api/roles")
+            self.assertEqual(during['Last-Modified'], before['Last-Modified'])
+            self.assertEqual(during['ETag'], before['ETag'])
+        finally:
+            chef.finish_sync()
+        after = self.client.get(
+            "/api/roles", HTTP_IF_MODIFIED_SINCE=during['Last-Modified'])
+        self.assertEqual(after.status_code, 200)
+        self.assertNotEqual(after['Last-Modified'], before['Last-Modified'])
+
+    def test_dashboard_not_modified(self):
+        """Should answer 304 to conditional requests of dashboard pages"""
+        for url in ["/", "/virt/", "/?env=staging"]:
+            resp = self.client.get(url)
+            self.assertEqual(resp.status_code, 200)
+            resp = self.client.get(url, HTTP_IF_NONE_MATCH=resp['ETag'])
+            self.assertEqual(resp.status_code, 304, url)
+
+    def test_dashboard_late_sync(self):
+        """Should not set validators when the page warns about a late sync,
+        as it shows how long ago the sync was
+
+        """
+        resp = self.client.get("/")
+        os.utime(self.syncdate_file, (0, 0))
+        resp = self.client.get("/", HTTP_IF_NONE_MATCH=resp['ETag'],
+                               HTTP_IF_MODIFIED_SINCE=resp['Last-Modified'])
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue("getting out of sync" in resp.content)
+        self.assertFalse(resp.has_header('ETag'))
+        self.assertFalse(resp.has_header('Last-Modified'))
+
+    def test_dashboard_with_dynamic_plugins(self):
+        """Should not set an ETag when plugins run on every request"""
+        plugin = type('Plugin', (object,), {
+            'DYNAMIC': True, 'inject': staticmethod(lambda node: None)})
+        with patch.dict(chef.plugins, {'dynamic': plugin}, clear=True):
+            resp = self.client.get("/")
+        self.assertEqual(resp.status_code, 200)
+        self.assertFalse(resp.has_header('ETag'))
+        self.assertFalse(resp.has_header('Last-Modified'))
+
+
+class TestPageCache(TestCase):
+
+    def setUp(self):
+        fd, self.syncdate_file = tempfile.mkstemp()
+        os.close(fd)
+        self.patchers = [
+            patch('kitchen.backends.lchef.SYNCDATE_FILE', self.syncdate_file),
+            patch('kitchen.dashboard.caching.SYNCDATE_FILE',
+                  self.syncdate_file),
+            patch('kitchen.dashboard.views.SYNCDATE_FILE',
+                  self.syncdate_file),
+        ]
+        for patcher in self.patchers:
+            patcher.start()
+        caching.page_cache.clear()
+
+    def tearDown(self):
+        for patcher in self.patchers:
+            patcher.stop()
+        os.remove(self.syncdate_file)
+        caching.page_cache.clear()
+
+    def test_cached_pages(self):
+        """Should serve repeated page loads without rendering them again"""
+        for url in ["/", "/virt/", "/?env=staging"]:
+            resp = self.client.get(url)
+            self.assertEqual(resp.status_code, 200)
+            with patch('kitchen.dashboard.views._get_data') as get_data:
+                cached = self.client.get(url)
+                self.assertFalse(get_data.called, url)
+            self.assertEqual(cached.content, resp.content)
+        self.assertEqual(caching.page_cache.get_stats()['entries'], 3)
+        resp = self.client.get("/?env=production&virt=")
+        self.assertEqual(caching.page_cache.get_stats()['entries'], 4)
+
+    def test_new_sync_renders_again(self):
+        """Should render pages again after a sync"""
+        self.client.get("/")
+        mtime = os.stat(self.syncdate_file).st_mtime + 1
+        os.utime(self.syncdate_file, (mtime, mtime))
+        self.client.get("/")
+        stats = caching.page_cache.get_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (0, 2))
+        self.client.get("/")
+        self.assertEqual(caching.page_cache.get_stats()['hits'], 1)
+
+    def test_bypass_late_sync(self):
+        """Should not cache pages showing how long ago a late sync was"""
+        os.utime(self.syncdate_file, (0, 0))
+        resp = self.client.get("/")
+        self.assertTrue("getting out of sync" in resp.content)
+        self.assertEqual(caching.page_cache.get_stats()['entries'], 0)
+
+    def test_bypass_with_messages(self):
+        """Should not cache pages with messages of previous requests"""
+        with patch.object(caching, 'get_messages', return_value=[1]):
+            self.client.get("/")
+        self.assertEqual(caching.page_cache.get_stats()['entries'], 0)
+
+    def test_error_pages_not_cached(self):
+        """Should not cache pages showing errors"""
+        with patch('kitchen.dashboard.views._get_data',
+                   side_effect=chef.RepoError("Broken repo")):
+            resp = self.client.get("/")
+        self.assertTrue("Broken repo" in resp.content)
+        self.assertEqual(caching.page_cache.get_stats()['entries'], 0)
+
+    def test_restore_written_files(self):
+        """Should write back the files written when the page was rendered"""
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        os.utime(path, (0, 0))
+
+        @caching.cache_render(files=[path])
+        def view(request):
+            with open(path, 'w') as f:
+                f.write(request.GET.get('name', ''))
+            return HttpResponse("graph")
+        factory = RequestFactory()
+        try:
+            resp = view(factory.get("/graph/", {'name': 'first'}))
+            self.assertEqual(resp.content, "graph")
+            view(factory.get("/graph/", {'name': 'second'}))
+            with patch.object(caching, '_gzip', side_effect=AssertionError):
+                resp = view(factory.get("/graph/", {'name': 'first'}))
+            self.assertEqual(resp.content, "graph")
+            with open(path) as f:
+                self.assertEqual(f.read(), "first")
+        finally:
+            os.remove(path)
+
+
+class TestPayloadCache(TestCase):
+
+    def setUp(self):
+        caching.payload_cache.clear()
+
+    def tearDown(self):
+        caching.payload_cache.clear()
+
+    def test_cached_payload(self):
+        """Should serve the same payload from the cache"""
+        resp = self.client.get("/api/nodes/?extended=1&env=production")
+        self.assertEqual(resp.status_code, 200)
+        with patch.object(chef, 'get_snapshot') as get_snapshot:
+            cached = self.client.get("/api/nodes/?env=production&extended=1")
+            self.assertFalse(get_snapshot.called)
+        self.assertEqual(cached.content, resp.content)
+        self.assertEqual(cached['Content-Type'], 'application/json')
+        self.assertEqual(cached['Content-Length'], str(len(resp.content)))
+        self.assertEqual(caching.payload_cache.hits, 1)
+        self.assertEqual(caching.payload_cache.misses, 1)
+
+    def test_large_payload_streamed(self):
+        """Should stream payloads larger than a cache entry, only buffering
+        up to the entry size
+
+        """
+        produced = []
+
+        def chunks():
+            for i in range(10):
+                produced.append(i)
+                yield 'x' * 10
+        view = caching.cache_payload(lambda request: HttpResponse(
+            chunks(), content_type='application/json'))
+        with patch.object(caching.payload_cache, 'max_entry_size', 25):
+            resp = view(RequestFactory().get("/api/nodes/"))
+        self.assertTrue(resp._base_content_is_iter)
+        self.assertEqual(len(produced), 3)
+        self.assertEqual(resp.content, 'x' * 100)
+        self.assertEqual(caching.payload_cache.get_stats()['entries'], 0)
+
+    def test_large_listing_not_cached(self):
+        """Should not fill the cache with a listing larger than an entry"""
+        size = len(self.client.get("/api/nodes/?extended=1").content)
+        caching.payload_cache.clear()
+        with patch.object(caching.payload_cache, 'max_entry_size', size - 1):
+            resp = self.client.get("/api/nodes/?extended=1")
+            self.assertTrue(resp._base_content_is_iter)
+            resp = self.client.get("/api/nodes/?extended=1&limit=1")
+            self.assertFalse(resp._base_content_is_iter)
+        self.assertEqual(caching.payload_cache.entries.keys(),
+                         [("/api/nodes/", "extended=1&limit=1")])
+
+    def test_gzip(self):
+        """Should send the compressed payload when the client accepts it"""
+        resp = self.client.get("/api/nodes/?extended=1")
+        for encoding in ["gzip", "deflate, gzip;q=0.5", "*"]:
+            compressed = self.client.get("/api/nodes/?extended=1",
+                                         HTTP_ACCEPT_ENCODING=encoding)
+            self.assertEqual(compressed['Content-Encoding'], 'gzip')
+            self.assertEqual(compressed['Vary'], 'Accept-Encoding')
+            self.assertEqual(zlib.decompress(compressed.content,
+                                             16 + zlib.MAX_WBITS),
+                             resp.content)
+            self.assertTrue(len(compressed.content) < len(resp.content))
+        for encoding in ["deflate", "gzip;q=0", "identity"]:
+            plain = self.client.get("/api/nodes/?extended=1",
+                                    HTTP_ACCEPT_ENCODING=encoding)
+            self.assertFalse(plain.has_header('Content-Encoding'))
+            self.assertEqual(plain.content, resp.content)
+
+    def test_generation_change(self):
+        """Should drop the cached payloads of older generations"""
+        cache = caching.PayloadCache(1000)
+        cache.set('gen1', 'a', caching.Payload('text/plain', 'a', 'za', ()))
+        self.assertEqual(cache.get('gen1', 'a').body, 'a')
+        self.assertEqual(cache.get('gen2', 'a'), None)
+        cache.set('gen2', 'b', caching.Payload('text/plain', 'b', 'zb', ()))
+        self.assertEqual(cache.get('gen1', 'a'), None)
+        self.assertEqual(cache.get_stats()['entries'], 1)
+
+    def test_lru_eviction(self):
+        """Should drop the least recently used payloads when full"""
+        cache = caching.PayloadCache(10)
+        for key in ['a', 'b', 'c']:
+            cache.set('gen', key,
+                      caching.Payload('text/plain', 'xx', 'yy', ()))
+            cache.get('gen', 'a')
+        self.assertEqual(cache.entries.keys(), ['c', 'a'])
+        self.assertEqual(cache.size, 8)
+        cache.set('gen', 'big',
+                  caching.Payload('text/plain', 'x' * 11, '', ()))
+        self.assertEqual(cache.get('gen', 'big'), None)
+
+    def test_cache_stats(self):
+        """Should return the counters of the API cache"""
+        self.client.get("/api/roles")
+        self.client.get("/api/roles")
+        resp = self.client.get("/api/cache")
+        data = json.loads(resp.content)
+        self.assertEqual((data['hits'], data['misses'], data['entries']),
+                         (1, 1, 1))
+
+
+class TestStartupReport(TestCase):
+
+    def test_import_timer(self):
+        """Should time the modules imported while active"""
+        sys.modules.pop('colorsys', None)
+        with ImportTimer() as timer:
+            import colorsys
+        self.assertEqual(timer.timings.keys(), ['colorsys'])
+        total, own = timer.timings['colorsys']
+        self.assertTrue(total >= own >= 0)
+
+    def test_startup_report(self):
+        """Should report the startup steps and module imports"""
+        output = StringIO()
+        command = Command()
+        command.stdout = output
+        command.handle_noargs(limit=5)
+        report = output.getvalue()
+        self.assertTrue("import kitchen.urls" in report)
+        self.assertTrue("load snapshot" in report)
+
 
 class TestTemplateTags(TestCase):
     run_list = [
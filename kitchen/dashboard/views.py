@@ -2,6 +2,7 @@
 import os
 import time
 import json
+from functools import partial
 
 from django.contrib.messages import add_message, ERROR, WARNING
 from django.shortcuts import render_to_response
@@ -9,39 +10,50 @@ from django.template import RequestContext
 from django.http import Http404, HttpResponseRedirect
 from logbook import Logger
 
-from kitchen.backends.lchef import (get_nodes, get_nodes_extended, get_roles,
-                                    get_role_groups, get_environments,
-                                    filter_nodes, group_nodes_by_host,
-                                    inject_plugin_data, RepoError, plugins as PLUGINS)
+from kitchen.backends.lchef import (get_snapshot,
+                                    group_nodes_by_host, inject_plugin_data,
+                                    RepoError, plugins as PLUGINS)
+from kitchen.backends.index import NodeList
 from kitchen.dashboard import graphs
+from kitchen.dashboard.caching import dashboard_condition, cache_render
 from kitchen.settings import (SHOW_VIRT_VIEW, SHOW_HOST_NAMES, SHOW_LINKS,
                               REPO, SYNCDATE_FILE)
 
 log = Logger(__name__)
 
+# Node attributes shown by the list and virt views
+LIST_FIELDS = ['name', 'fqdn', 'hostname', 'ipaddress', 'chef_environment',
+               'run_list', 'role', 'roles', 'recipes', 'tags',
+               'virtualization', 'kitchen', 'memory/total', 'cpu/total']
+
+
+def _get_data(request, env, roles, virt, group_by_host=False,
+              fields=LIST_FIELDS):
+    """Returns processed repository data, filtering nodes based on given args.
+    Nodes only contain the given attribute paths, or all attributes when
+    fields is None
 
-def _get_data(request, env, roles, virt, group_by_host=False):
-    """Returns processed repository data, filtering nodes based on given args
     """
     data = {'filter_env': env, 'filter_roles': roles, 'filter_virt': virt}
-    data['roles'] = get_roles()
-    roles_groups = get_role_groups(data['roles'])
-    data['roles_groups'] = roles_groups
+    snapshot = get_snapshot()
+    data['roles'] = snapshot.roles
+    data['roles_groups'] = snapshot.role_groups
     data['virt_roles'] = ['host', 'guest']
-    # Get environments before we filter nodes
-    data['nodes'] = get_nodes()
-    data['nodes_extended'] = get_nodes_extended(data['nodes'])
-    data['environments'] = get_environments(data['nodes_extended'])
+    # Environments are computed before nodes are filtered
+    data['nodes'] = snapshot.nodes
+    data['environments'] = snapshot.environments
     roles_to_filter = '' if group_by_host else data['filter_roles']
-    if data['filter_env'] or roles_to_filter or data['filter_virt']:
-        data['nodes_extended'] = filter_nodes(data['nodes_extended'],
-                                              data['filter_env'],
-                                              roles_to_filter,
-                                              data['filter_virt'])
+    records = snapshot.filter_nodes(
+        data['filter_env'], roles_to_filter, data['filter_virt'])
+    data['nodes_extended'] = [record.project(fields) for record in records]
     if group_by_host:
         data['nodes_extended'] = group_nodes_by_host(
             data['nodes_extended'], roles=data['filter_roles'])
-    inject_plugin_data(data['nodes_extended'])
+    if group_by_host:
+        snapshot.inject_plugin_data_by_host(data['nodes_extended'])
+    else:
+        snapshot.inject_plugin_data(data['nodes_extended'])
+    inject_plugin_data(data['nodes_extended'], dynamic=True)
     if not data['nodes_extended']:
         add_message(request, WARNING,
                     "There are no nodes that fit the supplied criteria.")
@@ -73,6 +85,8 @@ def _set_options(options):
     return options
 
 
+@dashboard_condition
+@cache_render()
 def main(request):
     """Default main view showing a list of nodes"""
     _show_repo_sync_date(request)
@@ -93,6 +107,8 @@ def main(request):
                               data, context_instance=RequestContext(request))
 
 
+@dashboard_condition
+@cache_render()
 def virt(request):
     """Displays a view where the nodes are grouped by physical host"""
     _show_repo_sync_date(request)
@@ -112,6 +128,8 @@ def virt(request):
                               data, context_instance=RequestContext(request))
 
 
+@dashboard_condition
+@cache_render(files=[graphs.GRAPH_FILE])
 def graph(request):
     """Graph view where users can visualize graphs of their nodes
     generated using Graphviz open source graph visualization library
@@ -123,7 +141,7 @@ def graph(request):
     env_filter = request.GET.get('env', REPO['DEFAULT_ENV'])
     try:
         data = _get_data(request, env_filter, request.GET.get('roles', ''),
-                         'guest')
+                         'guest', fields=None)
     except RepoError as e:
         add_message(request, ERROR, str(e))
     else:
@@ -143,6 +161,17 @@ def graph(request):
                               data, context_instance=RequestContext(request))
 
 
+def _build_plugin_nodes(snapshot, records):
+    """Returns the nodes of the given records with the output of all enabled
+    plugins, running dynamic plugins once for all of them
+
+    """
+    nodes = [record.to_dict() for record in records]
+    snapshot.inject_plugin_data(nodes)
+    inject_plugin_data(nodes, dynamic=True)
+    return nodes
+
+
 def plugins(request, name, method, plugin_type='list'):
     """Plugin interface view which either response with the page created by the
     plugin method, or returns a 404 HTTP Error
@@ -158,15 +187,20 @@ def plugins(request, name, method, plugin_type='list'):
         raise Http404("Plugin '{0}' has no method '{1}'".format(name, method))
     if not getattr(func, '__is_view__', False):
         raise Http404("Plugin method '{0}.{1}' is not defined as a view".format(name, method))
-    nodes = get_nodes()
-    nodes = get_nodes_extended(nodes)
+    snapshot = get_snapshot()
     if plugin_type in ('v', 'virt'):
         if func.__p_type__ != 'virt':
             raise Http404("Plugin '{0}.{1}' has wrong type".format(name, method))
+        nodes = [record.to_dict() for record in snapshot.nodes_extended]
         nodes = group_nodes_by_host(nodes, roles=None)
+        snapshot.inject_plugin_data_by_host(nodes)
+        inject_plugin_data(nodes, dynamic=True)
     elif func.__p_type__ != 'list':
         raise Http404("Plugin '{0}.{1}' has wrong type".format(name, method))
-    inject_plugin_data(nodes)
+    else:
+        # Only the nodes the plugin reads are decoded and get plugin data
+        nodes = NodeList(snapshot.index, snapshot.nodes_extended,
+                         partial(_build_plugin_nodes, snapshot))
     try:
         result = func(request, nodes)
     except TypeError:
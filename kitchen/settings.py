@@ -34,9 +34,50 @@ SHOW_HOST_NAMES = True
 SHOW_LINKS = True
 
 ENABLE_PLUGINS = []
+# Seconds a plugin may take to inject its data. A plugin module can set its
+# own TIME_BUDGET
+PLUGIN_TIME_BUDGET = 1.0
+# A plugin failing or going over budget this many times in a row is disabled
+# for PLUGIN_COOL_DOWN seconds
+PLUGIN_MAX_FAILURES = 3
+PLUGIN_COOL_DOWN = 300
+# Threads running plugins concurrently. A plugin module can set PROCESSES to
+# True to be run in a process instead
+PLUGIN_WORKERS = 4
+# Seconds after which a plugin adds no data. A plugin module can set its own
+# TIMEOUT
+PLUGIN_TIMEOUT = 5
+# Plugin results kept for plugins which set a TTL in seconds in their module
+PLUGIN_CACHE_SIZE = 10000
+
+# Number of threads reading the node data bag. 0 reads it serially
+LOAD_WORKERS = 0
+# Decode node data bag items using a pool of LOAD_WORKERS processes
+LOAD_WITH_PROCESSES = False
+
+# Bytes of memory used to cache API responses for the current repo sync
+API_CACHE_SIZE = 64 * 1024 * 1024
+# Larger API responses, like listings of many extended nodes, are streamed
+# instead of being cached
+API_CACHE_ENTRY_SIZE = 2 * 1024 * 1024
+# Bytes of memory used to cache rendered dashboard pages
+PAGE_CACHE_SIZE = 32 * 1024 * 1024
+
+# Number of repo syncs, and bytes, of node changes kept for /api/changes
+CHANGES_MAX_ENTRIES = 100
+CHANGES_MAX_SIZE = 10 * 1024 * 1024
+
+# Longest time in seconds /api/sync waits for a new repo sync, and how often
+# it checks for one
+SYNC_WAIT_TIMEOUT = 30
+SYNC_WAIT_INTERVAL = 1
 
 LOG_FILE = '/tmp/kitchen.log'
 SYNCDATE_FILE = '/tmp/kitchen-syncdate'
+# Where the repo sync saves the data loaded by the web workers. It must only
+# be writable by the user running the repo sync, snapshots in a directory
+# other users can write to are ignored
+SNAPSHOT_DIR = os.path.join(REPO_BASE_PATH, 'kitchen-snapshots')
 ###################
 
 ADMINS = ()
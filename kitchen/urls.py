@@ -11,9 +11,15 @@ urlpatterns = patterns('',
     (r'^virt/$', 'kitchen.dashboard.views.virt'),
     (r'^graph/$', 'kitchen.dashboard.views.graph'),
     (r'^plugins/((?P<plugin_type>(virt|v|list|l))/)?(?P<name>[\w\-\_]+)/(?P<method>\w+)/?$', 'kitchen.dashboard.views.plugins'),
-    (r'^api/nodes/(?P<name>\w+)$', api.get_node),
+    (r'^api/nodes/(?P<name>[\w\-\.]+)$', api.get_node),
     (r'^api/nodes', api.get_nodes),
+    (r'^api/bulk', api.get_nodes_bulk),
     (r'^api/roles', api.get_roles),
+    (r'^api/changes', api.get_changes),
+    (r'^api/sync', api.wait_for_sync),
+    (r'^api/facets', api.get_facets),
+    (r'^api/plugins', api.get_plugin_stats),
+    (r'^api/cache', api.get_cache_stats),
     (r'^404', 'django.views.generic.simple.direct_to_template',
               {'template': '404.html'}),
 )